@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify, Response, render_template_string, send_file
+from flask import Flask, request, jsonify, Response, send_file
 import os
 import uuid
 import httpx
@@ -7,39 +7,1318 @@ from apify_client import ApifyClient
 import json
 import time
 import requests
-from urllib.parse import quote
+from urllib.parse import quote, urlparse, parse_qsl
 import io
+import sys
 import tempfile
+import sqlite3
+import threading
+import hmac
+import hashlib
+import base64
+import zlib
+import gzip
+import html
+import heapq
+import bisect
+import socket
+from abc import ABC, abstractmethod
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError, ProtocolError, ReadTimeoutError
+from http.client import HTTPException
+from urllib3.util.connection import create_connection
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from string import Template
+from datetime import datetime, timezone
 
 app = Flask(__name__)
 
 # Initialize Apify client
 client = ApifyClient("apify_api_8gRV9FC5Igq5gQ40effgxuEaJBnzYm23Krp2")
 
-# Store sessions in memory
-SESSIONS = {}
+# ============= METRICS =============
 
-def get_terabox_download_url(terabox_url):
-    """Get download URL from Terabox using Apify"""
+# Prometheus text exposition at /metrics. Hot-path counters and histograms
+# are sharded per thread, so recording a sample takes no lock. Each worker
+# writes its samples to METRICS_DIR/<pid>.json every METRICS_FLUSH_INTERVAL
+# seconds, and whichever worker is scraped merges them. Counters from workers
+# that have exited are kept for METRICS_RETENTION; their gauges are dropped.
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") == "1"
+METRICS_DIR = os.environ.get("METRICS_DIR", os.path.join(tempfile.gettempdir(), "terabox_metrics"))
+METRICS_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", 5))
+METRICS_RETENTION = float(os.environ.get("METRICS_RETENTION", 3600))
+METRICS_PREFIX = "terabox_proxy_"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+RESOLVE_BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 60, 120)
+
+class Metric(ABC):
+    """Base for registered metrics - collect() returns [(suffix, labels, value)]"""
+    
+    kind = "untyped"
+    
+    def __init__(self, name, help_text, labels=(), per_worker=True):
+        self.name = METRICS_PREFIX + name
+        self.help = help_text
+        self.labels = tuple(labels)
+        # False for values that are the same in every worker, e.g. the shared session count
+        self.per_worker = per_worker
+        METRICS_REGISTRY.append(self)
+    
+    def label_dict(self, values):
+        return dict(zip(self.labels, values))
+    
+    @abstractmethod
+    def collect(self):
+        pass
+
+class ShardedMetric(Metric):
+    """Keeps one dict of values per thread - only the owning thread writes to it.
+    Shards of finished threads are folded into `retired` when collected."""
+    
+    def __init__(self, name, help_text, labels=()):
+        super().__init__(name, help_text, labels)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.shards = []  # (thread, values)
+        self.retired = {}
+    
+    def _shard(self):
+        values = getattr(self.local, "values", None)
+        if values is None:
+            values = self.local.values = {}
+            with self.lock:
+                self.shards.append((threading.current_thread(), values))
+        return values
+    
+    def _merged(self, add):
+        with self.lock:
+            live = []
+            for thread, values in self.shards:
+                if thread.is_alive():
+                    live.append((thread, values))
+                else:
+                    for key, value in list(values.items()):
+                        self.retired[key] = add(self.retired.get(key), value)
+            self.shards = live
+            merged = dict(self.retired)
+        for _, values in live:
+            for key, value in list(values.items()):
+                merged[key] = add(merged.get(key), value)
+        return merged
+
+class Counter(ShardedMetric):
+    kind = "counter"
+    
+    def inc(self, amount=1, labels=()):
+        values = self._shard()
+        values[labels] = values.get(labels, 0) + amount
+    
+    def total(self):
+        """Sum over every label set, in this worker"""
+        return sum(value for _, _, value in self.collect())
+    
+    def collect(self):
+        merged = self._merged(lambda total, value: (total or 0) + value)
+        return [("", self.label_dict(labels), value) for labels, value in merged.items()]
+
+class Histogram(ShardedMetric):
+    kind = "histogram"
+    
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+    
+    def observe(self, value, labels=()):
+        values = self._shard()
+        state = values.get(labels)
+        if state is None:
+            # Per-bucket counts (the last one is +Inf), then sum and count
+            state = values[labels] = [0] * (len(self.buckets) + 3)
+        state[bisect.bisect_left(self.buckets, value)] += 1
+        state[-2] += value
+        state[-1] += 1
+    
+    def time(self, labels=()):
+        return _HistogramTimer(self, labels)
+    
+    def collect(self):
+        def add(total, value):
+            value = list(value)
+            return value if total is None else [a + b for a, b in zip(total, value)]
+        
+        samples = []
+        for labels, state in self._merged(add).items():
+            label_dict = self.label_dict(labels)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), state):
+                cumulative += count
+                samples.append(("_bucket", {**label_dict, "le": _format_bound(bound)}, cumulative))
+            samples.append(("_sum", label_dict, state[-2]))
+            samples.append(("_count", label_dict, state[-1]))
+        return samples
+
+class _HistogramTimer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+    
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+    
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, self.labels)
+
+class CallbackMetric(Metric):
+    """Gauge or counter read at collection time from state the proxy already keeps.
+    `func` returns a number, or a dict of label-value tuples to numbers."""
+    
+    def __init__(self, name, help_text, func, kind="gauge", labels=(), per_worker=True):
+        super().__init__(name, help_text, labels, per_worker)
+        self.kind = kind
+        self.func = func
+    
+    def collect(self):
+        values = self.func()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [("", self.label_dict(labels), value) for labels, value in values.items()]
+
+METRICS_REGISTRY = []
+
+def _format_bound(bound):
+    return "+Inf" if bound == float("inf") else repr(float(bound))
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def collect_metrics(per_worker_only=False):
+    """{name: {"type", "help", "samples"}} for this process"""
+    families = {}
+    for metric in METRICS_REGISTRY:
+        if per_worker_only and not metric.per_worker:
+            continue
+        try:
+            samples = metric.collect()
+        except Exception as e:
+            print(f"Metric {metric.name} failed: {e}")
+            continue
+        families[metric.name] = {"type": metric.kind, "help": metric.help, "samples": samples}
+    return families
+
+def flush_metrics():
+    """Write this worker's samples where the other workers can merge them"""
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, f"{os.getpid()}.json")
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(collect_metrics(per_worker_only=True), f)
+    os.replace(tmp_path, path)
+
+def metrics_flusher():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            flush_metrics()
+        except Exception as e:
+            print(f"Metrics flush error: {e}")
+
+def worker_metric_files():
+    """(families, live) for every other worker's metrics file - expired files are removed"""
+    try:
+        names = os.listdir(METRICS_DIR)
+    except OSError:
+        return []
+    
+    now = time.time()
+    workers = []
+    for name in names:
+        if not name.endswith(".json") or name == f"{os.getpid()}.json":
+            continue
+        path = os.path.join(METRICS_DIR, name)
+        try:
+            age = now - os.path.getmtime(path)
+            if age > METRICS_RETENTION:
+                os.remove(path)
+                continue
+            with open(path) as f:
+                workers.append((json.load(f), age <= 3 * METRICS_FLUSH_INTERVAL))
+        except (OSError, ValueError):
+            continue
+    return workers
+
+def render_metrics():
+    """Text exposition of this worker's metrics summed with every other worker's"""
+    families = collect_metrics()
+    merged = {}
+    for name, family in families.items():
+        merged[name] = {"type": family["type"], "help": family["help"], "values": OrderedDict()}
+    
+    sources = [(families, True)] + worker_metric_files()
+    for source, live in sources:
+        for name, family in source.items():
+            if name not in merged or (family["type"] == "gauge" and not live):
+                continue
+            values = merged[name]["values"]
+            for suffix, labels, value in family["samples"]:
+                key = (suffix, tuple(sorted(labels.items())))
+                values[key] = values.get(key, 0) + value
+    
+    lines = []
+    for name, family in merged.items():
+        lines.append(f"# HELP {name} {family['help']}")
+        lines.append(f"# TYPE {name} {family['type']}")
+        for (suffix, labels), value in family["values"].items():
+            label_text = ",".join(f'{key}="{_escape_label(val)}"' for key, val in labels)
+            lines.append(f"{name}{suffix}{{{label_text}}} {value}" if label_text else f"{name}{suffix} {value}")
+    return "\n".join(lines) + "\n"
+
+RESOLVE_SECONDS = Histogram(
+    "resolve_seconds", "Apify resolution of a share link, by outcome", ("outcome",), RESOLVE_BUCKETS
+)
+UPSTREAM_TTFB_SECONDS = Histogram(
+    "upstream_ttfb_seconds", "Time from sending an upstream request to its response headers", ("client",)
+)
+UPSTREAM_RESPONSES = Counter("upstream_responses_total", "Upstream responses by status code", ("status",))
+UPSTREAM_READ_BYTES = Counter("upstream_read_bytes_total", "Body bytes read from the CDN")
+HEADER_FALLBACKS = Counter(
+    "upstream_header_fallbacks_total", "Stream requests retried with the next header profile after a refusal",
+    ("status",)
+)
+LINK_REJECTIONS = Counter("upstream_link_rejections_total", "Download links the CDN refused with 403/410")
+PROXY_REQUESTS = Counter("requests_total", "/stream and /download requests", ("mode",))
+PROXY_REJECTED = Counter("rejected_total", "Requests turned away by the stream budget", ("reason",))
+RELAYED_BYTES = Counter("relayed_bytes_total", "Body bytes sent to clients", ("mode",))
+
+# ============= SESSION STORE =============
+
+# Session backend: "sqlite" (shared by all workers on this machine) or "memory"
+SESSION_STORE = os.environ.get("SESSION_STORE", "sqlite")
+SESSION_DB_PATH = os.environ.get(
+    "SESSION_DB_PATH", os.path.join(tempfile.gettempdir(), "terabox_sessions.db")
+)
+SESSION_CACHE_SIZE = int(os.environ.get("SESSION_CACHE_SIZE", 1024))
+SESSION_CACHE_TTL = float(os.environ.get("SESSION_CACHE_TTL", 5))
+
+# Expiry reaper and hard cap (least recently used sessions go first)
+SESSION_MAX_COUNT = int(os.environ.get("SESSION_MAX_COUNT", 100000))
+SESSION_REAP_INTERVAL = float(os.environ.get("SESSION_REAP_INTERVAL", 30))
+SESSION_REAP_BATCH = int(os.environ.get("SESSION_REAP_BATCH", 500))
+
+class SessionStore(ABC):
+    """Interface for session backends - dict-like so routes stay unchanged.
+    get() returns a copy, so callers may change it without touching the store."""
+    
+    @abstractmethod
+    def get(self, session_id, default=None):
+        pass
+    
+    @abstractmethod
+    def set(self, session_id, session):
+        pass
+    
+    @abstractmethod
+    def delete(self, session_id):
+        pass
+    
+    @abstractmethod
+    def items(self):
+        pass
+    
+    @abstractmethod
+    def __len__(self):
+        pass
+    
+    def reap(self, now, limit):
+        """Remove up to `limit` expired sessions - returns how many were removed"""
+        return 0
+    
+    def evict(self, max_count, limit):
+        """Remove up to `limit` least recently used sessions above `max_count`"""
+        return 0
+    
+    def __getitem__(self, session_id):
+        session = self.get(session_id)
+        if session is None:
+            raise KeyError(session_id)
+        return session
+    
+    def __setitem__(self, session_id, session):
+        self.set(session_id, session)
+    
+    def __delitem__(self, session_id):
+        self.delete(session_id)
+    
+    def __contains__(self, session_id):
+        return self.get(session_id) is not None
+
+class MemorySessionStore(SessionStore):
+    """Per-process store - only correct with a single worker"""
+    
+    def __init__(self, max_count=0):
+        self.sessions = OrderedDict()
+        self.expiry_heap = []
+        self.max_count = max_count
+        self.lock = threading.Lock()
+    
+    def get(self, session_id, default=None):
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                return default
+            self.sessions.move_to_end(session_id)
+            return dict(session)
+    
+    def set(self, session_id, session):
+        with self.lock:
+            self.sessions[session_id] = dict(session)
+            self.sessions.move_to_end(session_id)
+            heapq.heappush(self.expiry_heap, (session.get("expire", 0), session_id))
+            
+            # Hard cap - drop least recently used immediately
+            while self.max_count and len(self.sessions) > self.max_count:
+                self.sessions.popitem(last=False)
+    
+    def delete(self, session_id):
+        with self.lock:
+            self.sessions.pop(session_id, None)
+    
+    def items(self):
+        with self.lock:
+            return [(session_id, dict(session)) for session_id, session in self.sessions.items()]
+    
+    def __len__(self):
+        return len(self.sessions)
+    
+    def reap(self, now, limit):
+        removed = 0
+        with self.lock:
+            while self.expiry_heap and removed < limit and self.expiry_heap[0][0] < now:
+                expire, session_id = heapq.heappop(self.expiry_heap)
+                session = self.sessions.get(session_id)
+                # Heap entries are lazy - skip ones superseded by a later set()
+                if session is not None and session.get("expire", 0) == expire:
+                    del self.sessions[session_id]
+                    removed += 1
+            
+            # Drop stale heap entries so the heap can't outgrow the store
+            if len(self.expiry_heap) > 2 * len(self.sessions) + 1024:
+                self.expiry_heap = [
+                    (expire, session_id) for expire, session_id in self.expiry_heap
+                    if session_id in self.sessions
+                    and self.sessions[session_id].get("expire", 0) == expire
+                ]
+                heapq.heapify(self.expiry_heap)
+        return removed
+    
+    def evict(self, max_count, limit):
+        removed = 0
+        with self.lock:
+            while len(self.sessions) > max_count and removed < limit:
+                self.sessions.popitem(last=False)
+                removed += 1
+        return removed
+
+class SQLiteSessionStore(SessionStore):
+    """Store shared by every worker process on the host via an mmap'd sqlite file"""
+    
+    # Only record an access when the stored one is older than this (keeps reads read-only)
+    TOUCH_INTERVAL = 60
+    
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "id TEXT PRIMARY KEY, data TEXT NOT NULL, expire REAL NOT NULL, "
+            "accessed REAL NOT NULL DEFAULT 0)"
+        )
+        try:
+            conn.execute("ALTER TABLE sessions ADD COLUMN accessed REAL NOT NULL DEFAULT 0")
+        except sqlite3.OperationalError:
+            pass
+        conn.execute("CREATE INDEX IF NOT EXISTS sessions_expire ON sessions(expire)")
+        conn.execute("CREATE INDEX IF NOT EXISTS sessions_accessed ON sessions(accessed)")
+        conn.commit()
+    
+    def _conn(self):
+        # sqlite connections must not be shared between threads
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA mmap_size=67108864")
+            self.local.conn = conn
+        return conn
+    
+    def get(self, session_id, default=None):
+        row = self._conn().execute(
+            "SELECT data, accessed FROM sessions WHERE id = ?", (session_id,)
+        ).fetchone()
+        if not row:
+            return default
+        
+        now = time.time()
+        if now - row[1] > self.TOUCH_INTERVAL:
+            self._conn().execute(
+                "UPDATE sessions SET accessed = ? WHERE id = ?", (now, session_id)
+            )
+        return json.loads(row[0])
+    
+    def set(self, session_id, session):
+        self._conn().execute(
+            "INSERT OR REPLACE INTO sessions (id, data, expire, accessed) VALUES (?, ?, ?, ?)",
+            (session_id, json.dumps(session), session.get("expire", 0), time.time()),
+        )
+    
+    def delete(self, session_id):
+        self._conn().execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+    
+    def items(self):
+        rows = self._conn().execute("SELECT id, data FROM sessions").fetchall()
+        return [(session_id, json.loads(data)) for session_id, data in rows]
+    
+    def __len__(self):
+        return self._conn().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+    
+    def reap(self, now, limit):
+        cursor = self._conn().execute(
+            "DELETE FROM sessions WHERE id IN "
+            "(SELECT id FROM sessions WHERE expire < ? ORDER BY expire LIMIT ?)",
+            (now, limit),
+        )
+        return cursor.rowcount
+    
+    def evict(self, max_count, limit):
+        excess = len(self) - max_count
+        if excess <= 0:
+            return 0
+        cursor = self._conn().execute(
+            "DELETE FROM sessions WHERE id IN "
+            "(SELECT id FROM sessions ORDER BY accessed LIMIT ?)",
+            (min(excess, limit),),
+        )
+        return cursor.rowcount
+
+class KeyValueSessionStore(SessionStore):
+    """Networked store over any client with get/set/delete/scan_iter (e.g. redis-py)"""
+    
+    def __init__(self, kv_client, prefix="tbsession:"):
+        self.kv = kv_client
+        self.prefix = prefix
+    
+    def get(self, session_id, default=None):
+        data = self.kv.get(self.prefix + session_id)
+        return json.loads(data) if data else default
+    
+    def set(self, session_id, session):
+        ttl = max(1, int(session.get("expire", 0) - time.time()))
+        self.kv.set(self.prefix + session_id, json.dumps(session), ex=ttl)
+    
+    def delete(self, session_id):
+        self.kv.delete(self.prefix + session_id)
+    
+    def items(self):
+        result = []
+        for key in self.kv.scan_iter(match=self.prefix + "*"):
+            key = key.decode() if isinstance(key, bytes) else key
+            session = self.get(key[len(self.prefix):])
+            if session is not None:
+                result.append((key[len(self.prefix):], session))
+        return result
+    
+    def __len__(self):
+        return sum(1 for _ in self.kv.scan_iter(match=self.prefix + "*"))
+
+class CachedSessionStore(SessionStore):
+    """Small in-process read-through cache in front of a shared store.
+    Cached sessions are copied on the way in and out, never handed out shared."""
+    
+    def __init__(self, backend, maxsize=1024, ttl=5):
+        self.backend = backend
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+    
+    def get(self, session_id, default=None):
+        now = time.time()
+        with self.lock:
+            entry = self.cache.get(session_id)
+            if entry and now - entry[0] < self.ttl:
+                self.cache.move_to_end(session_id)
+                return dict(entry[1])
+        
+        session = self.backend.get(session_id)
+        if session is None:
+            return default
+        
+        self._remember(session_id, session)
+        return session
+    
+    def _remember(self, session_id, session):
+        with self.lock:
+            self.cache[session_id] = (time.time(), dict(session))
+            self.cache.move_to_end(session_id)
+            while len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+    
+    def set(self, session_id, session):
+        self.backend.set(session_id, session)
+        self._remember(session_id, session)
+    
+    def delete(self, session_id):
+        self.backend.delete(session_id)
+        with self.lock:
+            self.cache.pop(session_id, None)
+    
+    def items(self):
+        return self.backend.items()
+    
+    def __len__(self):
+        return len(self.backend)
+    
+    def reap(self, now, limit):
+        return self.backend.reap(now, limit)
+    
+    def evict(self, max_count, limit):
+        return self.backend.evict(max_count, limit)
+
+def create_session_store():
+    """Build the configured session store"""
+    if SESSION_STORE == "memory":
+        return MemorySessionStore(max_count=SESSION_MAX_COUNT)
+    
+    return CachedSessionStore(
+        SQLiteSessionStore(SESSION_DB_PATH),
+        maxsize=SESSION_CACHE_SIZE,
+        ttl=SESSION_CACHE_TTL,
+    )
+
+SESSIONS = create_session_store()
+
+REAPER_STATS = {"runs": 0, "last_run": None, "last_reaped": 0, "reaped_total": 0, "evicted_total": 0}
+
+def reap_sessions():
+    """Evict expired and over-cap sessions in bounded slices"""
+    reaped = evicted = 0
+    
+    while True:
+        removed = SESSIONS.reap(time.time(), SESSION_REAP_BATCH)
+        reaped += removed
+        if removed < SESSION_REAP_BATCH:
+            break
+        time.sleep(0)  # let request threads in between slices
+    
+    while True:
+        removed = SESSIONS.evict(SESSION_MAX_COUNT, SESSION_REAP_BATCH)
+        evicted += removed
+        if removed < SESSION_REAP_BATCH:
+            break
+        time.sleep(0)
+    
+    REAPER_STATS["runs"] += 1
+    REAPER_STATS["last_run"] = time.time()
+    REAPER_STATS["last_reaped"] = reaped
+    REAPER_STATS["reaped_total"] += reaped
+    REAPER_STATS["evicted_total"] += evicted
+    return reaped, evicted
+
+def session_reaper():
+    """Background loop - replaces scanning the whole store on /cleanup"""
+    while True:
+        time.sleep(SESSION_REAP_INTERVAL)
+        try:
+            reap_sessions()
+        except Exception as e:
+            print(f"Session reaper error: {e}")
+
+threading.Thread(target=session_reaper, name="session-reaper", daemon=True).start()
+
+# ============= STATELESS SESSION TOKENS =============
+
+# "store" keeps sessions in SESSIONS, "token" packs them into a signed session ID
+SESSION_MODE = os.environ.get("SESSION_MODE", "store")
+SESSION_SECRET = os.environ.get("SESSION_SECRET", "").encode()
+SESSION_TOKEN_ENCRYPT = os.environ.get("SESSION_TOKEN_ENCRYPT", "0") == "1"
+
+try:
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:
+    AESGCM = None
+
+if SESSION_MODE == "token" and not SESSION_SECRET:
+    # The signing key is derived from the secret - without one anybody could mint tokens
+    raise RuntimeError("SESSION_MODE=token requires SESSION_SECRET")
+
+if SESSION_TOKEN_ENCRYPT and AESGCM is None:
+    print("⚠️ cryptography not installed - session tokens will be signed but not encrypted")
+    SESSION_TOKEN_ENCRYPT = False
+
+def derive_token_key(purpose, secret):
+    return hashlib.sha256(b"terabox-token-" + purpose + b":" + secret).digest()
+
+TOKEN_MAC_KEY = derive_token_key(b"mac", SESSION_SECRET)
+TOKEN_ENC_KEY = derive_token_key(b"enc", SESSION_SECRET)
+TOKEN_MAC_SIZE = 16
+TOKEN_FLAG_PLAIN = b"p"
+TOKEN_FLAG_ENCRYPTED = b"e"
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+def encode_session_token(session):
+    """Pack a session into a compact, HMAC-signed (optionally encrypted) token"""
+    payload = zlib.compress(json.dumps({
+        "u": session["download_url"],
+        "f": session["filename"],
+        "e": int(session["expire"]),
+        "t": session.get("terabox_url"),
+        "i": int(session["url_issued"]),
+        "x": int(session["url_expire"]),
+    }, separators=(",", ":")).encode())
+    
+    if SESSION_TOKEN_ENCRYPT:
+        nonce = os.urandom(12)
+        body = TOKEN_FLAG_ENCRYPTED + nonce + AESGCM(TOKEN_ENC_KEY).encrypt(nonce, payload, None)
+    else:
+        body = TOKEN_FLAG_PLAIN + payload
+    
+    mac = hmac.new(TOKEN_MAC_KEY, body, hashlib.sha256).digest()[:TOKEN_MAC_SIZE]
+    return f"{_b64encode(body)}.{_b64encode(mac)}"
+
+def decode_session_token(token):
+    """Verify and unpack a session token - returns None if invalid or expired"""
+    try:
+        body_text, mac_text = token.split(".", 1)
+        body = _b64decode(body_text)
+        expected = hmac.new(TOKEN_MAC_KEY, body, hashlib.sha256).digest()[:TOKEN_MAC_SIZE]
+        if not hmac.compare_digest(expected, _b64decode(mac_text)):
+            return None
+        
+        flag, payload = body[:1], body[1:]
+        if flag == TOKEN_FLAG_ENCRYPTED:
+            if AESGCM is None:
+                return None
+            payload = AESGCM(TOKEN_ENC_KEY).decrypt(payload[:12], payload[12:], None)
+        elif flag != TOKEN_FLAG_PLAIN:
+            return None
+        
+        data = json.loads(zlib.decompress(payload))
+    except Exception:
+        return None
+    
+    if data["e"] < time.time():
+        return None
+    
+    session = {
+        "download_url": data["u"],
+        "filename": data["f"],
+        "expire": data["e"],
+        "status": "ready",
+    }
+    # Tokens issued before URL refresh existed have no link fields
+    if "x" in data:
+        session.update(terabox_url=data["t"], url_issued=data["i"], url_expire=data["x"])
+    return session
+
+def get_session(session_id):
+    """Look up a session by ID - a signed token in token mode, a store key otherwise"""
+    if SESSION_MODE == "token":
+        session = decode_session_token(session_id)
+        # A token can't be rewritten, so a refreshed link is held next to it
+        return url_refresher.apply(session_id, session) if session else None
+    
+    session = SESSIONS.get(session_id)
+    # The reaper runs periodically, so treat not-yet-reaped sessions as gone
+    if session is not None and session["expire"] < time.time():
+        return None
+    return session
+
+# Batch processing limits - links are resolved BATCH_RESOLVE_SIZE per actor run,
+# with up to BATCH_WORKERS runs at once
+BATCH_MAX_URLS = int(os.environ.get("BATCH_MAX_URLS", 50))
+BATCH_WORKERS = int(os.environ.get("BATCH_WORKERS", 8))
+BATCH_RESOLVE_SIZE = int(os.environ.get("BATCH_RESOLVE_SIZE", 10))
+
+# ============= UPSTREAM HTTP CLIENT =============
+
+# Keep-alive pools to the Terabox CDN, shared by every request thread
+UPSTREAM_POOL_HOSTS = int(os.environ.get("UPSTREAM_POOL_HOSTS", 32))
+UPSTREAM_POOL_SIZE = int(os.environ.get("UPSTREAM_POOL_SIZE", 64))
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get("UPSTREAM_CONNECT_TIMEOUT", 10))
+UPSTREAM_READ_TIMEOUT = float(os.environ.get("UPSTREAM_READ_TIMEOUT", 30))
+UPSTREAM_DOWNLOAD_READ_TIMEOUT = float(os.environ.get("UPSTREAM_DOWNLOAD_READ_TIMEOUT", 300))
+UPSTREAM_DNS_TTL = float(os.environ.get("UPSTREAM_DNS_TTL", 300))
+
+UPSTREAM_STATS = {"requests": 0, "new_connections": 0, "dns_hits": 0, "dns_misses": 0, "async_requests": 0}
+upstream_stats_lock = threading.Lock()
+
+def _count_upstream(key, amount=1):
+    with upstream_stats_lock:
+        UPSTREAM_STATS[key] += amount
+
+class DNSCache:
+    """Thread-safe TTL cache of resolved upstream addresses"""
+    
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+    
+    def resolve(self, host, port):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get((host, port))
+            if entry and entry[1] > now:
+                _count_upstream("dns_hits")
+                return entry[0]
+        
+        _count_upstream("dns_misses")
+        address = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)[0][4][0]
+        with self.lock:
+            self.entries[(host, port)] = (address, now + self.ttl)
+        return address
+    
+    def forget(self, host, port):
+        with self.lock:
+            self.entries.pop((host, port), None)
+
+dns_cache = DNSCache(ttl=UPSTREAM_DNS_TTL)
+
+class _CachedDNSConnectionMixin:
+    """Connects to the cached address while keeping Host/SNI/cert checks on the name"""
+    
+    def _new_conn(self):
+        extra_kw = {}
+        if self.source_address:
+            extra_kw["source_address"] = self.source_address
+        if self.socket_options:
+            extra_kw["socket_options"] = self.socket_options
+        
+        address = dns_cache.resolve(self.host, self.port)
+        try:
+            conn = create_connection((address, self.port), self.timeout, **extra_kw)
+        except socket.timeout:
+            dns_cache.forget(self.host, self.port)
+            raise ConnectTimeoutError(
+                self, f"Connection to {self.host} timed out. (connect timeout={self.timeout})"
+            )
+        except OSError as e:
+            dns_cache.forget(self.host, self.port)
+            raise NewConnectionError(self, f"Failed to establish a new connection: {e}")
+        
+        _count_upstream("new_connections")
+        return conn
+
+class CachedDNSHTTPConnection(_CachedDNSConnectionMixin, HTTPConnection):
+    pass
+
+class CachedDNSHTTPSConnection(_CachedDNSConnectionMixin, HTTPSConnection):
+    pass
+
+class CachedDNSHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = CachedDNSHTTPConnection
+
+class CachedDNSHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = CachedDNSHTTPSConnection
+
+class UpstreamAdapter(HTTPAdapter):
+    """HTTPAdapter whose per-host pools use cached DNS"""
+    
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": CachedDNSHTTPConnectionPool,
+            "https": CachedDNSHTTPSConnectionPool,
+        }
+
+# One adapter (and so one set of pools) for the whole process; sessions are
+# per-thread because requests.Session itself isn't safe to share
+upstream_adapter = UpstreamAdapter(
+    pool_connections=UPSTREAM_POOL_HOSTS,
+    pool_maxsize=UPSTREAM_POOL_SIZE,
+    pool_block=False,
+)
+upstream_local = threading.local()
+
+def upstream_session():
+    session = getattr(upstream_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        session.mount("http://", upstream_adapter)
+        session.mount("https://", upstream_adapter)
+        upstream_local.session = session
+    return session
+
+def upstream_get(url, headers, read_timeout=None, **kwargs):
+    """Streaming GET to the CDN over the shared keep-alive pools"""
+    _count_upstream("requests")
+    started = time.perf_counter()
+    req = upstream_session().get(
+        url,
+        headers=headers,
+        stream=True,
+        timeout=(UPSTREAM_CONNECT_TIMEOUT, read_timeout or UPSTREAM_READ_TIMEOUT),
+        **kwargs
+    )
+    UPSTREAM_TTFB_SECONDS.observe(time.perf_counter() - started, ("sync",))
+    UPSTREAM_RESPONSES.inc(labels=(str(req.status_code),))
+    return req
+
+def discard_response(req):
+    """Close an unwanted response, draining small bodies so the connection is reused"""
+    try:
+        if int(req.headers.get('Content-Length') or 0) <= 65536:
+            req.content
+    except Exception:
+        pass
+    finally:
+        req.close()
+
+def upstream_stats():
+    with upstream_stats_lock:
+        stats = dict(UPSTREAM_STATS)
+    requests_made = stats["requests"]
+    stats["connection_reuse_rate"] = (
+        round(1 - stats["new_connections"] / requests_made, 4) if requests_made else 0.0
+    )
+    return stats
+
+# Actor results name the share link they were resolved from in one of these fields
+APIFY_ITEM_URL_FIELDS = ("url", "link", "input_url", "original_url", "share_url")
+
+def normalize_terabox_url(url):
+    """Key for matching a share link to actor results - ignores scheme, www. and a trailing slash"""
+    parsed = urlparse(url.strip())
+    host = (parsed.hostname or "").lower()
+    if host.startswith("www."):
+        host = host[4:]
+    return f"{host}{parsed.path.rstrip('/')}?{parsed.query}"
+
+def match_resolved_items(terabox_urls, items):
+    """Pair actor results with the links asked for - ({link: download URL or None}, unmatched).
+    
+    Items are matched by the source link they echo. When no item echoes one and
+    there is an item per link, the dataset order is taken as the input order.
+    `unmatched` counts resolved items that could not be paired with a link.
+    """
+    results = dict.fromkeys(terabox_urls)
+    by_key = {normalize_terabox_url(url): url for url in terabox_urls}
+    sources = [
+        next((item[field] for field in APIFY_ITEM_URL_FIELDS if isinstance(item.get(field), str)), None)
+        for item in items
+    ]
+    resolved = lambda item: bool(item.get("success") and item.get("download_url"))
+    
+    if not any(sources) and len(items) == len(terabox_urls):
+        for url, item in zip(terabox_urls, items):
+            if resolved(item):
+                results[url] = item["download_url"]
+        return results, 0
+    
+    unmatched = 0
+    for item, source in zip(items, sources):
+        if not resolved(item):
+            continue
+        url = by_key.get(normalize_terabox_url(source)) if source else None
+        if url is None and len(terabox_urls) == 1:
+            # A single-link run needs no matching
+            url = terabox_urls[0]
+        if url is None:
+            unmatched += 1
+        elif results[url] is None:
+            results[url] = item["download_url"]
+    return results, unmatched
+
+def resolve_terabox_urls(terabox_urls):
+    """Resolve share links in one Apify actor run - returns {link: download URL or None}.
+    
+    Links left unresolved while the run returned results that couldn't be told
+    apart are resolved again one per run.
+    """
+    terabox_urls = list(terabox_urls)
     run_input = {
-        "links": [terabox_url],
+        "links": terabox_urls,
         "proxyConfiguration": {
             "useApifyProxy": True,
             "apifyProxyGroups": ["RESIDENTIAL"],
         },
     }
     
+    results = dict.fromkeys(terabox_urls)
+    retry = []
+    started = time.perf_counter()
+    failed = "empty"
     try:
         run = client.actor("2EXlXqasdIPsVkOWB").call(run_input=run_input)
-        
-        for item in client.dataset(run["defaultDatasetId"]).iterate_items():
-            if item.get("success") and item.get("download_url"):
-                return item["download_url"]
-        
-        return None
+        items = list(client.dataset(run["defaultDatasetId"]).iterate_items())
+        results, unmatched = match_resolved_items(terabox_urls, items)
+        if unmatched:
+            retry = [url for url, download_url in results.items() if download_url is None]
     except Exception as e:
+        failed = "error"
         print(f"Apify error: {e}")
+    finally:
+        elapsed = time.perf_counter() - started
+        for url, download_url in results.items():
+            if url not in retry:
+                RESOLVE_SECONDS.observe(elapsed, ("ok" if download_url else failed,))
+    
+    if retry:
+        with ThreadPoolExecutor(max_workers=min(BATCH_WORKERS, len(retry))) as pool:
+            for url, resolved in zip(retry, pool.map(lambda url: resolve_terabox_urls([url]), retry)):
+                results[url] = resolved[url]
+    return results
+
+def get_terabox_download_url(terabox_url):
+    """Get download URL from Terabox using Apify"""
+    return resolve_terabox_urls([terabox_url])[terabox_url]
+
+def create_session(download_url, terabox_url=None):
+    """Store a new session for a resolved download URL and return its ID"""
+    session_id = str(uuid.uuid4())[:12]
+    now = time.time()
+    
+    session = {
+        "download_url": download_url,
+        "created": now,
+        "expire": now + 7200,  # 2 hours
+        "status": "ready",
+        "filename": f"video_{session_id}.mp4",
+        # Share link the download URL was resolved from, for refreshing it
+        "terabox_url": terabox_url,
+        "url_issued": now,
+        "url_expire": url_refresher.expiry_for(download_url, now),
+    }
+    
+    if SESSION_MODE == "token":
+        return encode_session_token(session)
+    
+    SESSIONS[session_id] = session
+    return session_id
+
+def session_urls(session_id, base_url):
+    """Build the public URLs for a session"""
+    return {
+        "session_id": session_id,
+        "player_url": f"{base_url}/player/{session_id}",
+        "stream_url": f"{base_url}/stream/{session_id}",
+        "download_endpoint": f"{base_url}/download/{session_id}",
+        "expires_in": 7200,
+    }
+
+# ============= DOWNLOAD URL REFRESH =============
+
+# Terabox download links carry their own signed expiry, shorter than a session.
+# Sessions remember the share link they were resolved from, and a background
+# refresher re-resolves recently active ones shortly before their link expires.
+URL_REFRESH_ENABLED = os.environ.get("URL_REFRESH_ENABLED", "1") == "1"
+URL_REFRESH_INTERVAL = float(os.environ.get("URL_REFRESH_INTERVAL", 30))
+URL_REFRESH_MARGIN = float(os.environ.get("URL_REFRESH_MARGIN", 600))
+URL_REFRESH_ACTIVE_WINDOW = float(os.environ.get("URL_REFRESH_ACTIVE_WINDOW", 1800))
+URL_REFRESH_BATCH = int(os.environ.get("URL_REFRESH_BATCH", 8))
+URL_REFRESH_MAX_TRACKED = int(os.environ.get("URL_REFRESH_MAX_TRACKED", 10000))
+# Assumed lifetime for links whose expiry can't be parsed or learned yet
+URL_DEFAULT_TTL = float(os.environ.get("URL_DEFAULT_TTL", 8 * 3600))
+# Rejections of previously working links a host needs before its learned lifetime is used
+URL_TTL_MIN_SAMPLES = int(os.environ.get("URL_TTL_MIN_SAMPLES", 3))
+# Weight of the newest observation in a host's learned lifetime
+URL_TTL_SMOOTHING = float(os.environ.get("URL_TTL_SMOOTHING", 0.3))
+
+URL_EXPIRED_STATUSES = (403, 410)
+URL_EXPIRY_PARAMS = ("expires", "expire", "x-expires", "exp", "e")
+URL_ISSUED_PARAMS = ("time", "ts", "t", "timestamp")
+
+def _parse_duration(value):
+    """Seconds in "8h", "30m", "1d", "3600s" or "3600" - None if not a duration"""
+    value = value.strip().lower()
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    if value[-1:] in units and value[:-1].isdigit():
+        return int(value[:-1]) * units[value[-1]]
+    if value.isdigit() and int(value) < 10 ** 9:
+        return int(value)
+    return None
+
+def _parse_timestamp(value):
+    """Unix time from a seconds or milliseconds timestamp - None otherwise"""
+    if not value.isdigit() or int(value) < 10 ** 9:
         return None
+    stamp = int(value)
+    return stamp / 1000 if stamp > 10 ** 12 else float(stamp)
+
+def parse_url_expiry(url):
+    """Expiry encoded in a signed URL's query string, or None"""
+    params = {name.lower(): value for name, value in parse_qsl(urlparse(url).query)}
+    
+    if "x-amz-expires" in params and "x-amz-date" in params:
+        try:
+            signed = datetime.strptime(params["x-amz-date"], "%Y%m%dT%H%M%SZ").replace(tzinfo=timezone.utc)
+            return signed.timestamp() + int(params["x-amz-expires"])
+        except ValueError:
+            pass
+    
+    for name in URL_EXPIRY_PARAMS:
+        value = params.get(name)
+        if not value:
+            continue
+        stamp = _parse_timestamp(value)
+        if stamp:
+            return stamp
+        # Terabox style: expires=8h relative to time=<unix>
+        duration = _parse_duration(value)
+        if duration:
+            for issued_name in URL_ISSUED_PARAMS:
+                issued = _parse_timestamp(params.get(issued_name, ""))
+                if issued:
+                    return issued + duration
+    return None
+
+class UrlRefresher:
+    """Keeps download URLs of active sessions fresh.
+    
+    Expiry comes from the URL itself, else from link lifetimes learned per CDN
+    host, else URL_DEFAULT_TTL. A link that served and is later rejected with
+    403/410 is one observation of how long links live; the learned value is a
+    moving average of those, used once a host has URL_TTL_MIN_SAMPLES of them,
+    and raised whenever a link is seen serving past it. Activity is tracked in
+    memory, so only sessions viewed through this worker are refreshed by it.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.activity = OrderedDict()  # session_id -> last access
+        self.links = {}  # download_url -> {"session_id", "issued", "served"}
+        self.learned_ttl = {}  # CDN host -> {"ttl", "samples"}
+        # Refreshed URLs for token sessions, which can't be rewritten in place
+        self.overrides = {}
+        self.in_progress = set()
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="url-refresh")
+        self.stats = {"refreshed": 0, "failed": 0, "rejected_links": 0, "learned_hosts": 0, "runs": 0}
+    
+    def url_expire(self, session):
+        """When a session's current link expires - sessions from before refresh support lack the fields"""
+        if "url_expire" in session:
+            return session["url_expire"]
+        return self.expiry_for(session["download_url"], session.get("url_issued") or session.get("created") or time.time())
+    
+    def expiry_for(self, download_url, issued):
+        expiry = parse_url_expiry(download_url)
+        if expiry:
+            return expiry
+        with self.lock:
+            learned = self.learned_ttl.get(urlparse(download_url).hostname)
+        if learned is None or learned["samples"] < URL_TTL_MIN_SAMPLES:
+            return issued + URL_DEFAULT_TTL
+        return issued + learned["ttl"]
+    
+    def touch(self, session_id, session):
+        with self.lock:
+            self.activity[session_id] = time.time()
+            self.activity.move_to_end(session_id)
+            link = self.links.get(session["download_url"])
+            if link is None or link["session_id"] != session_id:
+                self._track_link(session["download_url"], session_id, session.get("url_issued"))
+            while len(self.activity) > URL_REFRESH_MAX_TRACKED:
+                dropped, _ = self.activity.popitem(last=False)
+                self.overrides.pop(dropped, None)
+            if len(self.links) > 2 * URL_REFRESH_MAX_TRACKED:
+                self.links = {
+                    url: link for url, link in self.links.items() if link["session_id"] in self.activity
+                }
+    
+    def _track_link(self, download_url, session_id, issued):
+        self.links[download_url] = {"session_id": session_id, "issued": issued, "served": False}
+    
+    def apply(self, session_id, session):
+        """Session with any refreshed URL this worker holds for it"""
+        with self.lock:
+            override = self.overrides.get(session_id)
+        if override is None:
+            return session
+        return {**session, **override}
+    
+    def url_served(self, download_url):
+        """The CDN answered a link with content - it is alive at its current age"""
+        with self.lock:
+            link = self.links.get(download_url)
+            if link is None:
+                return
+            link["served"] = True
+            if not link["issued"]:
+                return
+            # A link still serving past the learned lifetime proves it too short
+            learned = self.learned_ttl.get(urlparse(download_url).hostname)
+            age = time.time() - link["issued"]
+            if learned is not None and age > learned["ttl"]:
+                learned["ttl"] = age
+    
+    def url_rejected(self, download_url):
+        """The CDN refused a link - learn its lifetime and refresh its session now"""
+        LINK_REJECTIONS.inc()
+        with self.lock:
+            link = self.links.get(download_url)
+            self.stats["rejected_links"] += 1
+        if link is None:
+            return
+        session = get_session(link["session_id"])
+        if session is None or session["download_url"] != download_url:
+            # Already swapped for a fresh link
+            return
+        
+        # Only a link that worked before says anything about lifetimes - one
+        # refused from the start was blocked, not expired
+        if link["served"] and link["issued"] and not parse_url_expiry(download_url):
+            self.learn_lifetime(urlparse(download_url).hostname, max(60.0, time.time() - link["issued"]))
+        self.schedule(link["session_id"])
+    
+    def learn_lifetime(self, host, lifetime):
+        with self.lock:
+            learned = self.learned_ttl.get(host)
+            if learned is None:
+                self.learned_ttl[host] = {"ttl": lifetime, "samples": 1}
+                return
+            learned["ttl"] += URL_TTL_SMOOTHING * (lifetime - learned["ttl"])
+            learned["samples"] += 1
+            if learned["samples"] == URL_TTL_MIN_SAMPLES:
+                self.stats["learned_hosts"] += 1
+    
+    def schedule(self, session_id):
+        with self.lock:
+            if session_id in self.in_progress:
+                return
+            self.in_progress.add(session_id)
+        self.executor.submit(self._refresh_guarded, session_id)
+    
+    def _refresh_guarded(self, session_id):
+        try:
+            self.refresh(session_id)
+        except Exception as e:
+            print(f"URL refresh error: {e}")
+        finally:
+            with self.lock:
+                self.in_progress.discard(session_id)
+    
+    def refresh(self, session_id, force=True):
+        """Re-resolve a session's download URL and swap it in - returns the new session or None"""
+        session = get_session(session_id)
+        if session is None or not session.get("terabox_url"):
+            return None
+        # Another worker may have refreshed it already
+        if not force and self.url_expire(session) - time.time() > self.margin(session):
+            return session
+        
+        download_url = get_terabox_download_url(session["terabox_url"])
+        if not download_url:
+            with self.lock:
+                self.stats["failed"] += 1
+            return None
+        
+        now = time.time()
+        fresh = {"download_url": download_url, "url_issued": now, "url_expire": self.expiry_for(download_url, now)}
+        if SESSION_MODE == "token":
+            with self.lock:
+                self.overrides[session_id] = fresh
+        else:
+            # A single store write - requests already relaying keep the old link
+            SESSIONS[session_id] = {**SESSIONS.get(session_id, session), **fresh}
+        
+        with self.lock:
+            self._track_link(download_url, session_id, now)
+            self.stats["refreshed"] += 1
+        return {**session, **fresh}
+    
+    def fresh_url(self, session_id, failed_url, timeout=60):
+        """The session's link once it differs from `failed_url` - re-resolving it
+        now unless a refresh is already running, in which case wait for that one"""
+        deadline = time.time() + timeout
+        while True:
+            session = get_session(session_id)
+            if session is None:
+                return None
+            if session["download_url"] != failed_url:
+                return session["download_url"]
+            with self.lock:
+                busy = session_id in self.in_progress
+                if not busy:
+                    self.in_progress.add(session_id)
+            if not busy:
+                try:
+                    session = self.refresh(session_id)
+                finally:
+                    with self.lock:
+                        self.in_progress.discard(session_id)
+                return session["download_url"] if session else None
+            if time.time() >= deadline:
+                return None
+            time.sleep(0.5)
+    
+    def margin(self, session):
+        """How long before expiry to refresh - at most half the link's lifetime,
+        so short-lived links aren't re-resolved on every pass"""
+        issued = session.get("url_issued") or session.get("created") or time.time()
+        return min(URL_REFRESH_MARGIN, (self.url_expire(session) - issued) / 2)
+    
+    def due(self, now):
+        """Recently active sessions whose link expires within the margin, most recent first"""
+        with self.lock:
+            recent = [
+                session_id for session_id, seen in reversed(self.activity.items())
+                if now - seen <= URL_REFRESH_ACTIVE_WINDOW and session_id not in self.in_progress
+            ]
+        
+        due = []
+        for session_id in recent:
+            session = get_session(session_id)
+            if session and session.get("terabox_url") and self.url_expire(session) - now <= self.margin(session):
+                due.append(session_id)
+                if len(due) >= URL_REFRESH_BATCH:
+                    break
+        return due
+    
+    def run(self):
+        while True:
+            time.sleep(URL_REFRESH_INTERVAL)
+            try:
+                for session_id in self.due(time.time()):
+                    with self.lock:
+                        if session_id in self.in_progress:
+                            continue
+                        self.in_progress.add(session_id)
+                    try:
+                        self.refresh(session_id, force=False)
+                    finally:
+                        with self.lock:
+                            self.in_progress.discard(session_id)
+                with self.lock:
+                    self.stats["runs"] += 1
+            except Exception as e:
+                print(f"URL refresher error: {e}")
+    
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["tracked_sessions"] = len(self.activity)
+            stats["learned_ttl"] = {
+                host: {"ttl": round(learned["ttl"]), "samples": learned["samples"]}
+                for host, learned in self.learned_ttl.items()
+            }
+        return stats
+
+url_refresher = UrlRefresher()
+
+if URL_REFRESH_ENABLED:
+    threading.Thread(target=url_refresher.run, name="url-refresher", daemon=True).start()
 
 @app.route("/process", methods=["POST"])
 def process_terabox():
@@ -57,33 +1336,14 @@ def process_terabox():
         
         print(f"Got Terabox URL: {download_url[:100]}...")
         
-        # Create session ID
-        session_id = str(uuid.uuid4())[:12]
-        
-        # Store session
-        SESSIONS[session_id] = {
-            "download_url": download_url,
-            "created": time.time(),
-            "expire": time.time() + 7200,  # 2 hours
-            "status": "ready",
-            "filename": f"video_{session_id}.mp4"
-        }
-        
-        # Create URLs
-        player_url = f"/player/{session_id}"
-        stream_url = f"/stream/{session_id}"
-        download_endpoint = f"/download/{session_id}"
+        session_id = create_session(download_url, terabox_url)
         
         # For production, use the actual host URL
         base_url = request.host_url.rstrip('/')
         
         return jsonify({
             "status": "success",
-            "session_id": session_id,
-            "player_url": f"{base_url}{player_url}",
-            "stream_url": f"{base_url}{stream_url}",
-            "download_endpoint": f"{base_url}{download_endpoint}",
-            "expires_in": 7200,
+            **session_urls(session_id, base_url),
             "message": "Video ready for streaming and download"
         })
         
@@ -91,660 +1351,2816 @@ def process_terabox():
         print(f"Error: {str(e)}")
         return jsonify({"status": "error", "message": str(e)}), 500
 
-@app.route("/stream/<session_id>")
-def stream_video(session_id):
-    """Stream video with proper headers to bypass Terabox protection"""
-    session = SESSIONS.get(session_id)
-    
-    if not session:
-        return "Session expired", 404
-    
-    video_url = session["download_url"]
-    
-    # Terabox requires specific headers
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-        'Referer': 'https://www.terabox.com/',
-        'Accept': 'video/webm,video/ogg,video/*;q=0.9,application/ogg;q=0.7,audio/*;q=0.6,*/*;q=0.5',
-        'Accept-Language': 'en-US,en;q=0.5',
-        'Accept-Encoding': 'gzip, deflate, br',
-        'Range': request.headers.get('Range', 'bytes=0-'),
-        'Origin': 'https://www.terabox.com',
-        'Connection': 'keep-alive',
-        'Sec-Fetch-Dest': 'video',
-        'Sec-Fetch-Mode': 'cors',
-        'Sec-Fetch-Site': 'cross-site',
-        'Pragma': 'no-cache',
-        'Cache-Control': 'no-cache',
+@app.route("/process/batch", methods=["POST"])
+def process_terabox_batch():
+    """Process many Terabox links at once - streams one NDJSON line per URL"""
+    payload = request.get_json(silent=True) or {}
+    urls = payload.get("urls")
+    
+    if not isinstance(urls, list) or not urls:
+        return jsonify({"status": "error", "message": "urls must be a non-empty list"}), 400
+    
+    if len(urls) > BATCH_MAX_URLS:
+        return jsonify({
+            "status": "error",
+            "message": f"Too many URLs (max {BATCH_MAX_URLS})"
+        }), 400
+    
+    base_url = request.host_url.rstrip('/')
+    
+    # Resolve each distinct link once, even if it appears several times in the batch
+    positions = OrderedDict()  # normalized link -> indexes of its occurrences
+    for index, url in enumerate(urls):
+        if isinstance(url, str) and url:
+            positions.setdefault(normalize_terabox_url(url), []).append(index)
+    keys = list(positions)
+    chunks = [keys[i:i + BATCH_RESOLVE_SIZE] for i in range(0, len(keys), BATCH_RESOLVE_SIZE)]
+    
+    def generate():
+        for index, url in enumerate(urls):
+            if not isinstance(url, str) or not url:
+                yield json.dumps({"index": index, "url": url, "status": "error", "message": "URL missing"}) + "\n"
+        
+        if not chunks:
+            return
+        
+        with ThreadPoolExecutor(max_workers=min(BATCH_WORKERS, len(chunks))) as pool:
+            futures = {
+                pool.submit(resolve_terabox_urls, [urls[positions[key][0]] for key in chunk]): chunk
+                for chunk in chunks
+            }
+            
+            for future in as_completed(futures):
+                try:
+                    resolved = future.result()
+                except Exception as e:
+                    resolved = {}
+                    print(f"Batch error: {e}")
+                
+                for key in futures[future]:
+                    download_url = resolved.get(urls[positions[key][0]])
+                    # Every occurrence of the link gets its own session
+                    for index in positions[key]:
+                        url = urls[index]
+                        if not download_url:
+                            yield json.dumps({
+                                "index": index,
+                                "url": url,
+                                "status": "error",
+                                "message": "Failed to get download link"
+                            }) + "\n"
+                            continue
+                        
+                        session_id = create_session(download_url, url)
+                        yield json.dumps({
+                            "index": index,
+                            "url": url,
+                            "status": "success",
+                            **session_urls(session_id, base_url)
+                        }) + "\n"
+    
+    return Response(generate(), mimetype="application/x-ndjson")
+
+# Terabox requires specific headers
+STREAM_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Referer': 'https://www.terabox.com/',
+    'Accept': 'video/webm,video/ogg,video/*;q=0.9,application/ogg;q=0.7,audio/*;q=0.6,*/*;q=0.5',
+    'Accept-Language': 'en-US,en;q=0.5',
+    'Accept-Encoding': 'identity;q=1, *;q=0',  # what browsers send for media ranges
+    'Origin': 'https://www.terabox.com',
+    'Connection': 'keep-alive',
+    'Sec-Fetch-Dest': 'video',
+    'Sec-Fetch-Mode': 'cors',
+    'Sec-Fetch-Site': 'cross-site',
+    'Pragma': 'no-cache',
+    'Cache-Control': 'no-cache',
+}
+
+# Reduced header set Terabox accepts when it rejects the browser-like one
+STREAM_FALLBACK_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+    'Referer': 'https://terabox.com/',
+    'Accept': '*/*',
+}
+
+# Header sets tried in order until the CDN accepts one
+STREAM_HEADER_PROFILES = {
+    "browser": STREAM_HEADERS,
+    "basic": STREAM_FALLBACK_HEADERS,
+}
+HEADER_PROFILE_TTL = float(os.environ.get("HEADER_PROFILE_TTL", 3600))
+
+class HeaderProfileMemory:
+    """Remembers which header profile each upstream host accepts"""
+    
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+        self.preferred = {}
+        self.counts = defaultdict(lambda: {"success": 0, "failure": 0})
+        self.lock = threading.Lock()
+    
+    def order(self, url):
+        """Profile names to try for this URL, known-good first"""
+        host = urlparse(url).hostname
+        names = list(STREAM_HEADER_PROFILES)
+        with self.lock:
+            entry = self.preferred.get(host)
+            if entry and entry[1] > time.time():
+                names.remove(entry[0])
+                names.insert(0, entry[0])
+        return names
+    
+    def record(self, url, profile, ok):
+        host = urlparse(url).hostname
+        with self.lock:
+            self.counts[profile]["success" if ok else "failure"] += 1
+            if ok:
+                self.preferred[host] = (profile, time.time() + self.ttl)
+            elif self.preferred.get(host, (None,))[0] == profile:
+                del self.preferred[host]
+    
+    def stats(self):
+        now = time.time()
+        with self.lock:
+            return {
+                "profiles": {name: dict(counts) for name, counts in self.counts.items()},
+                "hosts": {host: entry[0] for host, entry in self.preferred.items() if entry[1] > now},
+            }
+
+header_profiles = HeaderProfileMemory(ttl=HEADER_PROFILE_TTL)
+
+def profile_rejected(status_code):
+    return status_code == 403 or status_code == 404
+
+DOWNLOAD_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+    'Referer': 'https://www.terabox.com/',
+}
+
+# Upper bounds for relay chunks - the relay adapts below these to the link speed
+STREAM_CHUNK_SIZE = int(os.environ.get("STREAM_CHUNK_SIZE", 1024 * 1024))
+DOWNLOAD_CHUNK_SIZE = int(os.environ.get("DOWNLOAD_CHUNK_SIZE", 4 * 1024 * 1024))
+
+# Upstream headers that must not be relayed to the client as-is
+HOP_BY_HOP_HEADERS = {'transfer-encoding', 'connection', 'content-encoding', 'keep-alive'}
+
+def stream_response_headers(upstream_headers):
+    """Turn upstream response headers into the headers sent to the player"""
+    overridden = HOP_BY_HOP_HEADERS | {
+        'content-type', 'accept-ranges', 'cache-control', 'server', 'date',
+        'access-control-allow-origin', 'access-control-allow-headers',
+        'access-control-allow-methods', 'access-control-expose-headers',
+    }
+    # Upstream casing varies (httpx lower-cases names), so filter case-insensitively
+    response_headers = {
+        name: value for name, value in upstream_headers.items()
+        if name.lower() not in overridden
+    }
+    
+    # Ensure correct content type
+    response_headers['Content-Type'] = upstream_headers.get('Content-Type', 'video/mp4')
+    
+    # Add CORS headers
+    response_headers['Access-Control-Allow-Origin'] = '*'
+    response_headers['Access-Control-Allow-Headers'] = '*'
+    response_headers['Access-Control-Allow-Methods'] = 'GET, HEAD, OPTIONS'
+    response_headers['Access-Control-Expose-Headers'] = 'Content-Length, Content-Range'
+    
+    # Add range support
+    response_headers['Accept-Ranges'] = 'bytes'
+    response_headers['Cache-Control'] = 'no-cache'
+    
+    return response_headers
+
+def content_disposition(filename):
+    """Attachment header with a plain ASCII name and the exact one per RFC 5987"""
+    fallback = "".join(c if 32 <= ord(c) < 127 and c not in '"\\' else "_" for c in filename)
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(filename, safe='')}"
+
+def download_response_headers(filename, file_size):
+    """Headers for an attachment download"""
+    return {
+        'Content-Type': 'video/mp4',
+        'Content-Disposition': content_disposition(filename),
+        'Content-Length': str(file_size) if file_size > 0 else '',
+        'Accept-Ranges': 'bytes',
+        'Cache-Control': 'no-cache',
+        'Connection': 'keep-alive'
+    }
+
+def script_string(value):
+    """JavaScript string literal that is also safe inside an inline <script>"""
+    return json.dumps(value).replace("<", "\\u003c").replace(">", "\\u003e").replace("&", "\\u0026")
+
+def download_fallback_html(video_url):
+    """Simple HTML page with direct link when proxying the download fails"""
+    attribute_url = html.escape(video_url)
+    return f'''
+        <!DOCTYPE html>
+        <html>
+        <head>
+            <meta charset="UTF-8">
+            <title>Download Video</title>
+            <meta http-equiv="refresh" content="0; url={attribute_url}">
+            <script>
+                window.location.href = {script_string(video_url)};
+            </script>
+        </head>
+        <body>
+            <p>If download doesn't start automatically, <a href="{attribute_url}" download>click here</a></p>
+        </body>
+        </html>
+        '''
+
+# ============= RANGE HANDLING (RFC 7233) =============
+
+RESOURCE_INFO_SIZE = int(os.environ.get("RESOURCE_INFO_SIZE", 4096))
+
+class ResourceInfoCache:
+    """Size and validators learned from the CDN, keyed by download URL"""
+    
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+    
+    def get(self, url):
+        with self.lock:
+            info = self.entries.get(url)
+            if info is not None:
+                self.entries.move_to_end(url)
+            return info
+    
+    def set(self, url, info):
+        with self.lock:
+            self.entries[url] = info
+            self.entries.move_to_end(url)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+resource_info = ResourceInfoCache(maxsize=RESOURCE_INFO_SIZE)
+
+# Query parameters that change when Terabox re-signs a link to the same file
+URL_SIGNING_PARAMS = frozenset(URL_EXPIRY_PARAMS + URL_ISSUED_PARAMS + (
+    "sign", "signature", "dstime", "dp-logid", "r",
+    "x-amz-date", "x-amz-expires", "x-amz-signature", "x-amz-security-token", "x-amz-credential",
+))
+
+def resource_key(url, info=None):
+    """Identity of the file behind a download URL, for the segment cache and shared fetches.
+    
+    Host, path and every query parameter except the signing ones, plus the size
+    and validator the CDN reported - so re-signed links to one file share a key,
+    while different files behind a generic path, another host or a changed file
+    never do. `info` defaults to what was learned for `url`.
+    """
+    if info is None:
+        info = resource_info.get(url) or {}
+    parsed = urlparse(url)
+    params = sorted(
+        (name, value) for name, value in parse_qsl(parsed.query, keep_blank_values=True)
+        if name.lower() not in URL_SIGNING_PARAMS
+    )
+    identity = json.dumps([
+        (parsed.hostname or "").lower(), parsed.path, params,
+        info.get("size"), info.get("etag") or info.get("last_modified"),
+    ])
+    return hashlib.sha1(identity.encode()).hexdigest()
+
+def parse_byte_range(value):
+    """Parse a single `bytes=` range into (first, last) - first is None for suffix ranges.
+    
+    Returns None when there is nothing to honour: no header, another unit, a
+    malformed spec or a multi-range request (all of which RFC 7233 lets us ignore).
+    """
+    if not value:
+        return None
+    
+    unit, _, spec = value.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    
+    first, sep, last = spec.strip().partition("-")
+    if not sep:
+        return None
+    
+    try:
+        if not first:
+            return (None, int(last)) if last else None
+        first = int(first)
+        last = int(last) if last else None
+    except ValueError:
+        return None
+    
+    if first < 0 or (last is not None and last < first):
+        return None
+    return (first, last)
+
+def format_byte_range(byte_range):
+    first, last = byte_range
+    if first is None:
+        return f"bytes=-{last}"
+    return f"bytes={first}-{'' if last is None else last}"
+
+def resolve_byte_range(byte_range, size):
+    """Concrete (start, end) of a parsed range for a known size, or None if unsatisfiable"""
+    first, last = byte_range
+    if first is None:
+        if last == 0 or size == 0:
+            return None
+        return (max(0, size - last), size - 1)
+    if first >= size:
+        return None
+    return (first, size - 1 if last is None or last >= size else last)
+
+def if_range_matches(if_range, info):
+    """Whether an If-Range validator still matches the representation"""
+    if if_range.startswith('W/'):
+        return False
+    if if_range.startswith('"'):
+        etag = info.get("etag")
+        return bool(etag) and not etag.startswith('W/') and etag == if_range
+    return bool(info.get("last_modified")) and info["last_modified"] == if_range
+
+def learn_resource_info(url, status, headers):
+    """Record size/validators from an upstream response; returns the best known info"""
+    size = None
+    content_range = headers.get('Content-Range', '')
+    total = content_range.rsplit('/', 1)[-1] if '/' in content_range else ''
+    if total.isdigit():
+        size = int(total)
+    elif status == 200 and not headers.get('Content-Encoding'):
+        length = headers.get('Content-Length', '')
+        size = int(length) if length.isdigit() else None
+    
+    if size is None:
+        return resource_info.get(url)
+    
+    info = {
+        "size": size,
+        "etag": headers.get('ETag'),
+        "last_modified": headers.get('Last-Modified'),
+        "content_type": headers.get('Content-Type', 'video/mp4'),
+    }
+    resource_info.set(url, info)
+    return info
+
+def upstream_range_start(status, headers):
+    """First byte offset of an upstream response body"""
+    if status != 206:
+        return 0
+    spec = headers.get('Content-Range', '').partition(' ')[2].partition('/')[0]
+    return int(spec.partition('-')[0]) if spec.partition('-')[0].isdigit() else 0
+
+def plan_client_range(range_header, if_range, info):
+    """Decide what to ask the CDN for before contacting it.
+    
+    Returns (byte_range, window, upstream_range): `window` is the (status, start,
+    end) to serve when the size is already known, "unsatisfiable" for a 416, or
+    None when only the upstream response can tell. Callers probe the resource
+    first when If-Range is present, so it is always evaluated here.
+    """
+    byte_range = parse_byte_range(range_header)
+    
+    if info is None:
+        # Let the CDN resolve suffix/open-ended ranges for us
+        upstream_range = format_byte_range(byte_range) if byte_range else 'bytes=0-'
+        return byte_range, None, upstream_range
+    
+    if byte_range and if_range and not if_range_matches(if_range, info):
+        byte_range = None
+    
+    window = plan_window(byte_range, info["size"])
+    if window is None:
+        return byte_range, "unsatisfiable", None
+    
+    _, start, end = window
+    upstream_range = f"bytes={start}-{end}" if end >= start else 'bytes=0-'
+    return byte_range, window, upstream_range
+
+def plan_window(byte_range, size):
+    """(status, start, end) to send for a range against a known size, None for 416"""
+    if byte_range is None:
+        return (200, 0, size - 1)
+    resolved = resolve_byte_range(byte_range, size)
+    if resolved is None:
+        return None
+    return (206,) + resolved
+
+def plan_upstream_response(video_url, byte_range, upstream_status, upstream_headers):
+    """Map an upstream response onto what the client asked for.
+    
+    Returns ("relay", (status, start, end, skip, info)), ("unsatisfiable", size)
+    or ("passthrough", None) when the size can't be determined.
+    """
+    info = learn_resource_info(video_url, upstream_status, upstream_headers)
+    
+    if upstream_status == 416:
+        return "unsatisfiable", info["size"] if info else None
+    if upstream_status >= 400 or info is None:
+        return "passthrough", None
+    
+    window = plan_window(byte_range, info["size"])
+    if window is None:
+        return "unsatisfiable", info["size"]
+    
+    status, start, end = window
+    skip = start - upstream_range_start(upstream_status, upstream_headers)
+    if skip < 0:
+        raise ValueError("Upstream returned a range starting after the requested offset")
+    return "relay", (status, start, end, skip, info)
+
+def range_response_headers(mode, status, start, end, info, upstream_headers=None, filename=None):
+    """Client headers for a (possibly partial) response"""
+    if mode == "stream":
+        headers = stream_response_headers(upstream_headers or {'Content-Type': info["content_type"]})
+        for name in list(headers):
+            if name.lower() in ('content-length', 'content-range', 'etag', 'last-modified'):
+                headers.pop(name)
+    else:
+        headers = download_response_headers(filename, end - start + 1)
+    
+    headers['Content-Length'] = str(end - start + 1)
+    if status == 206:
+        headers['Content-Range'] = f"bytes {start}-{end}/{info['size']}"
+    if info.get("etag"):
+        headers['ETag'] = info["etag"]
+    if info.get("last_modified"):
+        headers['Last-Modified'] = info["last_modified"]
+    return headers
+
+def unsatisfiable_headers(size):
+    headers = {'Accept-Ranges': 'bytes', 'Access-Control-Allow-Origin': '*'}
+    if size is not None:
+        headers['Content-Range'] = f"bytes */{size}"
+    return headers
+
+# ============= ADAPTIVE RELAY BUFFERS =============
+
+# Relay chunks grow towards the max on fast links and shrink on slow ones,
+# aiming for RELAY_TARGET_SECONDS of data per chunk
+RELAY_MIN_CHUNK_SIZE = int(os.environ.get("RELAY_MIN_CHUNK_SIZE", 64 * 1024))
+RELAY_INITIAL_CHUNK_SIZE = int(os.environ.get("RELAY_INITIAL_CHUNK_SIZE", 256 * 1024))
+RELAY_TARGET_SECONDS = float(os.environ.get("RELAY_TARGET_SECONDS", 0.1))
+
+class RelayChunkSizer:
+    """Picks the next chunk size from measured upstream + client throughput"""
+    
+    GRANULARITY = 16 * 1024
+    
+    def __init__(self, max_size):
+        self.min_size = RELAY_MIN_CHUNK_SIZE
+        self.max_size = max(max_size, self.min_size)
+        self.size = min(max(RELAY_INITIAL_CHUNK_SIZE, self.min_size), self.max_size)
+        self.rate = None
+    
+    def observe(self, nbytes, seconds):
+        """Record one chunk's round trip: upstream read plus client write"""
+        if seconds <= 0:
+            return
+        rate = nbytes / seconds
+        self.rate = rate if self.rate is None else 0.7 * self.rate + 0.3 * rate
+        target = int(self.rate * RELAY_TARGET_SECONDS) // self.GRANULARITY * self.GRANULARITY
+        self.size = min(max(target, self.min_size), self.max_size)
+
+class RelayMemory:
+    """Tracks buffer bytes held for streams - live total, totals per kind and
+    per-stream peaks of the client relays.
+    
+    Kinds: "relay" (the buffer each client relay sends from), "parallel"
+    (reorder pieces of an accelerated download), "fanout" (a shared fetch's
+    retained window), "segment" (a segment being filled for the cache) and
+    "readahead" (a segment being prefetched).
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active_streams = 0
+        self.active_bytes = 0
+        self.kind_bytes = defaultdict(int)
+        self.completed_streams = 0
+        self.peak_total = 0
+        self.peak_max = 0
+    
+    def open(self, kind="relay"):
+        with self.lock:
+            if kind == "relay":
+                self.active_streams += 1
+        return {"kind": kind, "bytes": 0, "peak": 0, "closed": False}
+    
+    def resize(self, stream, nbytes):
+        with self.lock:
+            if stream["closed"]:
+                return
+            self.active_bytes += nbytes - stream["bytes"]
+            self.kind_bytes[stream["kind"]] += nbytes - stream["bytes"]
+            stream["bytes"] = nbytes
+            stream["peak"] = max(stream["peak"], nbytes)
+    
+    def close(self, stream):
+        with self.lock:
+            if stream["closed"]:
+                return
+            stream["closed"] = True
+            self.active_bytes -= stream["bytes"]
+            self.kind_bytes[stream["kind"]] -= stream["bytes"]
+            stream["bytes"] = 0
+            if stream["kind"] == "relay":
+                self.active_streams -= 1
+                self.completed_streams += 1
+                self.peak_total += stream["peak"]
+                self.peak_max = max(self.peak_max, stream["peak"])
+    
+    def bytes_by_kind(self):
+        with self.lock:
+            return {kind: nbytes for kind, nbytes in self.kind_bytes.items()}
+    
+    def snapshot(self):
+        with self.lock:
+            return {
+                "active_streams": self.active_streams,
+                "active_buffer_bytes": self.active_bytes,
+                "buffer_bytes_by_kind": dict(self.kind_bytes),
+                "completed_streams": self.completed_streams,
+                "max_stream_peak_bytes": self.peak_max,
+                "avg_stream_peak_bytes": (
+                    self.peak_total // self.completed_streams if self.completed_streams else 0
+                ),
+            }
+
+relay_memory = RelayMemory()
+
+def upstream_readinto(req):
+    """readinto() of the raw upstream body, or None if it has to be decoded first"""
+    if req.headers.get('Content-Encoding', 'identity').lower() not in ('', 'identity'):
+        return None
+    # urllib3 keeps the http.client response in _fp; reading it directly avoids
+    # the intermediate bytes objects urllib3/requests create per read
+    fp = getattr(req.raw, '_fp', None)
+    return getattr(fp, 'readinto', None)
+
+def relay_chunks(req, chunk_size, skip=0, length=None):
+    """Yield upstream bytes, dropping `skip` leading bytes and stopping after `length`.
+    
+    `chunk_size` is the upper bound; the actual size adapts to throughput. Reads
+    go into one reused buffer per stream - WSGI servers only accept bytes, so
+    each yielded chunk is still a single copy of what was read.
+    """
+    readinto = upstream_readinto(req)
+    if readinto is None:
+        yield from _relay_decoded_chunks(req, chunk_size, skip, length)
+        return
+    
+    sizer = RelayChunkSizer(chunk_size)
+    stream = relay_memory.open()
+    buffer = bytearray()
+    try:
+        while length is None or length > 0:
+            # Never more than the range still needs, so a short tail gets a short buffer
+            size = sizer.size if length is None else min(sizer.size, skip + length)
+            # Reallocate only when the chunk size grew, or shrank well below the buffer
+            if not size <= len(buffer) <= 2 * size:
+                buffer = bytearray(size)
+            
+            want = min(size, skip) if skip else size
+            # The buffer, plus the copy handed to the server unless skipping
+            relay_memory.resize(stream, len(buffer) + (0 if skip else want))
+            
+            started = time.perf_counter()
+            with memoryview(buffer) as view:
+                n = readinto(view[:want])
+                if not n:
+                    break
+                UPSTREAM_READ_BYTES.inc(n)
+                if skip:
+                    skip -= n
+                    continue
+                data = bytes(view[:n])
+            
+            if length is not None:
+                length -= n
+            yield data
+            # Time to the next resume includes the server writing `data` to the client
+            sizer.observe(n, time.perf_counter() - started)
+    finally:
+        relay_memory.close(stream)
+        if req.raw._fp.isclosed():
+            # Body read to the end behind urllib3's back - return the connection
+            # to the pool ourselves, or close() would drop it
+            req.raw.release_conn()
+        req.close()
+
+def _relay_decoded_chunks(req, chunk_size, skip=0, length=None):
+    """relay_chunks for content-encoded bodies, which requests has to decode"""
+    stream = relay_memory.open()
+    if length is not None:
+        chunk_size = max(1, min(chunk_size, skip + length))
+    relay_memory.resize(stream, chunk_size)
+    try:
+        for chunk in req.iter_content(chunk_size=chunk_size):
+            UPSTREAM_READ_BYTES.inc(len(chunk))
+            if skip:
+                if len(chunk) <= skip:
+                    skip -= len(chunk)
+                    continue
+                chunk = chunk[skip:]
+                skip = 0
+            if length is not None:
+                if len(chunk) >= length:
+                    yield chunk[:length]
+                    return
+                length -= len(chunk)
+            if chunk:
+                yield chunk
+    finally:
+        relay_memory.close(stream)
+        req.close()
+
+# ============= STREAM ADMISSION CONTROL =============
+
+# Limits for the whole proxy on this host. A request over any limit gets 503 +
+# Retry-After instead of queueing behind the streams already running; 0 turns a
+# limit off.
+#   STREAM_MAX_ACTIVE        concurrent /stream and /download relays (default: no limit)
+#   STREAM_MAX_BUFFER_BYTES  relay buffers of every kind, see RelayMemory (default 512 MB)
+#   STREAM_MAX_EGRESS_BPS    bytes per second sent to clients (default: no limit)
+# Like the metrics, each worker publishes its usage to STREAM_BUDGET_DIR every
+# STREAM_BUDGET_SYNC_INTERVAL and counts the other workers' last published
+# usage against the limits, so a burst spread over several workers can overshoot
+# by what they admit within one interval. STREAM_BUDGET_SCOPE=worker applies
+# the limits to each worker on its own instead.
+STREAM_MAX_ACTIVE = int(os.environ.get("STREAM_MAX_ACTIVE", 0))
+STREAM_MAX_BUFFER_BYTES = int(os.environ.get("STREAM_MAX_BUFFER_BYTES", 512 * 1024 * 1024))
+STREAM_MAX_EGRESS_BPS = int(os.environ.get("STREAM_MAX_EGRESS_BPS", 0))
+STREAM_RETRY_AFTER = int(os.environ.get("STREAM_RETRY_AFTER", 5))
+STREAM_BUDGET_SCOPE = os.environ.get("STREAM_BUDGET_SCOPE", "proxy")
+STREAM_BUDGET_DIR = os.environ.get(
+    "STREAM_BUDGET_DIR", os.path.join(tempfile.gettempdir(), "terabox_stream_budget")
+)
+STREAM_BUDGET_SYNC_INTERVAL = float(os.environ.get("STREAM_BUDGET_SYNC_INTERVAL", 1))
+
+class StreamBudget:
+    """Admission control for /stream and /download plus a shared egress token bucket.
+    
+    With a `shared_dir`, usage published there by other workers counts against
+    the limits too, and this worker's bucket refills at its share of the egress
+    limit in proportion to the streams it is running.
+    """
+    
+    def __init__(self, max_active, max_buffer_bytes, max_egress_bps, shared_dir=None):
+        self.lock = threading.Lock()
+        self.max_active = max_active
+        self.max_buffer_bytes = max_buffer_bytes
+        self.max_egress_bps = max_egress_bps
+        self.shared_dir = shared_dir
+        self.peers = {"workers": 0, "active": 0, "buffer_bytes": 0, "egress_bps": 0.0}
+        self.active = 0
+        self.admitted = 0
+        self.rejected = defaultdict(int)
+        now = time.monotonic()
+        # Token bucket holding at most one second of egress
+        self.tokens = float(max_egress_bps)
+        self.refilled = now
+        # Measured egress, rolled over roughly once a second
+        self.window_start = now
+        self.window_bytes = 0
+        self.egress_bps = 0.0
+    
+    def _roll(self, now):
+        elapsed = now - self.window_start
+        if elapsed >= 1:
+            self.egress_bps = self.window_bytes / elapsed
+            self.window_start = now
+            self.window_bytes = 0
+    
+    def buffer_bytes(self):
+        """Buffered bytes counted against the memory limit"""
+        return relay_memory.active_bytes + self.peers["buffer_bytes"]
+    
+    def admit(self):
+        """Take a stream slot - returns the name of the exhausted limit, or None"""
+        with self.lock:
+            self._roll(time.monotonic())
+            active = self.active + self.peers["active"]
+            if self.max_active and active >= self.max_active:
+                reason = "streams"
+            elif self.max_buffer_bytes and self.buffer_bytes() >= self.max_buffer_bytes:
+                reason = "memory"
+            elif (
+                self.max_egress_bps and active
+                and self.egress_bps + self.peers["egress_bps"] >= 0.95 * self.max_egress_bps
+            ):
+                reason = "bandwidth"
+            else:
+                self.active += 1
+                self.admitted += 1
+                return None
+            self.rejected[reason] += 1
+            return reason
+    
+    def release(self):
+        with self.lock:
+            self.active -= 1
+    
+    def charge(self, nbytes, paced=True):
+        """Account `nbytes` of egress - returns how long the sender should wait"""
+        with self.lock:
+            now = time.monotonic()
+            self._roll(now)
+            self.window_bytes += nbytes
+            if not (paced and self.max_egress_bps):
+                return 0
+            rate = self._egress_share()
+            self.tokens = min(self.tokens + (now - self.refilled) * rate, rate)
+            self.refilled = now
+            self.tokens -= nbytes
+            return -self.tokens / rate if self.tokens < 0 else 0
+    
+    def _egress_share(self):
+        # Called with the lock held
+        total = self.active + self.peers["active"]
+        if not total or not self.peers["active"]:
+            return float(self.max_egress_bps)
+        return self.max_egress_bps * max(self.active, 1) / total
+    
+    def sync(self):
+        """Publish this worker's usage to the shared directory and read everyone else's"""
+        with self.lock:
+            self._roll(time.monotonic())
+            usage = {"active": self.active, "buffer_bytes": relay_memory.active_bytes, "egress_bps": self.egress_bps}
+        
+        os.makedirs(self.shared_dir, exist_ok=True)
+        own_name = f"{os.getpid()}.json"
+        path = os.path.join(self.shared_dir, own_name)
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(usage, f)
+        os.replace(f"{path}.tmp", path)
+        
+        peers = {"workers": 0, "active": 0, "buffer_bytes": 0, "egress_bps": 0.0}
+        now = time.time()
+        for name in os.listdir(self.shared_dir):
+            if not name.endswith(".json") or name == own_name:
+                continue
+            peer_path = os.path.join(self.shared_dir, name)
+            try:
+                age = now - os.path.getmtime(peer_path)
+                if age > 3 * STREAM_BUDGET_SYNC_INTERVAL:
+                    # That worker has exited (or hung) - its streams are gone either way
+                    if age > METRICS_RETENTION:
+                        os.remove(peer_path)
+                    continue
+                with open(peer_path) as f:
+                    peer = json.load(f)
+            except (OSError, ValueError):
+                continue
+            peers["workers"] += 1
+            for key in ("active", "buffer_bytes", "egress_bps"):
+                peers[key] += peer.get(key, 0)
+        
+        with self.lock:
+            self.peers = peers
+    
+    def run_sync(self):
+        while True:
+            time.sleep(STREAM_BUDGET_SYNC_INTERVAL)
+            try:
+                self.sync()
+            except Exception as e:
+                print(f"Stream budget sync error: {e}")
+    
+    def snapshot(self):
+        with self.lock:
+            self._roll(time.monotonic())
+            peers = dict(self.peers)
+            active = self.active + peers["active"]
+            buffered = self.buffer_bytes()
+            egress = self.egress_bps + peers["egress_bps"]
+            return {
+                "scope": "proxy" if self.shared_dir else "worker",
+                "workers": peers["workers"] + 1,
+                "active_streams": active,
+                "max_streams": self.max_active or None,
+                "buffer_bytes": buffered,
+                "max_buffer_bytes": self.max_buffer_bytes or None,
+                "egress_bps": round(egress),
+                "max_egress_bps": self.max_egress_bps or None,
+                "utilisation": {
+                    "streams": round(active / self.max_active, 3) if self.max_active else None,
+                    "memory": round(buffered / self.max_buffer_bytes, 3) if self.max_buffer_bytes else None,
+                    "bandwidth": (
+                        round(egress / self.max_egress_bps, 3) if self.max_egress_bps else None
+                    ),
+                },
+                "this_worker": {
+                    "active_streams": self.active,
+                    "buffer_bytes": relay_memory.active_bytes,
+                    "egress_bps": round(self.egress_bps),
+                },
+                "admitted": self.admitted,
+                "rejected": dict(self.rejected),
+            }
+
+stream_budget = StreamBudget(
+    STREAM_MAX_ACTIVE, STREAM_MAX_BUFFER_BYTES, STREAM_MAX_EGRESS_BPS,
+    shared_dir=STREAM_BUDGET_DIR if STREAM_BUDGET_SCOPE == "proxy" else None,
+)
+
+if stream_budget.shared_dir:
+    threading.Thread(target=stream_budget.run_sync, name="stream-budget-sync", daemon=True).start()
+
+def over_budget_response(reason):
+    return Response(
+        f"Server busy ({reason}), retry shortly",
+        status=503,
+        mimetype='text/plain',
+        headers={'Retry-After': str(STREAM_RETRY_AFTER), 'Cache-Control': 'no-store'}
+    )
+
+class BudgetedBody:
+    """WSGI body that paces chunks through the egress budget and frees the
+    stream slot when the server closes it"""
+    
+    def __init__(self, chunks, mode):
+        self.chunks = chunks
+        self.labels = (mode,)
+        self.released = False
+    
+    def __iter__(self):
+        for chunk in self.chunks:
+            delay = stream_budget.charge(len(chunk))
+            if delay:
+                time.sleep(delay)
+            RELAYED_BYTES.inc(len(chunk), self.labels)
+            yield chunk
+    
+    def close(self):
+        if not self.released:
+            self.released = True
+            stream_budget.release()
+        close = getattr(self.chunks, 'close', None)
+        if close:
+            close()
+
+class BudgetedFile:
+    """File handed to wsgi.file_wrapper that frees the stream slot on close.
+    
+    sendfile can't be paced, so its bytes are charged up front instead.
+    """
+    
+    def __init__(self, f):
+        self.f = f
+        self.released = False
+    
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+    
+    def close(self):
+        if not self.released:
+            self.released = True
+            stream_budget.release()
+        self.f.close()
+
+def attach_stream_budget(response, mode):
+    """Tie an admitted stream slot to the lifetime of `response`'s body"""
+    body = response.response
+    if isinstance(body, (list, tuple)):
+        # HEAD, 416 and other bodiless answers are done already
+        stream_budget.release()
+        return response
+    
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    filelike = getattr(body, 'filelike', None)
+    if file_wrapper is not None and filelike is not None:
+        stream_budget.charge(response.content_length or 0, paced=False)
+        RELAYED_BYTES.inc(response.content_length or 0, (mode,))
+        response.response = file_wrapper(BudgetedFile(filelike), getattr(body, 'blksize', SENDFILE_BLOCK_SIZE))
+    else:
+        response.response = BudgetedBody(body, mode)
+    return response
+
+def open_stream_upstream(video_url, range_value):
+    """GET from the CDN with the stream header profiles, known-good profile first"""
+    profiles = header_profiles.order(video_url)
+    for attempt, profile in enumerate(profiles, 1):
+        req = upstream_get(video_url, {**STREAM_HEADER_PROFILES[profile], 'Range': range_value})
+        rejected = profile_rejected(req.status_code)
+        header_profiles.record(video_url, profile, not rejected)
+        if not rejected or attempt == len(profiles):
+            if req.status_code in URL_EXPIRED_STATUSES:
+                url_refresher.url_rejected(video_url)
+            elif req.status_code < 300:
+                url_refresher.url_served(video_url)
+            return req
+        HEADER_FALLBACKS.inc(labels=(str(req.status_code),))
+        discard_response(req)
+
+def open_download_upstream(video_url, range_value):
+    req = upstream_get(
+        video_url,
+        {**DOWNLOAD_HEADERS, 'Range': range_value},
+        read_timeout=UPSTREAM_DOWNLOAD_READ_TIMEOUT
+    )
+    if req.status_code in URL_EXPIRED_STATUSES:
+        url_refresher.url_rejected(video_url)
+    elif req.status_code < 300:
+        url_refresher.url_served(video_url)
+    return req
+
+def probe_resource_info(video_url):
+    """Learn size/validators with a one-byte request - cheaper than a full GET"""
+    req = open_stream_upstream(video_url, 'bytes=0-0')
+    try:
+        return learn_resource_info(video_url, req.status_code, req.headers)
+    finally:
+        discard_response(req)
+
+# ============= SEGMENT CACHE =============
+
+# Fixed-size byte ranges of popular videos kept on local disk
+SEGMENT_CACHE_ENABLED = os.environ.get("SEGMENT_CACHE_ENABLED", "1") == "1"
+SEGMENT_CACHE_DIR = os.environ.get(
+    "SEGMENT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "terabox_stream_cache")
+)
+SEGMENT_SIZE = int(os.environ.get("SEGMENT_SIZE", 4 * 1024 * 1024))
+SEGMENT_CACHE_BYTES = int(os.environ.get("SEGMENT_CACHE_BYTES", 2 * 1024 ** 3))
+
+class SegmentCache:
+    """Disk-backed LRU of video segments with a byte budget.
+    
+    Segments are keyed by resource_key(), which stays the same when Terabox
+    re-signs a link, so refreshed links keep their cache. Workers share the
+    directory: each keeps its own LRU index, adopts segments written by other
+    workers and treats one evicted elsewhere as a miss.
+    """
+    
+    def __init__(self, directory, segment_size, budget):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.budget = budget
+        self.index = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.stats = {
+            "hits": 0, "misses": 0, "bytes_from_cache": 0,
+            "evictions": 0, "sendfile_responses": 0,
+        }
+        
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+    
+    def _load_index(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            name, _, seg = entry.name.rpartition(".")
+            if name and seg.isdigit():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, (name, int(seg)), stat.st_size))
+        
+        for _, key, size in sorted(entries):
+            self.index[key] = size
+            self.total_bytes += size
+        self._evict()
+    
+    def path(self, key, seg):
+        return os.path.join(self.directory, f"{key}.{seg}")
+    
+    def segment_length(self, seg, size):
+        return min(self.segment_size, size - seg * self.segment_size)
+    
+    def _adopt(self, key, seg):
+        """Index a segment another worker wrote to the shared directory"""
+        try:
+            size = os.stat(self.path(key, seg)).st_size
+        except OSError:
+            return False
+        with self.lock:
+            if (key, seg) not in self.index:
+                self.index[(key, seg)] = size
+                self.total_bytes += size
+        return True
+    
+    def contains(self, key, seg):
+        with self.lock:
+            if (key, seg) in self.index:
+                return True
+        return self._adopt(key, seg)
+    
+    def lookup(self, key, seg):
+        """Path of a cached segment (touching it in the LRU), or None"""
+        with self.lock:
+            known = (key, seg) in self.index
+        if not known and not self._adopt(key, seg):
+            self.count("misses", 1)
+            return None
+        
+        with self.lock:
+            if (key, seg) in self.index:
+                self.index.move_to_end((key, seg))
+            self.stats["hits"] += 1
+        return self.path(key, seg)
+    
+    def forget(self, key, seg):
+        with self.lock:
+            size = self.index.pop((key, seg), None)
+            if size is not None:
+                self.total_bytes -= size
+    
+    def put(self, key, seg, data):
+        path = self.path(key, seg)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Segment cache write error: {e}")
+            return
+        
+        with self.lock:
+            previous = self.index.pop((key, seg), None)
+            if previous is not None:
+                self.total_bytes -= previous
+            self.index[(key, seg)] = len(data)
+            self.total_bytes += len(data)
+            self._evict()
+    
+    def _evict(self):
+        while self.total_bytes > self.budget and self.index:
+            (key, seg), size = self.index.popitem(last=False)
+            self.total_bytes -= size
+            self.stats["evictions"] += 1
+            try:
+                os.remove(self.path(key, seg))
+            except OSError:
+                pass
+    
+    def count(self, stat, amount):
+        with self.lock:
+            self.stats[stat] += amount
+    
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["segments"] = len(self.index)
+            stats["bytes_cached"] = self.total_bytes
+            stats["budget_bytes"] = self.budget
+        # Counted where bytes come off the socket, so a read shared by several
+        # viewers (or filling a read-ahead segment) counts once
+        stats["bytes_from_upstream"] = UPSTREAM_READ_BYTES.total()
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        return stats
+
+segment_cache = SegmentCache(SEGMENT_CACHE_DIR, SEGMENT_SIZE, SEGMENT_CACHE_BYTES) if SEGMENT_CACHE_ENABLED else None
+
+def plan_segments(key, start, end, size, max_run=None):
+    """Split [start, end] into cached segments and runs of missing ones.
+    
+    Yields ("hit", seg, path) or ("miss", first_seg, last_seg, fetch_start, fetch_end);
+    misses are widened to whole segments so every fetched byte can be cached.
+    A segment read-ahead is still fetching yields ("wait", seg, future) - the
+    caller waits on the future and the segment is planned again.
+    """
+    seg_size = segment_cache.segment_size
+    seg, last_seg = start // seg_size, end // seg_size
+    waited = None
+    
+    while seg <= last_seg:
+        future = read_ahead.pending(key, seg) if read_ahead is not None and seg != waited else None
+        if future is not None:
+            waited = seg
+            yield ("wait", seg, future)
+            continue
+        
+        path = segment_cache.lookup(key, seg)
+        if path is not None:
+            yield ("hit", seg, path)
+            seg += 1
+            continue
+        
+        run_end = seg
+        while (
+            run_end < last_seg
+            and (max_run is None or run_end - seg + 1 < max_run)
+            and not segment_cache.contains(key, run_end + 1)
+            and not (read_ahead is not None and read_ahead.pending(key, run_end + 1))
+        ):
+            run_end += 1
+        fetch_end = min(size, (run_end + 1) * seg_size) - 1
+        yield ("miss", seg, run_end, seg * seg_size, fetch_end)
+        seg = run_end + 1
+
+def cached_slice(seg, start, end, size):
+    """Offsets within segment `seg` that fall inside the client's [start, end]"""
+    seg_start = seg * segment_cache.segment_size
+    lo = max(start, seg_start) - seg_start
+    hi = min(end, seg_start + segment_cache.segment_length(seg, size) - 1) - seg_start
+    return lo, hi
+
+class SegmentFill:
+    """Cuts an upstream run into cache segments and the client's slice of it"""
+    
+    def __init__(self, key, first_seg, fetch_start, start, end, size):
+        self.key = key
+        self.seg = first_seg
+        self.pos = fetch_start
+        self.start = start
+        self.end = end
+        self.size = size
+        self.buffer = bytearray()
+        self.memory = relay_memory.open("segment")
+    
+    def feed(self, chunk):
+        """Take an upstream chunk; returns the bytes to send to the client"""
+        lo = max(self.pos, self.start)
+        hi = min(self.pos + len(chunk) - 1, self.end)
+        out = chunk[lo - self.pos:hi - self.pos + 1] if lo <= hi else b""
+        
+        self.pos += len(chunk)
+        self.buffer += chunk
+        seg_len = segment_cache.segment_length(self.seg, self.size)
+        while seg_len > 0 and len(self.buffer) >= seg_len:
+            # Viewers sharing one upstream read each fill the same segments
+            if not segment_cache.contains(self.key, self.seg):
+                segment_cache.put(self.key, self.seg, bytes(self.buffer[:seg_len]))
+            del self.buffer[:seg_len]
+            self.seg += 1
+            seg_len = segment_cache.segment_length(self.seg, self.size)
+        
+        relay_memory.resize(self.memory, len(self.buffer))
+        return out
+    
+    def close(self):
+        self.buffer = bytearray()
+        relay_memory.close(self.memory)
+
+def read_segment_file(path, lo, hi, chunk_size):
+    """Yield bytes lo..hi (inclusive) of a cached segment file"""
+    with open(path, "rb") as f:
+        f.seek(lo)
+        remaining = hi - lo + 1
+        while remaining > 0:
+            data = f.read(min(chunk_size, remaining))
+            if not data:
+                raise IOError(f"Cached segment {path} is truncated")
+            remaining -= len(data)
+            yield data
+
+def segment_fetch_accepted(status, headers, fetch_start):
+    # A CDN may answer a range covering the whole file with a plain 200
+    return status in (200, 206) and upstream_range_start(status, headers) == fetch_start
+
+# ============= READ-AHEAD PREFETCH =============
+
+# While a viewer plays sequentially, the next segments are fetched into the
+# segment cache in the background, so upstream stalls are absorbed before the
+# player gets there. A seek cancels prefetches the viewer no longer needs.
+READAHEAD_ENABLED = os.environ.get("READAHEAD_ENABLED", "1") == "1"
+READAHEAD_SEGMENTS = int(os.environ.get("READAHEAD_SEGMENTS", 2))
+READAHEAD_WORKERS = int(os.environ.get("READAHEAD_WORKERS", 4))
+READAHEAD_MAX_VIEWERS = int(os.environ.get("READAHEAD_MAX_VIEWERS", 1024))
+READAHEAD_WAIT_TIMEOUT = float(os.environ.get("READAHEAD_WAIT_TIMEOUT", 30))
+
+class ReadAhead:
+    """Per-viewer sequential playback detection and cancellable segment prefetch.
+    
+    Memory is bounded by READAHEAD_WORKERS segments - queued prefetches hold nothing.
+    """
+    
+    def __init__(self, depth, workers, max_viewers):
+        self.depth = depth
+        self.max_viewers = max_viewers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="read-ahead")
+        # Re-entrant: a future that is already done runs its callback on submit
+        self.lock = threading.RLock()
+        self.inflight = {}  # (key, seg) -> (future, cancel event)
+        self.viewers = OrderedDict()  # viewer -> {"key", "seg", "streak", "scheduled"}
+        self.stats = {"scheduled": 0, "completed": 0, "cancelled": 0, "failed": 0, "waits": 0, "sequential": 0, "seeks": 0}
+    
+    def _count(self, stat, amount=1):
+        with self.lock:
+            self.stats[stat] += amount
+    
+    def pending(self, key, seg):
+        """Future of an in-flight prefetch of `seg`, or None"""
+        with self.lock:
+            entry = self.inflight.get((key, seg))
+        return entry[0] if entry else None
+    
+    def observe(self, viewer, video_url, key, seg, size):
+        """Note that `viewer` is now being served `seg` and prefetch what follows it"""
+        last_seg = (size - 1) // segment_cache.segment_size
+        with self.lock:
+            state = self.viewers.get(viewer)
+            if state is not None and state["key"] == key and state["seg"] <= seg <= state["seg"] + self.depth + 1:
+                if seg > state["seg"]:
+                    state["streak"] += 1
+                    self.stats["sequential"] += 1
+            else:
+                if state is not None:
+                    self.stats["seeks"] += 1
+                state = {"key": key, "seg": seg, "streak": 0, "scheduled": set()}
+            
+            # One segment ahead until playback looks sequential, then the full depth
+            depth = min(self.depth, 1 + state["streak"])
+            wanted = {(key, s) for s in range(seg + 1, min(seg + depth, last_seg) + 1)}
+            stale = state["scheduled"] - wanted
+            state["seg"] = seg
+            state["scheduled"] = wanted
+            self.viewers[viewer] = state
+            self.viewers.move_to_end(viewer)
+            while len(self.viewers) > self.max_viewers:
+                _, dropped = self.viewers.popitem(last=False)
+                stale |= dropped["scheduled"]
+            
+            for item in stale:
+                self._cancel(item)
+            
+            # Leave headroom for the streams themselves
+            if stream_budget.max_buffer_bytes and stream_budget.buffer_bytes() >= stream_budget.max_buffer_bytes // 2:
+                return
+            for item in sorted(wanted):
+                if item not in self.inflight and not segment_cache.contains(*item):
+                    cancelled = threading.Event()
+                    future = self.executor.submit(self._prefetch, video_url, item[0], item[1], size, cancelled)
+                    self.inflight[item] = (future, cancelled)
+                    self.stats["scheduled"] += 1
+                    future.add_done_callback(lambda _, item=item: self._finished(item))
+    
+    def _cancel(self, item):
+        # Called with the lock held. Other viewers may still want this segment
+        if any(item in state["scheduled"] for state in self.viewers.values()):
+            return
+        entry = self.inflight.pop(item, None)
+        if entry is not None:
+            future, cancelled = entry
+            cancelled.set()
+            future.cancel()
+            self.stats["cancelled"] += 1
+    
+    def _finished(self, item):
+        with self.lock:
+            entry = self.inflight.get(item)
+            if entry is not None and entry[0].done():
+                del self.inflight[item]
+    
+    def _prefetch(self, video_url, key, seg, size, cancelled):
+        if cancelled.is_set() or segment_cache.contains(key, seg):
+            return
+        fetch_start = seg * segment_cache.segment_size
+        length = segment_cache.segment_length(seg, size)
+        memory = relay_memory.open("readahead")
+        try:
+            req = open_stream_upstream(video_url, f"bytes={fetch_start}-{fetch_start + length - 1}")
+            if not segment_fetch_accepted(req.status_code, req.headers, fetch_start):
+                discard_response(req)
+                self._count("failed")
+                return
+            
+            buffer = bytearray(length)
+            relay_memory.resize(memory, length)
+            pos = 0
+            chunks = relay_chunks(req, STREAM_CHUNK_SIZE, length=length)
+            try:
+                for chunk in chunks:
+                    if cancelled.is_set():
+                        return
+                    buffer[pos:pos + len(chunk)] = chunk
+                    pos += len(chunk)
+            finally:
+                chunks.close()
+        except Exception as e:
+            print(f"Read-ahead error: {e}")
+            self._count("failed")
+            return
+        finally:
+            relay_memory.close(memory)
+        
+        if pos == length:
+            segment_cache.put(key, seg, bytes(buffer))
+            self._count("completed")
+        else:
+            self._count("failed")
+    
+    def wait(self, future):
+        self._count("waits")
+        try:
+            future.result(timeout=READAHEAD_WAIT_TIMEOUT)
+        except Exception:
+            # Cancelled, failed or too slow - the caller fetches the segment itself
+            pass
+    
+    async def async_wait(self, future):
+        self._count("waits")
+        try:
+            await asyncio.wait_for(asyncio.wrap_future(future), READAHEAD_WAIT_TIMEOUT)
+        except Exception:
+            pass
+    
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["inflight"] = len(self.inflight)
+            stats["viewers"] = len(self.viewers)
+        return stats
+
+read_ahead = (
+    ReadAhead(READAHEAD_SEGMENTS, READAHEAD_WORKERS, READAHEAD_MAX_VIEWERS)
+    if READAHEAD_ENABLED and segment_cache is not None else None
+)
+
+# ============= ACCELERATED (MULTI-CONNECTION) DOWNLOADS =============
+
+# Terabox throttles each connection, so large downloads are split into pieces
+# fetched over several connections and reassembled in order
+DOWNLOAD_ACCEL_ENABLED = os.environ.get("DOWNLOAD_ACCEL_ENABLED", "1") == "1"
+DOWNLOAD_ACCEL_MIN_BYTES = int(os.environ.get("DOWNLOAD_ACCEL_MIN_BYTES", 32 * 1024 * 1024))
+DOWNLOAD_ACCEL_PIECE_SIZE = int(os.environ.get("DOWNLOAD_ACCEL_PIECE_SIZE", 4 * 1024 * 1024))
+DOWNLOAD_ACCEL_MIN_CONNECTIONS = int(os.environ.get("DOWNLOAD_ACCEL_MIN_CONNECTIONS", 2))
+DOWNLOAD_ACCEL_MAX_CONNECTIONS = int(os.environ.get("DOWNLOAD_ACCEL_MAX_CONNECTIONS", 8))
+DOWNLOAD_ACCEL_REORDER_PIECES = int(os.environ.get("DOWNLOAD_ACCEL_REORDER_PIECES", 12))
+DOWNLOAD_ACCEL_ADAPT_INTERVAL = float(os.environ.get("DOWNLOAD_ACCEL_ADAPT_INTERVAL", 2))
+
+ACCEL_STATS = {"downloads": 0, "pieces": 0, "connections_added": 0, "connections_removed": 0, "last_per_connection_bps": 0}
+accel_stats_lock = threading.Lock()
+
+def _count_accel(key, amount=1):
+    with accel_stats_lock:
+        ACCEL_STATS[key] += amount
+
+class ParallelRangeFetcher:
+    """Fetches [start, end] over N upstream connections and yields it in order.
+    
+    At most DOWNLOAD_ACCEL_REORDER_PIECES pieces are held at once, so memory is
+    bounded however far ahead fast connections get. N starts at the minimum and
+    grows while adding a connection raises aggregate throughput (i.e. the CDN
+    throttles per connection), shrinking again when it stops helping.
+    """
+    
+    def __init__(self, open_upstream, video_url, start, end, chunk_size):
+        self.open_upstream = open_upstream
+        self.video_url = video_url
+        self.chunk_size = chunk_size
+        self.pieces = [
+            (lo, min(lo + DOWNLOAD_ACCEL_PIECE_SIZE - 1, end))
+            for lo in range(start, end + 1, DOWNLOAD_ACCEL_PIECE_SIZE)
+        ]
+        self.buffers = {}
+        self.buffered = 0
+        self.memory = relay_memory.open("parallel")
+        self.next_piece = 0
+        self.emit_index = 0
+        self.target = min(DOWNLOAD_ACCEL_MIN_CONNECTIONS, len(self.pieces))
+        self.error = None
+        self.stopped = False
+        self.cond = threading.Condition()
+        
+        self.window_bytes = 0
+        self.window_started = time.time()
+        self.last_rate = None
+    
+    def _worker(self, worker_id):
+        while True:
+            with self.cond:
+                while not self.stopped and self.next_piece < len(self.pieces) and (
+                    worker_id >= self.target
+                    or self.next_piece - self.emit_index >= DOWNLOAD_ACCEL_REORDER_PIECES
+                ):
+                    self.cond.wait(1)
+                if self.stopped or self.next_piece >= len(self.pieces):
+                    return
+                index = self.next_piece
+                self.next_piece += 1
+                self.buffers[index] = bytearray()
+            
+            try:
+                self._fetch(index)
+            except Exception as e:
+                with self.cond:
+                    if self.error is None:
+                        self.error = e
+                    self.cond.notify_all()
+                return
+    
+    def _fetch(self, index):
+        lo, hi = self.pieces[index]
+        expected = hi - lo + 1
+        received = 0
+        
+        req = self.open_upstream(self.video_url, f"bytes={lo}-{hi}")
+        try:
+            if not segment_fetch_accepted(req.status_code, req.headers, lo):
+                raise UpstreamRefused(f"Upstream refused piece {lo}-{hi}", req.status_code)
+            
+            for chunk in req.iter_content(chunk_size=256 * 1024):
+                UPSTREAM_READ_BYTES.inc(len(chunk))
+                chunk = chunk[:expected - received]
+                with self.cond:
+                    if self.stopped:
+                        return
+                    self.buffers[index] += chunk
+                    self.buffered += len(chunk)
+                    relay_memory.resize(self.memory, self.buffered)
+                    self.window_bytes += len(chunk)
+                    self.cond.notify_all()
+                received += len(chunk)
+                if received >= expected:
+                    break
+        finally:
+            req.close()
+        
+        if received < expected:
+            raise IOError(f"Upstream piece {lo}-{hi} ended after {received} bytes")
+        
+        _count_accel("pieces")
+        with self.cond:
+            self._adapt()
+    
+    def _adapt(self):
+        """Adjust the connection count from the throughput of the last interval"""
+        now = time.time()
+        elapsed = now - self.window_started
+        if elapsed < DOWNLOAD_ACCEL_ADAPT_INTERVAL:
+            return
+        
+        rate = self.window_bytes / elapsed
+        with accel_stats_lock:
+            ACCEL_STATS["last_per_connection_bps"] = int(rate / max(1, self.target))
+        
+        if self.last_rate is None or rate > self.last_rate * 1.1:
+            if self.target < DOWNLOAD_ACCEL_MAX_CONNECTIONS:
+                self.target += 1
+                _count_accel("connections_added")
+        elif rate < self.last_rate * 0.9 and self.target > DOWNLOAD_ACCEL_MIN_CONNECTIONS:
+            self.target -= 1
+            _count_accel("connections_removed")
+        
+        self.last_rate = rate
+        self.window_bytes = 0
+        self.window_started = now
+        self.cond.notify_all()
+    
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.buffers.clear()
+            self.buffered = 0
+            relay_memory.close(self.memory)
+            self.cond.notify_all()
+    
+    def chunks(self):
+        _count_accel("downloads")
+        for worker_id in range(min(DOWNLOAD_ACCEL_MAX_CONNECTIONS, len(self.pieces))):
+            threading.Thread(target=self._worker, args=(worker_id,), daemon=True).start()
+        
+        try:
+            for index, (lo, hi) in enumerate(self.pieces):
+                emitted = 0
+                while emitted < hi - lo + 1:
+                    with self.cond:
+                        while self.error is None and (
+                            index not in self.buffers or len(self.buffers[index]) <= emitted
+                        ):
+                            self.cond.wait(1)
+                        if self.error is not None:
+                            raise self.error
+                        data = bytes(self.buffers[index][emitted:emitted + self.chunk_size])
+                    emitted += len(data)
+                    yield data
+                
+                with self.cond:
+                    self.buffered -= len(self.buffers.pop(index))
+                    relay_memory.resize(self.memory, self.buffered)
+                    self.emit_index = index + 1
+                    self.cond.notify_all()
+        finally:
+            self.stop()
+
+def use_accelerated_download(mode, length):
+    """Whether a download of `length` bytes should use parallel connections"""
+    if mode != "download" or length < DOWNLOAD_ACCEL_MIN_BYTES:
+        return False
+    override = request.args.get("accel")
+    if override is not None:
+        return override == "1"
+    return DOWNLOAD_ACCEL_ENABLED
+
+def fetch_range_chunks(video_url, mode, fetch_start, fetch_end, chunk_size, accelerate=False, session_id=None, key=None):
+    """Yield upstream bytes fetch_start..fetch_end in order, resuming mid-range
+    when upstream fails (see failover_chunks)"""
+    return failover_chunks(video_url, mode, fetch_start, fetch_end, chunk_size, session_id, accelerate=accelerate, key=key)
+
+def open_range_chunks(video_url, mode, fetch_start, fetch_end, chunk_size, accelerate=False, key=None):
+    """Yield upstream bytes fetch_start..fetch_end in order, over N connections or
+    one connection shared with concurrent viewers of the file `key` identifies"""
+    if accelerate:
+        open_upstream = open_stream_upstream if mode == "stream" else open_download_upstream
+        fetcher = ParallelRangeFetcher(open_upstream, video_url, fetch_start, fetch_end, chunk_size)
+        yield from fetcher.chunks()
+        return
+    
+    if fanout is not None:
+        yield from fanout.chunks(video_url, mode, fetch_start, fetch_end, chunk_size, key)
+    else:
+        yield from single_range_chunks(video_url, mode, fetch_start, fetch_end, chunk_size)
+
+def single_range_chunks(video_url, mode, fetch_start, fetch_end, chunk_size):
+    """Yield upstream bytes fetch_start..fetch_end over one private connection"""
+    open_upstream = open_stream_upstream if mode == "stream" else open_download_upstream
+    req = open_upstream(video_url, f"bytes={fetch_start}-{fetch_end}")
+    if not segment_fetch_accepted(req.status_code, req.headers, fetch_start):
+        discard_response(req)
+        raise UpstreamRefused(f"Upstream refused range {fetch_start}-{fetch_end}", req.status_code)
+    
+    yield from relay_chunks(req, chunk_size, 0, fetch_end - fetch_start + 1)
+
+# ============= MID-STREAM FAILOVER =============
+
+# A relay that loses its upstream midway (reset, read timeout, truncated body, or
+# an expired link on reopen) resumes at the next byte the client hasn't got,
+# on the session's current link - re-resolved first if the CDN refused the old
+# one. Each session gets FAILOVER_MAX_RETRIES resumes per FAILOVER_WINDOW so a
+# dead file can't keep a worker retrying forever.
+FAILOVER_ENABLED = os.environ.get("FAILOVER_ENABLED", "1") == "1"
+FAILOVER_MAX_RETRIES = int(os.environ.get("FAILOVER_MAX_RETRIES", 3))
+FAILOVER_WINDOW = float(os.environ.get("FAILOVER_WINDOW", 300))
+FAILOVER_BACKOFF = float(os.environ.get("FAILOVER_BACKOFF", 0.5))
+FAILOVER_MAX_TRACKED = int(os.environ.get("FAILOVER_MAX_TRACKED", 10000))
+# Threads for the ASGI engine's session lookups and re-resolves - a re-resolve can
+# wait up to a minute, so they don't run on the executor the streams read from
+FAILOVER_WORKERS = int(os.environ.get("FAILOVER_WORKERS", 8))
+
+UPSTREAM_FAILURES = (
+    OSError, HTTPException, requests.RequestException, ProtocolError, ReadTimeoutError, httpx.HTTPError
+)
+
+class UpstreamRefused(IOError):
+    """Upstream answered a range fetch with something other than the range"""
+    
+    def __init__(self, message, status):
+        super().__init__(f"{message} ({status})")
+        self.status = status
+
+class FailoverBudget:
+    """Resumes per session in a sliding window, plus counters for /stats"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.attempts = OrderedDict()  # session_id -> deque of resume times
+        self.stats = {"resumed": 0, "refreshed_links": 0, "exhausted": 0, "failed": 0}
+    
+    def allow(self, session_id):
+        now = time.time()
+        with self.lock:
+            attempts = self.attempts.pop(session_id, None) or deque()
+            while attempts and now - attempts[0] > FAILOVER_WINDOW:
+                attempts.popleft()
+            allowed = len(attempts) < FAILOVER_MAX_RETRIES
+            if allowed:
+                attempts.append(now)
+            else:
+                self.stats["exhausted"] += 1
+            self.attempts[session_id] = attempts
+            while len(self.attempts) > FAILOVER_MAX_TRACKED:
+                self.attempts.popitem(last=False)
+        return allowed
+    
+    def count(self, key, amount=1):
+        with self.lock:
+            self.stats[key] += amount
+    
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["tracked_sessions"] = len(self.attempts)
+        return stats
+
+failover_budget = FailoverBudget()
+
+def failover_url(session_id, failed_url, error):
+    """Link to resume on after `error` - None when the session is gone or can't be re-resolved"""
+    session = get_session(session_id)
+    if session is None:
+        return None
+    download_url = session["download_url"]
+    if download_url == failed_url and isinstance(error, UpstreamRefused) and error.status in URL_EXPIRED_STATUSES:
+        download_url = url_refresher.fresh_url(session_id, failed_url)
+    # Otherwise a dropped connection - the same link is still good
+    if download_url and download_url != failed_url:
+        failover_budget.count("refreshed_links")
+    return download_url
+
+def failover_allowed(session_id, pos, error):
+    """Whether a relay that failed at `pos` may resume - counts against the session's budget"""
+    if not FAILOVER_ENABLED or session_id is None or not failover_budget.allow(session_id):
+        return False
+    print(f"Upstream failed at byte {pos} ({error}), resuming")
+    return True
+
+def failover_plan(session_id, video_url, pos, error):
+    """Link to resume at `pos` on, or None to give up and re-raise `error`"""
+    if not failover_allowed(session_id, pos, error):
+        return None
+    time.sleep(FAILOVER_BACKOFF)
+    return failover_url(session_id, video_url, error)
+
+failover_executor = ThreadPoolExecutor(max_workers=FAILOVER_WORKERS, thread_name_prefix="failover")
+
+async def async_failover_plan(session_id, video_url, pos, error):
+    """Async counterpart of failover_plan - backs off on the loop and looks the
+    link up on failover_executor"""
+    if not failover_allowed(session_id, pos, error):
+        return None
+    await asyncio.sleep(FAILOVER_BACKOFF)
+    return await asyncio.get_running_loop().run_in_executor(
+        failover_executor, failover_url, session_id, video_url, error
+    )
+
+def failover_chunks(video_url, mode, start, end, chunk_size, session_id, chunks=None, accelerate=False, key=None):
+    """Yield upstream bytes start..end, reopening at the next unsent byte when the
+    upstream read fails. `chunks` is an already open iterator for the range."""
+    pos = start
+    if chunks is None:
+        chunks = open_range_chunks(video_url, mode, start, end, chunk_size, accelerate, key)
+    try:
+        while True:
+            try:
+                for chunk in chunks:
+                    pos += len(chunk)
+                    yield chunk
+                if pos <= end:
+                    raise IOError(f"Upstream body ended at byte {pos}, expected {end + 1}")
+                return
+            except UPSTREAM_FAILURES as e:
+                chunks.close()
+                resume_url = failover_plan(session_id, video_url, pos, e)
+                if resume_url is None:
+                    failover_budget.count("failed")
+                    raise
+                video_url = resume_url
+                failover_budget.count("resumed")
+                chunks = open_range_chunks(video_url, mode, pos, end, chunk_size, accelerate, key)
+    finally:
+        chunks.close()
+
+# ============= SHARED UPSTREAM FETCHES =============
+
+# Concurrent viewers of the same file share one upstream read: the first request
+# for a range starts a SharedFetch, later requests whose start is still in its
+# retained window subscribe to it. A subscriber that falls more than
+# FANOUT_WINDOW behind the fastest one is dropped and fetches the rest itself.
+FANOUT_ENABLED = os.environ.get("FANOUT_ENABLED", "1") == "1"
+FANOUT_WINDOW = int(os.environ.get("FANOUT_WINDOW", 16 * 1024 * 1024))
+
+FANOUT_STATS = {"fetches": 0, "joins": 0, "fallbacks": 0, "shared_bytes": 0}
+fanout_stats_lock = threading.Lock()
+
+def _count_fanout(key, amount=1):
+    with fanout_stats_lock:
+        FANOUT_STATS[key] += amount
+
+class SharedFetch:
+    """One upstream read of [start, end], broadcast to every subscriber.
+    
+    A reader pulls from upstream while the fastest subscriber is within
+    FANOUT_WINDOW of the head, and keeps the last FANOUT_WINDOW bytes for
+    subscribers that lag or join late. The reader is a thread reading through
+    requests, or with a `loop`, a task on that event loop reading through httpx.
+    """
+    
+    def __init__(self, registry, key, video_url, mode, start, end, chunk_size, loop=None):
+        self.registry = registry
+        self.key = key
+        self.end = end
+        self.cond = threading.Condition()
+        self.chunks = deque()  # (offset, bytes)
+        self.base = start
+        self.head = start
+        self.done = False
+        self.error = None
+        self.positions = {}  # subscriber token -> next offset it wants
+        self.memory = relay_memory.open("fanout")
+        self.async_waiters = []
+        self.loop = loop
+        self.fetch_args = (video_url, mode, start, end, chunk_size)
+        # Set while the reader waits for the slowest subscriber to move
+        self.reader_blocked = False
+        self.reader_event = asyncio.Event() if loop is not None else None
+        self.task = None
+    
+    def start(self):
+        if self.loop is None:
+            threading.Thread(target=self._run, args=self.fetch_args, daemon=True).start()
+        else:
+            self.task = self.loop.create_task(self._run_async(*self.fetch_args))
+    
+    def _publish(self):
+        # Called with the condition held
+        self.cond.notify_all()
+        for loop, event in self.async_waiters:
+            loop.call_soon_threadsafe(event.set)
+        self.async_waiters = []
+    
+    def _wake_reader(self):
+        # Called with the condition held, when a subscriber moved on or left
+        if not self.reader_blocked:
+            return
+        self.reader_blocked = False
+        if self.loop is None:
+            self.cond.notify_all()
+        else:
+            self.loop.call_soon_threadsafe(self.reader_event.set)
+    
+    def _window_full(self):
+        return self.head - max(self.positions.values()) >= FANOUT_WINDOW
+    
+    def _append(self, chunk):
+        # Called with the condition held
+        self.chunks.append((self.head, chunk))
+        self.head += len(chunk)
+        while self.head - (self.base + len(self.chunks[0][1])) >= FANOUT_WINDOW:
+            _, dropped = self.chunks.popleft()
+            self.base += len(dropped)
+        relay_memory.resize(self.memory, self.head - self.base)
+        self._publish()
+    
+    def _finish(self):
+        self.registry.remove(self)
+        with self.cond:
+            self.done = True
+            self._publish()
+            self._release_if_idle()
+    
+    def _run(self, video_url, mode, start, end, chunk_size):
+        chunks = single_range_chunks(video_url, mode, start, end, chunk_size)
+        try:
+            for chunk in chunks:
+                with self.cond:
+                    # Run ahead of the fastest subscriber by at most one window
+                    while self.positions and self._window_full():
+                        self.reader_blocked = True
+                        self.cond.wait(1)
+                    if not self.positions:
+                        return
+                    self._append(chunk)
+        except Exception as e:
+            with self.cond:
+                self.error = e
+        finally:
+            self._finish()
+            chunks.close()
+    
+    async def _run_async(self, video_url, mode, start, end, chunk_size):
+        chunks = async_single_range_chunks(video_url, mode, start, end, chunk_size)
+        try:
+            async for chunk in chunks:
+                while True:
+                    with self.cond:
+                        if not self.positions:
+                            return
+                        if not self._window_full():
+                            self._append(chunk)
+                            break
+                        self.reader_event.clear()
+                        self.reader_blocked = True
+                    try:
+                        await asyncio.wait_for(self.reader_event.wait(), 1)
+                    except asyncio.TimeoutError:
+                        pass
+        except Exception as e:
+            with self.cond:
+                self.error = e
+        finally:
+            self._finish()
+            await chunks.aclose()
+    
+    def _release_if_idle(self):
+        # Called with the condition held - late readers still need the window until they detach
+        if self.done and not self.positions:
+            self.chunks.clear()
+            relay_memory.close(self.memory)
+    
+    def can_join(self, start, end):
+        with self.cond:
+            return not self.done and self.base <= start <= self.head and end <= self.end
+    
+    def attach(self, token, start):
+        with self.cond:
+            self.positions[token] = start
+    
+    def detach(self, token):
+        with self.cond:
+            self.positions.pop(token, None)
+            self._publish()
+            self._wake_reader()
+            self._release_if_idle()
+    
+    def _read(self, token, pos):
+        """("data", bytes) | ("wait", None) | ("lagged", None) | ("end", error) - condition held"""
+        if pos < self.base or token not in self.positions:
+            return ("lagged", None)
+        self.positions[token] = pos
+        self._wake_reader()
+        if pos < self.head:
+            for offset, chunk in self.chunks:
+                if offset <= pos < offset + len(chunk):
+                    return ("data", chunk[pos - offset:] if pos > offset else chunk)
+        if self.done:
+            return ("end", self.error)
+        return ("wait", None)
+    
+    def next_chunk(self, token, pos):
+        with self.cond:
+            while True:
+                outcome = self._read(token, pos)
+                if outcome[0] != "wait":
+                    return outcome
+                if not self.cond.wait(UPSTREAM_READ_TIMEOUT):
+                    return ("lagged", None)
+    
+    async def async_next_chunk(self, token, pos):
+        with self.cond:
+            outcome = self._read(token, pos)
+            if outcome[0] != "wait":
+                return outcome
+            event = asyncio.Event()
+            self.async_waiters.append((asyncio.get_running_loop(), event))
+        try:
+            await asyncio.wait_for(event.wait(), UPSTREAM_READ_TIMEOUT)
+        except asyncio.TimeoutError:
+            return ("lagged", None)
+        return await self.async_next_chunk(token, pos)
+
+class FanoutRegistry:
+    """In-flight SharedFetches by resource_key() of the download URL"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.fetches = defaultdict(list)
+    
+    def subscribe(self, video_url, mode, start, end, chunk_size, loop=None, key=None):
+        """(SharedFetch, token, joined) for [start, end], joining a running fetch if one covers it.
+        A new fetch reads on `loop` when given, else on its own thread. `key` is the
+        resource_key() of the file, computed from what is known of `video_url` if not given."""
+        key = key or resource_key(video_url)
+        token = object()
+        with self.lock:
+            for shared in self.fetches[key]:
+                if shared.can_join(start, end):
+                    shared.attach(token, start)
+                    _count_fanout("joins")
+                    return shared, token, True
+            shared = SharedFetch(self, key, video_url, mode, start, end, chunk_size, loop)
+            shared.attach(token, start)
+            self.fetches[key].append(shared)
+        _count_fanout("fetches")
+        shared.start()
+        return shared, token, False
+    
+    def remove(self, shared):
+        with self.lock:
+            fetches = self.fetches.get(shared.key)
+            if fetches and shared in fetches:
+                fetches.remove(shared)
+                if not fetches:
+                    del self.fetches[shared.key]
+    
+    def chunks(self, video_url, mode, start, end, chunk_size, key=None):
+        """Yield start..end from a shared fetch, falling back to a private one when lagging"""
+        shared, token, joined = self.subscribe(video_url, mode, start, end, chunk_size, key=key)
+        pos = start
+        try:
+            while pos <= end:
+                kind, value = shared.next_chunk(token, pos)
+                if kind == "data":
+                    value = value[:end - pos + 1]
+                    pos += len(value)
+                    yield value
+                    continue
+                if kind == "end" and value is not None and pos == start:
+                    raise value
+                break
+        finally:
+            shared.detach(token)
+        
+        if joined:
+            _count_fanout("shared_bytes", pos - start)
+        if pos <= end:
+            # Too slow for the shared read, or it ended early - fetch the rest alone
+            _count_fanout("fallbacks")
+            yield from single_range_chunks(video_url, mode, pos, end, chunk_size)
+    
+    async def async_chunks(self, video_url, mode, start, end, chunk_size, key=None):
+        """Async counterpart of chunks - a fetch started here reads on the running loop"""
+        shared, token, joined = self.subscribe(video_url, mode, start, end, chunk_size, asyncio.get_running_loop(), key)
+        pos = start
+        try:
+            while pos <= end:
+                kind, value = await shared.async_next_chunk(token, pos)
+                if kind == "data":
+                    value = value[:end - pos + 1]
+                    pos += len(value)
+                    yield value
+                    continue
+                if kind == "end" and value is not None and pos == start:
+                    raise value
+                break
+        finally:
+            shared.detach(token)
+        
+        if joined:
+            _count_fanout("shared_bytes", pos - start)
+        if pos <= end:
+            _count_fanout("fallbacks")
+            async for chunk in async_single_range_chunks(video_url, mode, pos, end, chunk_size):
+                yield chunk
+
+fanout = FanoutRegistry() if FANOUT_ENABLED else None
+
+def cached_range_chunks(video_url, mode, start, end, info, chunk_size, accelerate=False, viewer=None, session_id=None):
+    """Serve [start, end] from the segment cache, fetching only missing segments.
+    
+    With a `viewer`, read-ahead fetches the segments that follow, so this only
+    ever fetches the segment being served itself. `session_id` lets fetches
+    fail over to the session's current link.
+    """
+    key = resource_key(video_url, info)
+    size = info["size"]
+    seg_size = segment_cache.segment_size
+    
+    for step in plan_segments(key, start, end, size, max_run=1 if viewer else None):
+        if step[0] == "wait":
+            read_ahead.wait(step[2])
+            continue
+        if viewer:
+            read_ahead.observe(viewer, video_url, key, step[1], size)
+        
+        if step[0] == "hit":
+            _, seg, path = step
+            lo, hi = cached_slice(seg, start, end, size)
+            offset = seg * seg_size + lo
+            try:
+                for data in read_segment_file(path, lo, hi, chunk_size):
+                    offset += len(data)
+                    segment_cache.count("bytes_from_cache", len(data))
+                    yield data
+                continue
+            except OSError:
+                # Evicted by another worker - refetch it, resuming after what was sent
+                segment_cache.forget(key, seg)
+                start = offset
+                step = ("miss", seg, seg, seg * seg_size, seg * seg_size + segment_cache.segment_length(seg, size) - 1)
+        
+        _, first_seg, _, fetch_start, fetch_end = step
+        fill = SegmentFill(key, first_seg, fetch_start, start, end, size)
+        run_accelerated = accelerate and fetch_end - fetch_start + 1 >= DOWNLOAD_ACCEL_MIN_BYTES
+        chunks = fetch_range_chunks(video_url, mode, fetch_start, fetch_end, chunk_size, run_accelerated, session_id, key)
+        try:
+            for chunk in chunks:
+                out = fill.feed(chunk)
+                if out:
+                    yield out
+        finally:
+            fill.close()
+            chunks.close()
+
+SENDFILE_ENABLED = os.environ.get("SENDFILE_ENABLED", "1") == "1"
+SENDFILE_BLOCK_SIZE = int(os.environ.get("SENDFILE_BLOCK_SIZE", 1024 * 1024))
+
+def sendfile_segment_response(video_url, mode, byte_range, window, info, filename=None, viewer=None):
+    """Hand a cached segment to the server's wsgi.file_wrapper (sendfile under gunicorn).
+    
+    Only used when the window lies in one cached segment, or for an open-ended
+    player request, which is answered with the rest of that segment - the player
+    simply asks for the next range, which is again served from the cache.
+    Returns None when the generator path has to be used instead.
+    """
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    if not SENDFILE_ENABLED or file_wrapper is None:
+        return None
+    
+    status, start, end = window
+    size = info["size"]
+    seg_size = segment_cache.segment_size
+    seg = start // seg_size
+    seg_end = seg * seg_size + segment_cache.segment_length(seg, size) - 1
+    
+    if end > seg_end:
+        if not (mode == "stream" and status == 206 and byte_range[1] is None):
+            return None
+        end = seg_end
+    
+    key = resource_key(video_url, info)
+    if not segment_cache.contains(key, seg):
+        return None
+    path = segment_cache.lookup(key, seg)
+    
+    try:
+        f = open(path, "rb")
+    except OSError:
+        segment_cache.forget(key, seg)
+        return None
+    
+    if os.fstat(f.fileno()).st_size != segment_cache.segment_length(seg, size):
+        f.close()
+        segment_cache.forget(key, seg)
+        return None
+    
+    if viewer:
+        read_ahead.observe(viewer, video_url, key, seg, size)
+    
+    # The server sends Content-Length bytes from the current file offset
+    f.seek(start - seg * seg_size)
+    segment_cache.count("bytes_from_cache", end - start + 1)
+    segment_cache.count("sendfile_responses", 1)
+    
+    return Response(
+        file_wrapper(f, SENDFILE_BLOCK_SIZE),
+        headers=range_response_headers(mode, status, start, end, info, filename=filename),
+        status=status,
+        direct_passthrough=True
+    )
+
+def proxy_range_request(video_url, mode, filename=None, session_id=None):
+    """serve_range_request behind the stream budget"""
+    PROXY_REQUESTS.inc(labels=(mode,))
+    reason = stream_budget.admit()
+    if reason:
+        PROXY_REJECTED.inc(labels=(reason,))
+        return over_budget_response(reason)
+    try:
+        response = serve_range_request(video_url, mode, filename, session_id)
+    except Exception:
+        stream_budget.release()
+        raise
+    return attach_stream_budget(response, mode)
+
+def serve_range_request(video_url, mode, filename=None, session_id=None):
+    """Serve GET/HEAD for /stream or /download with full Range/If-Range semantics.
+    
+    `session_id` enables read-ahead for sequential /stream playback and lets a
+    relay that loses its upstream resume on the session's current link.
+    """
+    viewer = session_id if mode == "stream" and read_ahead is not None else None
+    info = resource_info.get(video_url)
+    # Downloads probe too, so large ones can be split across connections from the start
+    needs_size = mode == "download" and DOWNLOAD_ACCEL_ENABLED
+    if info is None and (request.method == "HEAD" or request.headers.get('If-Range') or needs_size):
+        info = probe_resource_info(video_url)
+    
+    byte_range, window, upstream_range = plan_client_range(
+        request.headers.get('Range'), request.headers.get('If-Range'), info
+    )
+    
+    if window == "unsatisfiable":
+        return Response(status=416, headers=unsatisfiable_headers(info["size"]))
+    
+    if window is not None and request.method == "HEAD":
+        status, start, end = window
+        return Response(
+            status=status,
+            headers=range_response_headers(mode, status, start, end, info, filename=filename)
+        )
+    
+    chunk_size = STREAM_CHUNK_SIZE if mode == "stream" else DOWNLOAD_CHUNK_SIZE
+    
+    # Once the size is known, serve through the segment cache
+    if window is not None and segment_cache is not None:
+        response = sendfile_segment_response(video_url, mode, byte_range, window, info, filename, viewer)
+        if response is not None:
+            return response
+        
+        status, start, end = window
+        accelerate = use_accelerated_download(mode, end - start + 1)
+        return Response(
+            cached_range_chunks(video_url, mode, start, end, info, chunk_size, accelerate, viewer, session_id),
+            headers=range_response_headers(mode, status, start, end, info, filename=filename),
+            status=status,
+            direct_passthrough=True
+        )
+    
+    # Without the cache a known-size range still goes through a shared or parallel fetch
+    if window is not None and (fanout is not None or use_accelerated_download(mode, window[2] - window[1] + 1)):
+        status, start, end = window
+        accelerate = use_accelerated_download(mode, end - start + 1)
+        return Response(
+            fetch_range_chunks(video_url, mode, start, end, chunk_size, accelerate, session_id, resource_key(video_url, info)),
+            headers=range_response_headers(mode, status, start, end, info, filename=filename),
+            status=status,
+            direct_passthrough=True
+        )
+    
+    if mode == "stream":
+        req = open_stream_upstream(video_url, upstream_range)
+    else:
+        req = open_download_upstream(video_url, upstream_range)
+    
+    try:
+        outcome, detail = plan_upstream_response(video_url, byte_range, req.status_code, req.headers)
+    except Exception:
+        discard_response(req)
+        raise
+    
+    if outcome == "unsatisfiable":
+        discard_response(req)
+        return Response(status=416, headers=unsatisfiable_headers(detail))
+    
+    if outcome == "passthrough":
+        if mode == "download":
+            if not req.ok:
+                discard_response(req)
+            req.raise_for_status()
+            headers = download_response_headers(filename, int(req.headers.get('content-length', 0)))
+        else:
+            headers = stream_response_headers(req.headers)
+        if request.method == "HEAD":
+            discard_response(req)
+            return Response(status=req.status_code, headers=headers)
+        return Response(relay_chunks(req, chunk_size), headers=headers, status=req.status_code, direct_passthrough=True)
+    
+    status, start, end, skip, info = detail
+    headers = range_response_headers(mode, status, start, end, info, req.headers, filename)
+    if request.method == "HEAD":
+        discard_response(req)
+        return Response(status=status, headers=headers)
+    
+    chunks = relay_chunks(req, chunk_size, skip, end - start + 1)
+    return Response(
+        failover_chunks(video_url, mode, start, end, chunk_size, session_id, chunks),
+        headers=headers,
+        status=status,
+        direct_passthrough=True
+    )
+
+@app.route("/stream/<session_id>", methods=["GET", "HEAD"])
+def stream_video(session_id):
+    """Stream video with proper headers to bypass Terabox protection"""
+    session = get_session(session_id)
+    
+    if not session:
+        return "Session expired", 404
+    
+    url_refresher.touch(session_id, session)
+    
+    video_url = session["download_url"]
+    
+    # Forward the request to Terabox
+    try:
+        return proxy_range_request(video_url, "stream", session_id=session_id)
+        
+    except Exception as e:
+        print(f"Stream error: {str(e)}")
+        return f"Streaming error: {str(e)}", 500
+
+@app.route("/download/<session_id>", methods=["GET", "HEAD"])
+def download_video(session_id):
+    """Instant streaming download - starts downloading immediately, resumable via Range"""
+    session = get_session(session_id)
+    
+    if not session:
+        return "Session expired", 404
+    
+    url_refresher.touch(session_id, session)
+    
+    video_url = session["download_url"]
+    filename = session.get("filename", "terabox_video.mp4")
+    
+    try:
+        # Stream directly from Terabox to client
+        return proxy_range_request(video_url, "download", filename, session_id)
+        
+    except Exception as e:
+        print(f"Download error: {str(e)}")
+        return download_fallback_html(video_url)
+
+# ============= PAGE ASSETS =============
+
+# The player and download pages are a small per-session HTML shell plus CSS/JS
+# that is built once at startup: fingerprinted, precompressed and served with a
+# one-year immutable Cache-Control. Brotli is used when the brotli package is installed.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ASSET_MAX_AGE = int(os.environ.get("ASSET_MAX_AGE", 365 * 24 * 3600))
+
+class StaticAsset:
+    """In-memory asset with a content fingerprint and precompressed variants"""
+    
+    def __init__(self, name, body, content_type):
+        self.body = body.encode("utf-8")
+        self.content_type = content_type
+        self.etag = hashlib.sha256(self.body).hexdigest()[:16]
+        stem, _, ext = name.rpartition(".")
+        self.name = f"{stem}.{self.etag[:10]}.{ext}"
+        self.url = f"/assets/{self.name}"
+        self.encodings = {"identity": self.body, "gzip": gzip.compress(self.body, 9)}
+        if brotli is not None:
+            self.encodings["br"] = brotli.compress(self.body)
+
+def negotiate_encoding(encodings):
+    """Best precompressed variant the client accepts"""
+    for encoding in ("br", "gzip"):
+        if encoding in encodings and request.accept_encodings[encoding]:
+            return encoding
+    return "identity"
+
+def validated_response(encodings, etag, content_type, cache_control, status=200):
+    """Serve a prebuilt body with ETag/If-None-Match, picking a compressed variant"""
+    encoding = negotiate_encoding(encodings)
+    # Each encoding is a different representation, so it gets its own validator
+    tag = etag if encoding == "identity" else f"{etag}-{encoding}"
+    headers = {'ETag': f'"{tag}"', 'Cache-Control': cache_control, 'Vary': 'Accept-Encoding'}
+    if request.if_none_match.contains(tag):
+        return Response(status=304, headers=headers)
+    if encoding != "identity":
+        headers['Content-Encoding'] = encoding
+    return Response(encodings[encoding], status=status, headers=headers, content_type=content_type)
+
+def page_shell_response(page):
+    """Per-session page: tiny, so it is only validated, not compressed"""
+    body = page.encode("utf-8")
+    etag = hashlib.sha256(body).hexdigest()[:16]
+    return validated_response(
+        {"identity": body}, etag, "text/html; charset=utf-8", "private, no-cache"
+    )
+
+PLAYER_CSS = StaticAsset("player.css", """\
+* {
+    margin: 0;
+    padding: 0;
+    box-sizing: border-box;
+}
+
+body {
+    background: linear-gradient(135deg, #0f172a 0%, #1e293b 100%);
+    color: white;
+    font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif;
+    min-height: 100vh;
+    display: flex;
+    flex-direction: column;
+}
+
+.header {
+    background: linear-gradient(135deg, #6366f1 0%, #4f46e5 100%);
+    padding: 20px;
+    text-align: center;
+    box-shadow: 0 4px 20px rgba(99, 102, 241, 0.3);
+}
+
+.header h1 {
+    font-size: 24px;
+    margin-bottom: 5px;
+}
+
+.header p {
+    opacity: 0.9;
+    font-size: 14px;
+}
+
+.main-container {
+    flex: 1;
+    display: flex;
+    flex-direction: column;
+    align-items: center;
+    padding: 20px;
+}
+
+.video-container {
+    width: 100%;
+    max-width: 1000px;
+    background: #000;
+    border-radius: 10px;
+    overflow: hidden;
+    margin-bottom: 20px;
+    box-shadow: 0 10px 30px rgba(0, 0, 0, 0.5);
+}
+
+#my-video {
+    width: 100%;
+    height: auto;
+    max-height: 70vh;
+}
+
+.controls {
+    display: flex;
+    flex-wrap: wrap;
+    gap: 15px;
+    justify-content: center;
+    margin-top: 20px;
+    max-width: 1000px;
+    width: 100%;
+}
+
+.btn {
+    padding: 15px 25px;
+    border: none;
+    border-radius: 10px;
+    font-size: 16px;
+    font-weight: 600;
+    cursor: pointer;
+    display: flex;
+    align-items: center;
+    gap: 10px;
+    text-decoration: none;
+    color: white;
+    transition: all 0.3s;
+}
+
+.btn-download {
+    background: linear-gradient(135deg, #10b981 0%, #059669 100%);
+}
+
+.btn-fullscreen {
+    background: linear-gradient(135deg, #f59e0b 0%, #d97706 100%);
+}
+
+.btn:hover {
+    transform: translateY(-3px);
+    box-shadow: 0 8px 25px rgba(0, 0, 0, 0.4);
+}
+
+.info {
+    background: rgba(255, 255, 255, 0.05);
+    padding: 20px;
+    border-radius: 10px;
+    margin-top: 20px;
+    max-width: 1000px;
+    width: 100%;
+    text-align: center;
+    color: #94a3b8;
+}
+
+@media (max-width: 768px) {
+    .controls {
+        flex-direction: column;
+    }
+
+    .btn {
+        width: 100%;
+        justify-content: center;
+    }
+
+    .video-container {
+        border-radius: 0;
+    }
+}
+""", "text/css; charset=utf-8")
+
+PLAYER_JS = StaticAsset("player.js", """\
+const downloadButton = document.querySelector('.btn-download');
+
+// Initialize video.js player
+const player = videojs('my-video', {
+    controls: true,
+    autoplay: true,
+    preload: 'auto',
+    fluid: true,
+    responsive: true,
+    playbackRates: [0.5, 1, 1.5, 2],
+    controlBar: {
+        children: [
+            'playToggle',
+            'volumePanel',
+            'currentTimeDisplay',
+            'timeDivider',
+            'durationDisplay',
+            'progressControl',
+            'remainingTimeDisplay',
+            'playbackRateMenuButton',
+            'fullscreenToggle'
+        ]
+    }
+});
+
+// Fullscreen function
+function toggleFullscreen() {
+    if (player.isFullscreen()) {
+        player.exitFullscreen();
+    } else {
+        player.requestFullscreen();
     }
-    
-    # Forward the request to Terabox
-    try:
-        req = requests.get(video_url, headers=headers, stream=True, timeout=30)
-        
-        if req.status_code == 403 or req.status_code == 404:
-            # Try alternative headers
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-                'Referer': 'https://terabox.com/',
-                'Accept': '*/*',
-            }
-            req = requests.get(video_url, headers=headers, stream=True, timeout=30)
-        
-        # Get response headers
-        response_headers = dict(req.headers)
-        
-        # Fix headers for proper streaming
-        if 'Content-Length' in response_headers:
-            response_headers['Content-Length'] = str(response_headers['Content-Length'])
-        
-        # Ensure correct content type
-        response_headers['Content-Type'] = req.headers.get('Content-Type', 'video/mp4')
-        
-        # Add CORS headers
-        response_headers['Access-Control-Allow-Origin'] = '*'
-        response_headers['Access-Control-Allow-Headers'] = '*'
-        response_headers['Access-Control-Allow-Methods'] = 'GET, HEAD, OPTIONS'
-        response_headers['Access-Control-Expose-Headers'] = 'Content-Length, Content-Range'
-        
-        # Add range support
-        response_headers['Accept-Ranges'] = 'bytes'
-        response_headers['Cache-Control'] = 'no-cache'
-        
-        # Remove problematic headers
-        for header in ['Transfer-Encoding', 'Connection', 'Content-Encoding']:
-            response_headers.pop(header, None)
-        
-        # Stream the response
-        def generate():
-            for chunk in req.iter_content(chunk_size=1024*1024):  # 1MB chunks
-                if chunk:
-                    yield chunk
-        
-        return Response(generate(), headers=response_headers, status=req.status_code)
-        
-    except Exception as e:
-        print(f"Stream error: {str(e)}")
-        return f"Streaming error: {str(e)}", 500
+}
 
-@app.route("/download/<session_id>")
-def download_video(session_id):
-    """Instant streaming download - starts downloading immediately"""
-    session = SESSIONS.get(session_id)
-    
-    if not session:
-        return "Session expired", 404
-    
-    video_url = session["download_url"]
-    filename = session.get("filename", "terabox_video.mp4")
-    
-    # Headers for Terabox
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-        'Referer': 'https://www.terabox.com/',
-        'Range': request.headers.get('Range', 'bytes=0-'),
+// Handle player events
+player.on('error', function() {
+    console.log('Player error occurred');
+});
+
+player.on('loadeddata', function() {
+    console.log('Video loaded successfully');
+});
+
+// Auto-play when video is ready
+player.ready(function() {
+    this.play().catch(function(error) {
+        console.log('Auto-play was prevented:', error);
+    });
+});
+
+// Download button handler - starts download in background
+function startDownload(event, url) {
+    event.preventDefault();
+
+    // Create invisible iframe for download
+    const iframe = document.createElement('iframe');
+    iframe.style.display = 'none';
+    iframe.src = url;
+    document.body.appendChild(iframe);
+
+    // Also try direct link method
+    setTimeout(() => {
+        const link = document.createElement('a');
+        link.href = url;
+        link.download = 'terabox_video.mp4';
+        document.body.appendChild(link);
+        link.click();
+        document.body.removeChild(link);
+    }, 100);
+
+    return false;
+}
+
+// Keyboard shortcuts
+document.addEventListener('keydown', function(e) {
+    if (e.code === 'KeyF' || e.code === 'KeyK') {
+        e.preventDefault();
+        if (player.paused()) {
+            player.play();
+        } else {
+            player.pause();
+        }
+    }
+    if (e.code === 'KeyD') {
+        e.preventDefault();
+        startDownload({preventDefault: () => {}}, downloadButton.href);
+    }
+});
+
+// Mobile optimization
+if (/Android|iPhone|iPad|iPod|BlackBerry|IEMobile|Opera Mini/i.test(navigator.userAgent)) {
+    // Force landscape suggestion on mobile
+    setTimeout(function() {
+        alert('💡 Tip: Rotate your phone sideways for better viewing experience!');
+    }, 3000);
+}
+""", "application/javascript; charset=utf-8")
+
+DOWNLOAD_CSS = StaticAsset("download.css", """\
+body {
+    margin: 0;
+    padding: 40px;
+    background: linear-gradient(135deg, #0f172a 0%, #1e293b 100%);
+    color: white;
+    font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif;
+    text-align: center;
+    min-height: 100vh;
+    display: flex;
+    flex-direction: column;
+    justify-content: center;
+    align-items: center;
+}
+.container {
+    max-width: 500px;
+    padding: 40px;
+    background: rgba(255, 255, 255, 0.1);
+    border-radius: 20px;
+    backdrop-filter: blur(10px);
+}
+.spinner {
+    width: 60px;
+    height: 60px;
+    border: 4px solid rgba(255, 255, 255, 0.1);
+    border-top-color: #6366f1;
+    border-radius: 50%;
+    animation: spin 1s linear infinite;
+    margin: 0 auto 30px;
+}
+@keyframes spin {
+    to { transform: rotate(360deg); }
+}
+.progress {
+    width: 100%;
+    height: 8px;
+    background: rgba(255, 255, 255, 0.1);
+    border-radius: 4px;
+    margin: 20px 0;
+    overflow: hidden;
+}
+.progress-bar {
+    height: 100%;
+    background: linear-gradient(90deg, #6366f1, #8b5cf6);
+    animation: loading 2s infinite;
+}
+@keyframes loading {
+    0% { width: 0%; }
+    50% { width: 70%; }
+    100% { width: 100%; }
+}
+.btn {
+    display: inline-block;
+    background: linear-gradient(135deg, #10b981 0%, #059669 100%);
+    color: white;
+    padding: 14px 28px;
+    border-radius: 50px;
+    text-decoration: none;
+    font-weight: 600;
+    margin-top: 20px;
+    transition: transform 0.3s;
+}
+.btn:hover {
+    transform: translateY(-3px);
+}
+""", "text/css; charset=utf-8")
+
+DOWNLOAD_JS = StaticAsset("download.js", """\
+const downloadLink = document.getElementById('download-link');
+
+// Try to trigger download immediately
+function startDownload() {
+    const link = document.createElement('a');
+    link.href = downloadLink.href;
+    link.download = downloadLink.getAttribute('download');
+    document.body.appendChild(link);
+    link.click();
+    document.body.removeChild(link);
+
+    // Update UI
+    document.querySelector('h2').textContent = '✅ Download Started!';
+    document.querySelector('p').textContent = 'Your video is now downloading...';
+}
+
+// Try multiple methods for instant download
+setTimeout(startDownload, 100);
+
+// Fallback after 3 seconds
+setTimeout(() => {
+    window.location.href = downloadLink.href;
+}, 3000);
+
+// Show time elapsed
+let seconds = 0;
+setInterval(() => {
+    seconds++;
+    const timer = document.getElementById('timer');
+    if (timer) {
+        timer.textContent = seconds + 's';
     }
+}, 1000);
+""", "application/javascript; charset=utf-8")
+
+ASSETS = {asset.name: asset for asset in (PLAYER_CSS, PLAYER_JS, DOWNLOAD_CSS, DOWNLOAD_JS)}
+
+EXPIRED_PAGE = StaticAsset("expired.html", """\
+<!DOCTYPE html>
+<html>
+<head>
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <style>
+        body {
+            margin: 0;
+            padding: 0;
+            background: linear-gradient(135deg, #1a1a2e 0%, #16213e 100%);
+            color: white;
+            font-family: 'Segoe UI', sans-serif;
+            height: 100vh;
+            display: flex;
+            justify-content: center;
+            align-items: center;
+            text-align: center;
+        }
+        .error {
+            background: rgba(239, 68, 68, 0.1);
+            padding: 30px;
+            border-radius: 15px;
+            border: 2px solid rgba(239, 68, 68, 0.3);
+            max-width: 400px;
+        }
+    </style>
+</head>
+<body>
+    <div class="error">
+        <h1 style="color: #ef4444; font-size: 48px;">⏰</h1>
+        <h2>Session Expired</h2>
+        <p>This video link has expired.</p>
+        <p style="color: #94a3b8; margin-top: 20px;">
+            Please get a new link from the Telegram bot.
+        </p>
+    </div>
+</body>
+</html>
+""", "text/html; charset=utf-8")
+
+# Asset URLs are filled in once; $-placeholders are per session
+PLAYER_SHELL = Template(Template("""\
+<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>🎬 Terabox Video Player</title>
+    <link href="https://vjs.zencdn.net/8.0.4/video-js.css" rel="stylesheet" />
+    <link href="$css_url" rel="stylesheet" />
+</head>
+<body>
+    <div class="header">
+        <h1>🎬 Terabox Video Player</h1>
+        <p>Streaming directly from Terabox • No downloads needed</p>
+    </div>
     
-    try:
-        # Stream directly from Terabox to client
-        req = requests.get(video_url, headers=headers, stream=True, timeout=300)
-        req.raise_for_status()
-        
-        # Get file size for progress
-        file_size = int(req.headers.get('content-length', 0))
+    <div class="main-container">
+        <div class="video-container">
+            <video
+                id="my-video"
+                class="video-js vjs-default-skin vjs-big-play-centered"
+                controls
+                preload="auto"
+                autoplay
+                playsinline
+                data-setup='{}'
+            >
+                <source src="$stream_url" type="video/mp4" />
+                <p class="vjs-no-js">
+                    To view this video please enable JavaScript, and consider upgrading to a
+                    web browser that <a href="https://videojs.com/html5-video-support/" target="_blank">supports HTML5 video</a>
+                </p>
+            </video>
+        </div>
         
-        # Create a streaming response
-        def generate():
-            chunk_size = 8192 * 1024  # 8MB chunks for faster download
-            for chunk in req.iter_content(chunk_size=chunk_size):
-                if chunk:
-                    yield chunk
+        <div class="controls">
+            <a href="$download_url" class="btn btn-download" onclick="startDownload(event, this.href)">
+                <svg width="20" height="20" fill="currentColor" viewBox="0 0 24 24">
+                    <path d="M19 9h-4V3H9v6H5l7 7 7-7zM5 18v2h14v-2H5z"/>
+                </svg>
+                Download Video
+            </a>
+            
+            <button onclick="toggleFullscreen()" class="btn btn-fullscreen">
+                <svg width="20" height="20" fill="currentColor" viewBox="0 0 24 24">
+                    <path d="M7 14H5v5h5v-2H7v-3zm-2-4h2V7h3V5H5v5zm12 7h-3v2h5v-5h-2v3zM14 5v2h3v3h2V5h-5z"/>
+                </svg>
+                Fullscreen
+            </button>
+        </div>
         
-        # Set headers for instant download
-        response_headers = {
-            'Content-Type': 'video/mp4',
-            'Content-Disposition': f'attachment; filename="{filename}"',
-            'Content-Length': str(file_size) if file_size > 0 else '',
-            'Accept-Ranges': 'bytes',
-            'Cache-Control': 'no-cache',
-            'Connection': 'keep-alive'
-        }
+        <div class="info">
+            <p>🎥 This video is streamed directly from Terabox through our secure proxy.</p>
+            <p style="margin-top: 10px; font-size: 14px;">
+                🔒 Secure connection • ⚡ Fast streaming • 📱 Mobile friendly
+            </p>
+        </div>
+    </div>
+    
+    <script src="https://vjs.zencdn.net/8.0.4/video.min.js"></script>
+    <script src="$js_url"></script>
+</body>
+</html>
+""").safe_substitute(css_url=PLAYER_CSS.url, js_url=PLAYER_JS.url))
+
+DOWNLOAD_SHELL = Template(Template("""\
+<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="UTF-8">
+    <title>Downloading $filename...</title>
+    <link href="$css_url" rel="stylesheet" />
+</head>
+<body>
+    <div class="container">
+        <div class="spinner"></div>
+        <h2>🎬 Download Starting...</h2>
+        <p>Your video download should start automatically.</p>
         
-        # Remove Transfer-Encoding header for direct download
-        if 'Transfer-Encoding' in req.headers:
-            del req.headers['Transfer-Encoding']
+        <div class="progress">
+            <div class="progress-bar"></div>
+        </div>
         
-        # Return streaming response that starts immediately
-        return Response(
-            generate(),
-            headers=response_headers,
-            status=200,
-            direct_passthrough=True
-        )
+        <p style="color: #94a3b8; margin: 20px 0;">
+            If download doesn't start in 5 seconds, click below:
+        </p>
         
-    except Exception as e:
-        print(f"Download error: {str(e)}")
+        <a id="download-link" href="$video_url" download="$filename" class="btn">
+            📥 Click to Download Now
+        </a>
         
-        # Fallback: Create a simple HTML page with direct link
-        html = f'''
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <meta charset="UTF-8">
-            <title>Download Video</title>
-            <meta http-equiv="refresh" content="0; url={video_url}">
-            <script>
-                window.location.href = "{video_url}";
-            </script>
-        </head>
-        <body>
-            <p>If download doesn't start automatically, <a href="{video_url}" download>click here</a></p>
-        </body>
-        </html>
-        '''
-        return html
+        <p style="margin-top: 30px; font-size: 14px; color: #64748b;">
+            <i>Downloading directly from Terabox servers...</i>
+        </p>
+    </div>
+    
+    <script src="$js_url"></script>
+</body>
+</html>
+""").safe_substitute(css_url=DOWNLOAD_CSS.url, js_url=DOWNLOAD_JS.url))
+
+@app.route("/assets/<name>")
+def static_asset(name):
+    """Fingerprinted page assets - the name changes with the content"""
+    asset = ASSETS.get(name)
+    if asset is None:
+        return "Not found", 404
+    return validated_response(
+        asset.encodings, asset.etag, asset.content_type,
+        f"public, max-age={ASSET_MAX_AGE}, immutable"
+    )
 
 @app.route("/direct_download/<session_id>")
 def direct_download(session_id):
     """Alternative download endpoint with meta refresh for instant start"""
-    session = SESSIONS.get(session_id)
+    session = get_session(session_id)
     
     if not session:
         return "Session expired", 404
     
+    url_refresher.touch(session_id, session)
+    
     video_url = session["download_url"]
     filename = session.get("filename", "terabox_video.mp4")
     
-    # HTML page with meta refresh and JavaScript for instant download
-    html = f'''
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <meta charset="UTF-8">
-        <title>Downloading {filename}...</title>
-        <style>
-            body {{
-                margin: 0;
-                padding: 40px;
-                background: linear-gradient(135deg, #0f172a 0%, #1e293b 100%);
-                color: white;
-                font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif;
-                text-align: center;
-                min-height: 100vh;
-                display: flex;
-                flex-direction: column;
-                justify-content: center;
-                align-items: center;
-            }}
-            .container {{
-                max-width: 500px;
-                padding: 40px;
-                background: rgba(255, 255, 255, 0.1);
-                border-radius: 20px;
-                backdrop-filter: blur(10px);
-            }}
-            .spinner {{
-                width: 60px;
-                height: 60px;
-                border: 4px solid rgba(255, 255, 255, 0.1);
-                border-top-color: #6366f1;
-                border-radius: 50%;
-                animation: spin 1s linear infinite;
-                margin: 0 auto 30px;
-            }}
-            @keyframes spin {{
-                to {{ transform: rotate(360deg); }}
-            }}
-            .progress {{
-                width: 100%;
-                height: 8px;
-                background: rgba(255, 255, 255, 0.1);
-                border-radius: 4px;
-                margin: 20px 0;
-                overflow: hidden;
-            }}
-            .progress-bar {{
-                height: 100%;
-                background: linear-gradient(90deg, #6366f1, #8b5cf6);
-                animation: loading 2s infinite;
-            }}
-            @keyframes loading {{
-                0% {{ width: 0%; }}
-                50% {{ width: 70%; }}
-                100% {{ width: 100%; }}
-            }}
-            .btn {{
-                display: inline-block;
-                background: linear-gradient(135deg, #10b981 0%, #059669 100%);
-                color: white;
-                padding: 14px 28px;
-                border-radius: 50px;
-                text-decoration: none;
-                font-weight: 600;
-                margin-top: 20px;
-                transition: transform 0.3s;
-            }}
-            .btn:hover {{
-                transform: translateY(-3px);
-            }}
-        </style>
-    </head>
-    <body>
-        <div class="container">
-            <div class="spinner"></div>
-            <h2>🎬 Download Starting...</h2>
-            <p>Your video download should start automatically.</p>
-            
-            <div class="progress">
-                <div class="progress-bar"></div>
-            </div>
-            
-            <p style="color: #94a3b8; margin: 20px 0;">
-                If download doesn't start in 5 seconds, click below:
-            </p>
-            
-            <a href="{video_url}" download="{filename}" class="btn">
-                📥 Click to Download Now
-            </a>
-            
-            <p style="margin-top: 30px; font-size: 14px; color: #64748b;">
-                <i>Downloading directly from Terabox servers...</i>
-            </p>
-        </div>
-        
-        <script>
-            // Try to trigger download immediately
-            function startDownload() {{
-                const link = document.createElement('a');
-                link.href = "{video_url}";
-                link.download = "{filename}";
-                document.body.appendChild(link);
-                link.click();
-                document.body.removeChild(link);
-                
-                // Update UI
-                document.querySelector('h2').textContent = '✅ Download Started!';
-                document.querySelector('p').textContent = 'Your video is now downloading...';
-            }}
-            
-            // Try multiple methods for instant download
-            setTimeout(startDownload, 100);
-            
-            // Fallback after 3 seconds
-            setTimeout(() => {{
-                window.location.href = "{video_url}";
-            }}, 3000);
-            
-            // Show time elapsed
-            let seconds = 0;
-            setInterval(() => {{
-                seconds++;
-                const timer = document.getElementById('timer');
-                if (timer) {{
-                    timer.textContent = seconds + 's';
-                }}
-            }}, 1000);
-        </script>
-    </body>
-    </html>
-    '''
-    
-    return html
+    # Page that triggers the download from JavaScript, with a link as fallback
+    return page_shell_response(DOWNLOAD_SHELL.substitute(
+        video_url=html.escape(video_url), filename=html.escape(filename)
+    ))
 
 @app.route("/player/<session_id>")
 def video_player(session_id):
     """Fixed HTML video player with correct download button"""
-    session = SESSIONS.get(session_id)
+    session = get_session(session_id)
     
     if not session:
-        return render_template_string('''
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <meta name="viewport" content="width=device-width, initial-scale=1.0">
-            <style>
-                body {
-                    margin: 0;
-                    padding: 0;
-                    background: linear-gradient(135deg, #1a1a2e 0%, #16213e 100%);
-                    color: white;
-                    font-family: 'Segoe UI', sans-serif;
-                    height: 100vh;
-                    display: flex;
-                    justify-content: center;
-                    align-items: center;
-                    text-align: center;
-                }
-                .error {
-                    background: rgba(239, 68, 68, 0.1);
-                    padding: 30px;
-                    border-radius: 15px;
-                    border: 2px solid rgba(239, 68, 68, 0.3);
-                    max-width: 400px;
-                }
-            </style>
-        </head>
-        <body>
-            <div class="error">
-                <h1 style="color: #ef4444; font-size: 48px;">⏰</h1>
-                <h2>Session Expired</h2>
-                <p>This video link has expired.</p>
-                <p style="color: #94a3b8; margin-top: 20px;">
-                    Please get a new link from the Telegram bot.
-                </p>
-            </div>
-        </body>
-        </html>
-        ''')
+        # Served at the session's own URL, so a cache must not keep it once the
+        # session turns up (e.g. after a transient store miss)
+        return validated_response(
+            EXPIRED_PAGE.encodings, EXPIRED_PAGE.etag, EXPIRED_PAGE.content_type, "no-store"
+        )
     
-    stream_url = f"/stream/{session_id}"
-    # FIX: Use the direct download endpoint instead of HTML page
-    download_url = f"/direct_download/{session_id}"
+    url_refresher.touch(session_id, session)
     
     # Get base URL for absolute paths
     base_url = request.host_url.rstrip('/')
-    full_stream_url = f"{base_url}{stream_url}"
-    full_download_url = f"{base_url}{download_url}"
-    
-    html = f'''
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <meta charset="UTF-8">
-        <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <title>🎬 Terabox Video Player</title>
-        <link href="https://vjs.zencdn.net/8.0.4/video-js.css" rel="stylesheet" />
-        <style>
-            * {{
-                margin: 0;
-                padding: 0;
-                box-sizing: border-box;
-            }}
-            
-            body {{
-                background: linear-gradient(135deg, #0f172a 0%, #1e293b 100%);
-                color: white;
-                font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif;
-                min-height: 100vh;
-                display: flex;
-                flex-direction: column;
-            }}
-            
-            .header {{
-                background: linear-gradient(135deg, #6366f1 0%, #4f46e5 100%);
-                padding: 20px;
-                text-align: center;
-                box-shadow: 0 4px 20px rgba(99, 102, 241, 0.3);
-            }}
-            
-            .header h1 {{
-                font-size: 24px;
-                margin-bottom: 5px;
-            }}
-            
-            .header p {{
-                opacity: 0.9;
-                font-size: 14px;
-            }}
-            
-            .main-container {{
-                flex: 1;
-                display: flex;
-                flex-direction: column;
-                align-items: center;
-                padding: 20px;
-            }}
-            
-            .video-container {{
-                width: 100%;
-                max-width: 1000px;
-                background: #000;
-                border-radius: 10px;
-                overflow: hidden;
-                margin-bottom: 20px;
-                box-shadow: 0 10px 30px rgba(0, 0, 0, 0.5);
-            }}
-            
-            #my-video {{
-                width: 100%;
-                height: auto;
-                max-height: 70vh;
-            }}
-            
-            .controls {{
-                display: flex;
-                flex-wrap: wrap;
-                gap: 15px;
-                justify-content: center;
-                margin-top: 20px;
-                max-width: 1000px;
-                width: 100%;
-            }}
-            
-            .btn {{
-                padding: 15px 25px;
-                border: none;
-                border-radius: 10px;
-                font-size: 16px;
-                font-weight: 600;
-                cursor: pointer;
-                display: flex;
-                align-items: center;
-                gap: 10px;
-                text-decoration: none;
-                color: white;
-                transition: all 0.3s;
-            }}
-            
-            .btn-download {{
-                background: linear-gradient(135deg, #10b981 0%, #059669 100%);
-            }}
-            
-            .btn-fullscreen {{
-                background: linear-gradient(135deg, #f59e0b 0%, #d97706 100%);
-            }}
-            
-            .btn:hover {{
-                transform: translateY(-3px);
-                box-shadow: 0 8px 25px rgba(0, 0, 0, 0.4);
-            }}
-            
-            .info {{
-                background: rgba(255, 255, 255, 0.05);
-                padding: 20px;
-                border-radius: 10px;
-                margin-top: 20px;
-                max-width: 1000px;
-                width: 100%;
-                text-align: center;
-                color: #94a3b8;
-            }}
-            
-            @media (max-width: 768px) {{
-                .controls {{
-                    flex-direction: column;
-                }}
-                
-                .btn {{
-                    width: 100%;
-                    justify-content: center;
-                }}
-                
-                .video-container {{
-                    border-radius: 0;
-                }}
-            }}
-        </style>
-    </head>
-    <body>
-        <div class="header">
-            <h1>🎬 Terabox Video Player</h1>
-            <p>Streaming directly from Terabox • No downloads needed</p>
-        </div>
-        
-        <div class="main-container">
-            <div class="video-container">
-                <video
-                    id="my-video"
-                    class="video-js vjs-default-skin vjs-big-play-centered"
-                    controls
-                    preload="auto"
-                    autoplay
-                    playsinline
-                    data-setup='{{}}'
-                >
-                    <source src="{full_stream_url}" type="video/mp4" />
-                    <p class="vjs-no-js">
-                        To view this video please enable JavaScript, and consider upgrading to a
-                        web browser that <a href="https://videojs.com/html5-video-support/" target="_blank">supports HTML5 video</a>
-                    </p>
-                </video>
-            </div>
-            
-            <div class="controls">
-                <!-- FIX: Use the direct_download endpoint which will trigger instant download -->
-                <a href="{full_download_url}" class="btn btn-download" onclick="startDownload(event, '{full_download_url}')">
-                    <svg width="20" height="20" fill="currentColor" viewBox="0 0 24 24">
-                        <path d="M19 9h-4V3H9v6H5l7 7 7-7zM5 18v2h14v-2H5z"/>
-                    </svg>
-                    Download Video
-                </a>
-                
-                <button onclick="toggleFullscreen()" class="btn btn-fullscreen">
-                    <svg width="20" height="20" fill="currentColor" viewBox="0 0 24 24">
-                        <path d="M7 14H5v5h5v-2H7v-3zm-2-4h2V7h3V5H5v5zm12 7h-3v2h5v-5h-2v3zM14 5v2h3v3h2V5h-5z"/>
-                    </svg>
-                    Fullscreen
-                </button>
-            </div>
-            
-            <div class="info">
-                <p>🎥 This video is streamed directly from Terabox through our secure proxy.</p>
-                <p style="margin-top: 10px; font-size: 14px;">
-                    🔒 Secure connection • ⚡ Fast streaming • 📱 Mobile friendly
-                </p>
-            </div>
-        </div>
-        
-        <script src="https://vjs.zencdn.net/8.0.4/video.min.js"></script>
-        <script>
-            // Initialize video.js player
-            const player = videojs('my-video', {{
-                controls: true,
-                autoplay: true,
-                preload: 'auto',
-                fluid: true,
-                responsive: true,
-                playbackRates: [0.5, 1, 1.5, 2],
-                controlBar: {{
-                    children: [
-                        'playToggle',
-                        'volumePanel',
-                        'currentTimeDisplay',
-                        'timeDivider',
-                        'durationDisplay',
-                        'progressControl',
-                        'remainingTimeDisplay',
-                        'playbackRateMenuButton',
-                        'fullscreenToggle'
-                    ]
-                }}
-            }});
-            
-            // Fullscreen function
-            function toggleFullscreen() {{
-                if (player.isFullscreen()) {{
-                    player.exitFullscreen();
-                }} else {{
-                    player.requestFullscreen();
-                }}
-            }}
-            
-            // Handle player events
-            player.on('error', function() {{
-                console.log('Player error occurred');
-            }});
-            
-            player.on('loadeddata', function() {{
-                console.log('Video loaded successfully');
-            }});
-            
-            // Auto-play when video is ready
-            player.ready(function() {{
-                this.play().catch(function(error) {{
-                    console.log('Auto-play was prevented:', error);
-                }});
-            }});
-            
-            // Download button handler - starts download in background
-            function startDownload(event, url) {{
-                event.preventDefault();
-                
-                // Create invisible iframe for download
-                const iframe = document.createElement('iframe');
-                iframe.style.display = 'none';
-                iframe.src = url;
-                document.body.appendChild(iframe);
-                
-                // Also try direct link method
-                setTimeout(() => {{
-                    const link = document.createElement('a');
-                    link.href = url;
-                    link.download = 'terabox_video.mp4';
-                    document.body.appendChild(link);
-                    link.click();
-                    document.body.removeChild(link);
-                }}, 100);
-                
-                return false;
-            }}
-            
-            // Keyboard shortcuts
-            document.addEventListener('keydown', function(e) {{
-                if (e.code === 'KeyF' || e.code === 'KeyK') {{
-                    e.preventDefault();
-                    if (player.paused()) {{
-                        player.play();
-                    }} else {{
-                        player.pause();
-                    }}
-                }}
-                if (e.code === 'KeyD') {{
-                    e.preventDefault();
-                    startDownload({{preventDefault: () => {{}}}}, '{full_download_url}');
-                }}
-            }});
-            
-            // Mobile optimization
-            if (/Android|iPhone|iPad|iPod|BlackBerry|IEMobile|Opera Mini/i.test(navigator.userAgent)) {{
-                // Force landscape suggestion on mobile
-                setTimeout(function() {{
-                    alert('💡 Tip: Rotate your phone sideways for better viewing experience!');
-                }}, 3000);
-            }}
-        </script>
-    </body>
-    </html>
-    '''
-    
-    return html
+    return page_shell_response(PLAYER_SHELL.substitute(
+        stream_url=html.escape(f"{base_url}/stream/{session_id}"),
+        # The direct download endpoint starts the download instantly
+        download_url=html.escape(f"{base_url}/direct_download/{session_id}")
+    ))
 
 @app.route("/cleanup")
 def cleanup():
-    """Clean expired sessions"""
-    now = time.time()
-    expired = []
-    
-    for session_id, session in list(SESSIONS.items()):
-        if session["expire"] < now:
-            expired.append(session_id)
-            del SESSIONS[session_id]
-    
+    """Session stats - expired sessions are removed by the background reaper"""
+    return jsonify({
+        "cleaned": REAPER_STATS["last_reaped"],
+        "remaining": len(SESSIONS),
+        "max_sessions": SESSION_MAX_COUNT,
+        "reaper": REAPER_STATS
+    })
+
+@app.route("/stats")
+def stats():
+    """Proxy internals for this worker"""
     return jsonify({
-        "cleaned": len(expired),
-        "remaining": len(SESSIONS)
+        "upstream": upstream_stats(),
+        "header_profiles": header_profiles.stats(),
+        "segment_cache": segment_cache.snapshot() if segment_cache else None,
+        "download_accel": dict(ACCEL_STATS),
+        "relay_memory": relay_memory.snapshot(),
+        "stream_budget": stream_budget.snapshot(),
+        "read_ahead": read_ahead.snapshot() if read_ahead else None,
+        "fanout": dict(FANOUT_STATS),
+        "url_refresh": url_refresher.snapshot(),
+        "failover": failover_budget.snapshot()
     })
 
+# State the proxy already tracks, read when /metrics is scraped
+CallbackMetric("active_streams", "Streams holding a budget slot", lambda: stream_budget.active)
+CallbackMetric(
+    "relay_buffer_bytes", "Bytes held in stream buffers, by kind",
+    lambda: {(kind,): nbytes for kind, nbytes in relay_memory.bytes_by_kind().items()}, labels=("kind",)
+)
+CallbackMetric("sessions", "Sessions in the shared store", lambda: len(SESSIONS), per_worker=False)
+CallbackMetric(
+    "segment_cache_lookups_total", "Segment cache lookups by result",
+    lambda: {("hit",): segment_cache.stats["hits"], ("miss",): segment_cache.stats["misses"]} if segment_cache else {},
+    kind="counter", labels=("result",)
+)
+CallbackMetric("fanout_shared_bytes_total", "Bytes served from another viewer's upstream read",
+               lambda: FANOUT_STATS["shared_bytes"], kind="counter")
+CallbackMetric("failover_resumes_total", "Relays resumed after an upstream failure",
+               lambda: failover_budget.stats["resumed"], kind="counter")
+CallbackMetric("url_refreshes_total", "Download links re-resolved before or after expiry",
+               lambda: url_refresher.stats["refreshed"], kind="counter")
+
+if METRICS_ENABLED and METRICS_DIR:
+    threading.Thread(target=metrics_flusher, name="metrics-flusher", daemon=True).start()
+
+@app.route("/metrics")
+def metrics():
+    """Prometheus text exposition, summed over all workers sharing METRICS_DIR"""
+    if not METRICS_ENABLED:
+        return "Metrics disabled", 404
+    return Response(render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
 @app.route("/")
 def index():
     return jsonify({
@@ -752,12 +4168,548 @@ def index():
         "service": "Terabox Video Proxy Service",
         "endpoints": {
             "POST /process": "Process Terabox link",
+            "POST /process/batch": "Process many Terabox links (NDJSON stream)",
             "GET /player/<id>": "Video player page",
             "GET /stream/<id>": "Direct video stream",
             "GET /download/<id>": "Download video"
         }
     })
 
+# ============= ASYNC (ASGI) STREAMING ENGINE =============
+#
+# Serve with:  uvicorn api.flask_api:asgi_app
+#         or:  gunicorn -k uvicorn.workers.UvicornWorker api.flask_api:asgi_app
+#
+# /stream and /download are relayed on the event loop with httpx.AsyncClient, so a
+# viewer costs one coroutine and one chunk buffer instead of a worker thread.
+# Every other route (and the WSGI deployment via `app`) goes through Flask unchanged.
+
+ASYNC_UPSTREAM_MAX_CONNECTIONS = int(os.environ.get("ASYNC_UPSTREAM_MAX_CONNECTIONS", 4096))
+ASGI_WSGI_THREADS = int(os.environ.get("ASGI_WSGI_THREADS", 16))
+
+async_upstream = {"client": None}
+wsgi_bridge_pool = ThreadPoolExecutor(max_workers=ASGI_WSGI_THREADS, thread_name_prefix="wsgi-bridge")
+
+def get_async_upstream():
+    """Shared httpx.AsyncClient for the running event loop"""
+    client = async_upstream["client"]
+    if client is None:
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=ASYNC_UPSTREAM_MAX_CONNECTIONS,
+                max_keepalive_connections=UPSTREAM_POOL_SIZE,
+            ),
+            timeout=httpx.Timeout(UPSTREAM_READ_TIMEOUT, connect=UPSTREAM_CONNECT_TIMEOUT),
+            follow_redirects=True,
+        )
+        async_upstream["client"] = client
+    return client
+
+async def async_upstream_get(url, headers, read_timeout=None):
+    """Streaming GET to the CDN - caller must aclose() the response"""
+    _count_upstream("async_requests")
+    client = get_async_upstream()
+    upstream_request = client.build_request(
+        "GET",
+        url,
+        headers=headers,
+        timeout=httpx.Timeout(read_timeout or UPSTREAM_READ_TIMEOUT, connect=UPSTREAM_CONNECT_TIMEOUT),
+    )
+    started = time.perf_counter()
+    upstream = await client.send(upstream_request, stream=True)
+    UPSTREAM_TTFB_SECONDS.observe(time.perf_counter() - started, ("async",))
+    UPSTREAM_RESPONSES.inc(labels=(str(upstream.status_code),))
+    return upstream
+
+def _asgi_headers(headers):
+    return [
+        (str(name).lower().encode("latin-1"), str(value).encode("latin-1"))
+        for name, value in headers.items()
+    ]
+
+def _asgi_request_headers(scope):
+    return {name.decode("latin-1").lower(): value.decode("latin-1") for name, value in scope["headers"]}
+
+async def _asgi_send_text(send, status, text, content_type="text/html; charset=utf-8", headers=None):
+    body = text.encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", content_type.encode()),
+            (b"content-length", str(len(body)).encode()),
+        ] + _asgi_headers(headers or {}),
+    })
+    await send({"type": "http.response.body", "body": body})
+
+async def async_upstream_body(upstream, chunk_size, skip=0, length=None):
+    """Async counterpart of relay_chunks - network reads are coalesced into one
+    reused buffer up to the adaptive chunk size before each send"""
+    sizer = RelayChunkSizer(chunk_size)
+    stream = relay_memory.open()
+    buffer = bytearray()
+    started = time.perf_counter()
+    try:
+        async for chunk in upstream.aiter_bytes():
+            UPSTREAM_READ_BYTES.inc(len(chunk))
+            if skip:
+                if len(chunk) <= skip:
+                    skip -= len(chunk)
+                    continue
+                chunk = chunk[skip:]
+                skip = 0
+            if length is not None:
+                chunk = chunk[:length]
+                length -= len(chunk)
+            
+            buffer += chunk
+            relay_memory.resize(stream, len(buffer))
+            if len(buffer) >= sizer.size or length == 0:
+                data = bytes(buffer)
+                buffer.clear()
+                relay_memory.resize(stream, len(data))
+                yield data
+                sizer.observe(len(data), time.perf_counter() - started)
+                started = time.perf_counter()
+            if length == 0:
+                return
+        if buffer:
+            yield bytes(buffer)
+    finally:
+        relay_memory.close(stream)
+        await upstream.aclose()
+
+async def async_cached_range_chunks(video_url, mode, start, end, info, chunk_size, viewer=None, session_id=None):
+    """Async counterpart of cached_range_chunks - disk I/O, including the cache
+    lookups of the planner and read-ahead, runs on the default executor"""
+    loop = asyncio.get_running_loop()
+    key = resource_key(video_url, info)
+    size = info["size"]
+    seg_size = segment_cache.segment_size
+    plan = plan_segments(key, start, end, size, max_run=1 if viewer else None)
+    
+    while True:
+        step = await loop.run_in_executor(None, next, plan, None)
+        if step is None:
+            break
+        if step[0] == "wait":
+            await read_ahead.async_wait(step[2])
+            continue
+        if viewer:
+            await loop.run_in_executor(None, read_ahead.observe, viewer, video_url, key, step[1], size)
+        
+        if step[0] == "hit":
+            _, seg, path = step
+            lo, hi = cached_slice(seg, start, end, size)
+            offset = seg * seg_size + lo
+            reader = read_segment_file(path, lo, hi, chunk_size)
+            try:
+                while True:
+                    data = await loop.run_in_executor(None, next, reader, None)
+                    if data is None:
+                        break
+                    offset += len(data)
+                    segment_cache.count("bytes_from_cache", len(data))
+                    yield data
+                continue
+            except OSError:
+                segment_cache.forget(key, seg)
+                start = offset
+                step = ("miss", seg, seg, seg * seg_size, seg * seg_size + segment_cache.segment_length(seg, size) - 1)
+            finally:
+                reader.close()
+        
+        _, first_seg, _, fetch_start, fetch_end = step
+        fill = SegmentFill(key, first_seg, fetch_start, start, end, size)
+        chunks = async_fetch_range_chunks(video_url, mode, fetch_start, fetch_end, chunk_size, session_id, key)
+        try:
+            async for chunk in chunks:
+                # feed() may write a finished segment to disk
+                out = await loop.run_in_executor(None, fill.feed, chunk)
+                if out:
+                    yield out
+        finally:
+            fill.close()
+            await chunks.aclose()
+
+def async_fetch_range_chunks(video_url, mode, fetch_start, fetch_end, chunk_size, session_id=None, key=None):
+    """Async counterpart of fetch_range_chunks (single or shared connection)"""
+    return async_failover_chunks(video_url, mode, fetch_start, fetch_end, chunk_size, session_id, key=key)
+
+def async_open_range_chunks(video_url, mode, fetch_start, fetch_end, chunk_size, key=None):
+    """Async counterpart of open_range_chunks, without the parallel fetcher"""
+    if fanout is not None:
+        return fanout.async_chunks(video_url, mode, fetch_start, fetch_end, chunk_size, key)
+    return async_single_range_chunks(video_url, mode, fetch_start, fetch_end, chunk_size)
+
+async def async_failover_chunks(video_url, mode, start, end, chunk_size, session_id, chunks=None, key=None):
+    """Async counterpart of failover_chunks (see async_failover_plan)"""
+    pos = start
+    if chunks is None:
+        chunks = async_open_range_chunks(video_url, mode, start, end, chunk_size, key)
+    try:
+        while True:
+            try:
+                async for chunk in chunks:
+                    pos += len(chunk)
+                    yield chunk
+                if pos <= end:
+                    raise IOError(f"Upstream body ended at byte {pos}, expected {end + 1}")
+                return
+            except UPSTREAM_FAILURES as e:
+                await chunks.aclose()
+                resume_url = await async_failover_plan(session_id, video_url, pos, e)
+                if resume_url is None:
+                    failover_budget.count("failed")
+                    raise
+                video_url = resume_url
+                failover_budget.count("resumed")
+                chunks = async_open_range_chunks(video_url, mode, pos, end, chunk_size, key)
+    finally:
+        await chunks.aclose()
+
+async def async_single_range_chunks(video_url, mode, fetch_start, fetch_end, chunk_size):
+    """Async counterpart of single_range_chunks"""
+    range_value = f"bytes={fetch_start}-{fetch_end}"
+    if mode == "stream":
+        upstream = await async_open_stream_upstream(video_url, range_value)
+    else:
+        upstream = await async_open_download_upstream(video_url, range_value)
+    
+    if not segment_fetch_accepted(upstream.status_code, upstream.headers, fetch_start):
+        await async_discard_response(upstream)
+        raise UpstreamRefused(f"Upstream refused range {fetch_start}-{fetch_end}", upstream.status_code)
+    
+    async for chunk in async_upstream_body(upstream, chunk_size, 0, fetch_end - fetch_start + 1):
+        yield chunk
+
+async def _asgi_relay(receive, send, status, headers, chunks, mode):
+    """Pump an async byte iterator to the client until either side is done"""
+    disconnected = asyncio.Event()
+    
+    async def watch_disconnect():
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                disconnected.set()
+                return
+    
+    labels = (mode,)
+    watcher = asyncio.create_task(watch_disconnect())
+    try:
+        await send({"type": "http.response.start", "status": status, "headers": _asgi_headers(headers)})
+        async for chunk in chunks:
+            if disconnected.is_set():
+                return
+            delay = stream_budget.charge(len(chunk))
+            if delay:
+                await asyncio.sleep(delay)
+            RELAYED_BYTES.inc(len(chunk), labels)
+            # send() waits for the transport, so a slow client throttles the upstream read
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+    except Exception as e:
+        if not disconnected.is_set():
+            print(f"Async relay error: {e}")
+    finally:
+        watcher.cancel()
+        await chunks.aclose()
+
+async def _asgi_send_empty(send, status, headers):
+    await send({"type": "http.response.start", "status": status, "headers": _asgi_headers(headers)})
+    await send({"type": "http.response.body", "body": b""})
+
+async def async_discard_response(upstream):
+    try:
+        if int(upstream.headers.get('Content-Length') or 0) <= 65536:
+            await upstream.aread()
+    except Exception:
+        pass
+    finally:
+        await upstream.aclose()
+
+async def async_open_stream_upstream(video_url, range_value):
+    """Async counterpart of open_stream_upstream"""
+    profiles = header_profiles.order(video_url)
+    for attempt, profile in enumerate(profiles, 1):
+        upstream = await async_upstream_get(
+            video_url, {**STREAM_HEADER_PROFILES[profile], 'Range': range_value}
+        )
+        rejected = profile_rejected(upstream.status_code)
+        header_profiles.record(video_url, profile, not rejected)
+        if not rejected or attempt == len(profiles):
+            if upstream.status_code in URL_EXPIRED_STATUSES:
+                # Re-resolving calls Apify, keep it off the event loop
+                await asyncio.get_running_loop().run_in_executor(None, url_refresher.url_rejected, video_url)
+            elif upstream.status_code < 300:
+                url_refresher.url_served(video_url)
+            return upstream
+        HEADER_FALLBACKS.inc(labels=(str(upstream.status_code),))
+        await async_discard_response(upstream)
+
+async def async_open_download_upstream(video_url, range_value):
+    upstream = await async_upstream_get(
+        video_url,
+        {**DOWNLOAD_HEADERS, 'Range': range_value},
+        read_timeout=UPSTREAM_DOWNLOAD_READ_TIMEOUT
+    )
+    if upstream.status_code in URL_EXPIRED_STATUSES:
+        await asyncio.get_running_loop().run_in_executor(None, url_refresher.url_rejected, video_url)
+    elif upstream.status_code < 300:
+        url_refresher.url_served(video_url)
+    return upstream
+
+async def asgi_proxy_range_request(scope, receive, send, video_url, mode, filename=None, session_id=None):
+    """Async counterpart of proxy_range_request"""
+    PROXY_REQUESTS.inc(labels=(mode,))
+    reason = stream_budget.admit()
+    if reason:
+        PROXY_REJECTED.inc(labels=(reason,))
+        return await _asgi_send_text(
+            send, 503, f"Server busy ({reason}), retry shortly", "text/plain; charset=utf-8",
+            {'Retry-After': str(STREAM_RETRY_AFTER), 'Cache-Control': 'no-store'}
+        )
+    try:
+        await asgi_serve_range_request(scope, receive, send, video_url, mode, filename, session_id)
+    finally:
+        stream_budget.release()
+
+async def asgi_serve_range_request(scope, receive, send, video_url, mode, filename=None, session_id=None):
+    """Async counterpart of serve_range_request"""
+    viewer = session_id if mode == "stream" and read_ahead is not None else None
+    request_headers = _asgi_request_headers(scope)
+    is_head = scope["method"] == "HEAD"
+    
+    info = resource_info.get(video_url)
+    if info is None and (is_head or request_headers.get('if-range')):
+        upstream = await async_open_stream_upstream(video_url, 'bytes=0-0')
+        info = learn_resource_info(video_url, upstream.status_code, upstream.headers)
+        await async_discard_response(upstream)
+    
+    byte_range, window, upstream_range = plan_client_range(
+        request_headers.get('range'), request_headers.get('if-range'), info
+    )
+    
+    if window == "unsatisfiable":
+        return await _asgi_send_empty(send, 416, unsatisfiable_headers(info["size"]))
+    
+    if window is not None and is_head:
+        status, start, end = window
+        return await _asgi_send_empty(
+            send, status, range_response_headers(mode, status, start, end, info, filename=filename)
+        )
+    
+    chunk_size = STREAM_CHUNK_SIZE if mode == "stream" else DOWNLOAD_CHUNK_SIZE
+    
+    if window is not None and segment_cache is not None:
+        status, start, end = window
+        headers = range_response_headers(mode, status, start, end, info, filename=filename)
+        headers.pop('Connection', None)
+        return await _asgi_relay(
+            receive, send, status, headers,
+            async_cached_range_chunks(video_url, mode, start, end, info, chunk_size, viewer, session_id),
+            mode
+        )
+    
+    if window is not None and fanout is not None:
+        status, start, end = window
+        headers = range_response_headers(mode, status, start, end, info, filename=filename)
+        headers.pop('Connection', None)
+        return await _asgi_relay(
+            receive, send, status, headers,
+            async_fetch_range_chunks(video_url, mode, start, end, chunk_size, session_id, resource_key(video_url, info)),
+            mode
+        )
+    
+    if mode == "stream":
+        upstream = await async_open_stream_upstream(video_url, upstream_range)
+    else:
+        upstream = await async_open_download_upstream(video_url, upstream_range)
+    
+    try:
+        outcome, detail = plan_upstream_response(
+            video_url, byte_range, upstream.status_code, upstream.headers
+        )
+    except Exception:
+        await async_discard_response(upstream)
+        raise
+    
+    if outcome == "unsatisfiable":
+        await async_discard_response(upstream)
+        return await _asgi_send_empty(send, 416, unsatisfiable_headers(detail))
+    
+    if outcome == "passthrough":
+        if mode == "download":
+            if upstream.is_error:
+                await async_discard_response(upstream)
+            upstream.raise_for_status()
+            headers = download_response_headers(filename, int(upstream.headers.get('content-length', 0)))
+            if headers['Content-Length'] == '':
+                headers.pop('Content-Length')
+            headers.pop('Connection')
+        else:
+            headers = stream_response_headers(upstream.headers)
+        if is_head:
+            await async_discard_response(upstream)
+            return await _asgi_send_empty(send, upstream.status_code, headers)
+        return await _asgi_relay(
+            receive, send, upstream.status_code, headers, async_upstream_body(upstream, chunk_size), mode
+        )
+    
+    status, start, end, skip, info = detail
+    headers = range_response_headers(mode, status, start, end, info, upstream.headers, filename)
+    headers.pop('Connection', None)
+    if is_head:
+        await async_discard_response(upstream)
+        return await _asgi_send_empty(send, status, headers)
+    
+    await _asgi_relay(
+        receive, send, status, headers,
+        async_failover_chunks(
+            video_url, mode, start, end, chunk_size, session_id,
+            async_upstream_body(upstream, chunk_size, skip, end - start + 1)
+        ),
+        mode
+    )
+
+async def async_get_session(session_id):
+    """get_session off the event loop - a store lookup may wait on disk or a locked db"""
+    if SESSION_MODE == "token":
+        # Only a signature check, no I/O
+        return get_session(session_id)
+    return await asyncio.get_running_loop().run_in_executor(None, get_session, session_id)
+
+async def asgi_stream(scope, receive, send, session_id):
+    """Async counterpart of stream_video"""
+    session = await async_get_session(session_id)
+    
+    if not session:
+        return await _asgi_send_text(send, 404, "Session expired")
+    
+    url_refresher.touch(session_id, session)
+    
+    try:
+        await asgi_proxy_range_request(scope, receive, send, session["download_url"], "stream", session_id=session_id)
+    except Exception as e:
+        print(f"Stream error: {str(e)}")
+        return await _asgi_send_text(send, 500, f"Streaming error: {str(e)}")
+
+async def asgi_download(scope, receive, send, session_id):
+    """Async counterpart of download_video"""
+    session = await async_get_session(session_id)
+    
+    if not session:
+        return await _asgi_send_text(send, 404, "Session expired")
+    
+    url_refresher.touch(session_id, session)
+    
+    video_url = session["download_url"]
+    filename = session.get("filename", "terabox_video.mp4")
+    
+    try:
+        await asgi_proxy_range_request(scope, receive, send, video_url, "download", filename, session_id)
+    except Exception as e:
+        print(f"Download error: {str(e)}")
+        return await _asgi_send_text(send, 200, download_fallback_html(video_url))
+
+def _asgi_to_environ(scope, body):
+    """Minimal PEP 3333 environ for running the Flask app under ASGI"""
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    if scope.get("client"):
+        environ["REMOTE_ADDR"] = scope["client"][0]
+    
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1")
+        value = value.decode("latin-1")
+        if name == "content-length":
+            continue
+        if name == "content-type":
+            environ["CONTENT_TYPE"] = value
+            continue
+        key = "HTTP_" + name.upper().replace("-", "_")
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    
+    return environ
+
+async def asgi_wsgi_bridge(scope, receive, send):
+    """Run a request through the Flask app on the bridge thread pool"""
+    body = b""
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get("body", b"")
+        more_body = message.get("more_body", False)
+    
+    loop = asyncio.get_running_loop()
+    started = {}
+    
+    def start_response(status, headers, exc_info=None):
+        started["status"] = int(status.split(" ", 1)[0])
+        started["headers"] = headers
+        return lambda data: None
+    
+    result = await loop.run_in_executor(wsgi_bridge_pool, app, _asgi_to_environ(scope, body), start_response)
+    iterator = iter(result)
+    try:
+        await send({
+            "type": "http.response.start",
+            "status": started["status"],
+            "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in started["headers"]],
+        })
+        while True:
+            chunk = await loop.run_in_executor(wsgi_bridge_pool, next, iterator, None)
+            if chunk is None:
+                break
+            if chunk:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+    finally:
+        if hasattr(result, "close"):
+            await loop.run_in_executor(wsgi_bridge_pool, result.close)
+
+async def asgi_app(scope, receive, send):
+    """ASGI entry point - async relay for /stream and /download, Flask for the rest"""
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if async_upstream["client"] is not None:
+                    await async_upstream["client"].aclose()
+                    async_upstream["client"] = None
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    
+    if scope["type"] != "http":
+        return
+    
+    parts = scope["path"].strip("/").split("/")
+    if scope["method"] in ("GET", "HEAD") and len(parts) == 2:
+        if parts[0] == "stream":
+            return await asgi_stream(scope, receive, send, parts[1])
+        if parts[0] == "download":
+            return await asgi_download(scope, receive, send, parts[1])
+    
+    await asgi_wsgi_bridge(scope, receive, send)
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
     print(f"🚀 Starting Terabox Video Proxy on port {port}")
@@ -0,0 +1,519 @@
+"""Throughput of bot.py against a local fake Telegram Bot API.
+
+Starts two things:
+
+  fake API  - HTTP server implementing getMe, getUpdates, sendMessage,
+              editMessageText, getChatMember and copyMessage, with optional
+              per-call latency and random 429 (retry_after) responses
+  bot       - the real Application from bot.build_application(), polling the
+              fake API from a scratch directory so no real user data is touched
+
+The fake API hands out synthetic traffic (Terabox links, /start and junk text
+from a pool of users) at a fixed arrival rate, then a /broadcast from the
+admin to a pre-seeded user table. Reports updates/s, first-reply latency
+percentiles (update delivered -> first sendMessage to that chat), handler
+latency, Bot API calls per update and broadcast completion time, as JSON.
+
+With --workers N the bot runs as `BOT_WORKERS=N python bot.py` instead (front
+end plus N worker processes); per-handler timings then stay in those processes.
+
+Usage:
+    python benchmarks/bot_throughput_bench.py --updates 2000 --users 500
+    python benchmarks/bot_throughput_bench.py --workers 4 --api-latency-ms 20
+    python benchmarks/bot_throughput_bench.py --api-latency-ms 50 --rate-limit-rate 0.02
+    python benchmarks/bot_throughput_bench.py --updates 0 --broadcast-users 100000
+"""
+import argparse
+import asyncio
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCH_DIR)
+
+BOT_TOKEN = "123456:bench"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+FIRST_USER_ID = 10 ** 9
+
+# ============= SYNTHETIC TRAFFIC =============
+
+def synthetic_text(rng, link_ratio, start_ratio):
+    roll = rng.random()
+    if roll < link_ratio:
+        surl = "".join(rng.choice("abcdefghijklmnopqrstuvwxyz0123456789") for _ in range(22))
+        return f"https://www.terabox.com/s/1{surl}"
+    if roll < link_ratio + start_ratio:
+        return "/start"
+    return "hello, is this thing on?"
+
+def message_json(message_id, user_id, text, reply_to=None):
+    message = {
+        "message_id": message_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    if reply_to is not None:
+        message["reply_to_message"] = reply_to
+    return message
+
+# ============= FAKE BOT API =============
+
+def run_fake_api(port, args, admin_id):
+    """Serve the Bot API subset bot.py uses until killed"""
+    rng = random.Random(args.seed)
+    latency = args.api_latency_ms / 1000
+    lock = threading.Condition()
+
+    state = {
+        "updates": [],          # update dicts, update_id == index
+        "released": 0,          # how many of them getUpdates may hand out
+        "traffic": 0,           # synthetic updates queued by /_control/start
+        "arrival_start": None,
+        "delivered": {},        # update_id -> first delivery time
+        "first_delivery": None,
+        "last_reply": None,
+        "calls": defaultdict(int),
+        "rate_limited": defaultdict(int),
+        "reply_latencies": [],
+        "broadcast_started": None,
+        "broadcast_finished": None,
+        "copies": 0,
+    }
+    awaiting_reply = defaultdict(deque)  # chat_id -> delivery times of unanswered updates
+    message_ids = iter(range(1, 1 << 62))
+
+    def release():
+        """Expose the updates whose arrival time has come (caller holds the lock)"""
+        if state["arrival_start"] is None:
+            return
+        if args.rate:
+            due = int((time.time() - state["arrival_start"]) * args.rate) + 1
+            traffic_released = min(state["traffic"], due)
+        else:
+            traffic_released = state["traffic"]
+        state["released"] = max(state["released"], traffic_released)
+
+    def queue_traffic():
+        users = [FIRST_USER_ID + i for i in range(args.users)]
+        for _ in range(args.updates):
+            update_id = len(state["updates"])
+            user_id = rng.choice(users)
+            text = synthetic_text(rng, args.link_ratio, args.start_ratio)
+            state["updates"].append({"update_id": update_id, "message": message_json(update_id + 1, user_id, text)})
+        state["traffic"] = len(state["updates"])
+        state["arrival_start"] = time.time()
+
+    def queue_broadcast():
+        update_id = len(state["updates"])
+        announcement = message_json(10 ** 6, admin_id, "Scheduled maintenance tonight")
+        state["updates"].append({
+            "update_id": update_id,
+            "message": message_json(10 ** 6 + 1, admin_id, "/broadcast", reply_to=announcement),
+        })
+        state["traffic"] = len(state["updates"])
+        state["released"] = state["traffic"]
+        state["broadcast_started"] = time.time()
+
+    def sent_message(chat_id, text):
+        return {
+            "message_id": next(message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "from": BOT_USER,
+            "text": text or "",
+        }
+
+    def get_updates(params):
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        deadline = time.time() + min(float(params.get("timeout") or 0), 1.0)
+        with lock:
+            while True:
+                release()
+                if state["released"] > offset:
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return []
+                lock.wait(min(remaining, 0.005 if state["arrival_start"] else remaining))
+            batch = state["updates"][offset:min(state["released"], offset + limit)]
+            now = time.time()
+            for update in batch:
+                if update["update_id"] not in state["delivered"]:
+                    state["delivered"][update["update_id"]] = now
+                    state["first_delivery"] = state["first_delivery"] or now
+                    awaiting_reply[update["message"]["chat"]["id"]].append(now)
+            return batch
+
+    def call(method, params):
+        if method == "getUpdates":
+            return get_updates(params)
+        if latency:
+            time.sleep(latency)
+        if method == "getMe":
+            return BOT_USER
+        if method in ("deleteWebhook", "answerCallbackQuery"):
+            return True
+        if method == "sendMessage":
+            with lock:
+                now = time.time()
+                waiting = awaiting_reply.get(int(params["chat_id"]))
+                if waiting:
+                    state["reply_latencies"].append(now - waiting.popleft())
+                state["last_reply"] = now
+            return sent_message(params["chat_id"], params.get("text"))
+        if method == "editMessageText":
+            text = params.get("text") or ""
+            if "Broadcast Complete" in text:
+                with lock:
+                    state["broadcast_finished"] = time.time()
+            return sent_message(params["chat_id"], text)
+        if method == "getChatMember":
+            user_id = int(params["user_id"])
+            status = "left" if rng.random() < args.left_rate else "member"
+            return {"status": status, "user": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}}
+        if method == "copyMessage":
+            with lock:
+                state["copies"] += 1
+            return {"message_id": next(message_ids)}
+        if method == "getChat":
+            return {"id": int(params["chat_id"]), "type": "channel", "title": "Bench channel"}
+        return None
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # headers and body go out as two writes; without this every call eats a delayed ACK
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def _reply(self, payload, status=200):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            try:
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                # a long poll cut short by the bot shutting down
+                pass
+
+        def _params(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            raw = self.rfile.read(length) if length else b""
+            params = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+            if "json" in (self.headers.get("Content-Type") or ""):
+                params.update(json.loads(raw or b"{}"))
+            else:
+                params.update({k: v[0] for k, v in parse_qs(raw.decode()).items()})
+            return params
+
+        def do_GET(self):
+            self.do_POST()
+
+        def do_POST(self):
+            path = urlparse(self.path).path
+            params = self._params()
+            if path == "/_control/start":
+                with lock:
+                    queue_traffic()
+                    lock.notify_all()
+                return self._reply(True)
+            if path == "/_control/broadcast":
+                with lock:
+                    queue_broadcast()
+                    lock.notify_all()
+                return self._reply(True)
+            if path == "/_stats":
+                with lock:
+                    return self._reply({k: v for k, v in state.items() if k not in ("updates", "delivered")})
+
+            method = path.rsplit("/", 1)[-1]
+            with lock:
+                state["calls"][method] += 1
+            if method != "getUpdates" and args.rate_limit_rate and rng.random() < args.rate_limit_rate:
+                with lock:
+                    state["rate_limited"][method] += 1
+                return self._reply({
+                    "ok": False,
+                    "error_code": 429,
+                    "description": f"Too Many Requests: retry after {args.retry_after}",
+                    "parameters": {"retry_after": args.retry_after},
+                }, status=429)
+            self._reply({"ok": True, "result": call(method, params)})
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    server.serve_forever()
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise SystemExit(f"nothing listening on port {port}")
+
+def control(port, path):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    conn.request("POST", path, body=b"", headers={"Content-Length": "0"})
+    payload = json.loads(conn.getresponse().read())
+    conn.close()
+    return payload
+
+# ============= BOT =============
+
+def seed_bot_files(workdir, args):
+    """user_data.json with `--broadcast-users` users and `--force-channels` channels"""
+    now = time.strftime("%Y-%m-%dT%H:%M:%S+05:30")
+    users = {
+        str(FIRST_USER_ID + args.users + i): {"first_seen": now, "last_seen": now, "total_queries": 1}
+        for i in range(args.broadcast_users)
+    }
+    with open(os.path.join(workdir, "user_data.json"), "w") as f:
+        json.dump({"users": users, "total_users": len(users), "last_24h_users": 0, "last_update": None}, f)
+    channels = [
+        {"id": -1000000000000 - i, "title": f"Channel {i}", "invite_link": f"https://t.me/+bench{i}"}
+        for i in range(args.force_channels)
+    ]
+    with open(os.path.join(workdir, "force_channels.json"), "w") as f:
+        json.dump(channels, f)
+
+def handler_count(bot, names):
+    return sum(
+        timer["count"] for (kind, name), timer in bot.bot_metrics.timers.items()
+        if kind == "handler" and name in names
+    )
+
+async def wait_until(condition, timeout, poll=0.02):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        await asyncio.sleep(poll)
+    return True
+
+async def run_bot(bot, args, port):
+    bot.BROADCAST_DELAY = args.broadcast_delay
+    application = bot.build_application(token=BOT_TOKEN, base_url=f"http://127.0.0.1:{port}/bot")
+
+    startup_started = time.perf_counter()
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+    await application.updater.start_polling(poll_interval=0, timeout=1)
+    startup = time.perf_counter() - startup_started
+
+    result = {"startup_seconds": round(startup, 3)}
+    traffic_handlers = ("start", "handle_message")
+    try:
+        if args.updates:
+            control(port, "/_control/start")
+            finished = await wait_until(lambda: handler_count(bot, traffic_handlers) >= args.updates, args.timeout)
+            result["traffic_finished"] = finished
+            result["traffic_stats"] = control(port, "/_stats")
+        if args.broadcast_users:
+            api_calls_before = sum(t["count"] for (kind, _), t in bot.bot_metrics.timers.items() if kind == "api")
+            control(port, "/_control/broadcast")
+            finished = await wait_until(lambda: handler_count(bot, ("admin_broadcast",)) >= 1, args.timeout, poll=0.1)
+            result["broadcast_returned"] = finished
+            result["broadcast_api_calls"] = sum(
+                t["count"] for (kind, _), t in bot.bot_metrics.timers.items() if kind == "api"
+            ) - api_calls_before
+    finally:
+        await application.updater.stop()
+        await application.stop()
+        await application.post_shutdown(application)
+        await application.shutdown()
+
+    result["handlers"] = {
+        name: bot.bot_metrics.summary(kind, name)
+        for (kind, name) in sorted(bot.bot_metrics.timers) if kind in ("handler", "step", "wait")
+    }
+    result["api"] = {
+        name: bot.bot_metrics.summary(kind, name)
+        for (kind, name) in sorted(bot.bot_metrics.timers) if kind == "api"
+    }
+    result["api_rate_limited"] = bot.bot_metrics.counters["api_rate_limited"]
+    return result
+
+def run_bot_process(args, port, workdir):
+    """bot.py in multi-process mode (BOT_WORKERS=--workers) as a subprocess"""
+    env = dict(os.environ, BOT_WORKERS=str(args.workers), BOT_API_URL=f"http://127.0.0.1:{port}/bot", BOT_METRICS_PORT="0")
+    started = time.time()
+    proc = subprocess.Popen([sys.executable, os.path.join(REPO_ROOT, "bot.py")], cwd=workdir, env=env, stdout=sys.stderr)
+
+    def api_stats():
+        return control(port, "/_stats")
+
+    def poll(condition, timeout):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if proc.poll() is not None:
+                raise SystemExit(f"bot.py exited with {proc.returncode}")
+            if condition(api_stats()):
+                return True
+            time.sleep(0.05)
+        return False
+
+    result = {"handlers": {}, "api": {}, "api_rate_limited": None}
+    try:
+        # the front end and every worker call getMe in initialize(), workers once more in post_init
+        poll(lambda stats: stats["calls"].get("getMe", 0) >= 2 * args.workers + 1, 120)
+        result["startup_seconds"] = round(time.time() - started, 3)
+        if args.updates:
+            control(port, "/_control/start")
+            result["traffic_finished"] = poll(lambda stats: len(stats["reply_latencies"]) >= args.updates, args.timeout)
+            result["traffic_stats"] = api_stats()
+        if args.broadcast_users:
+            calls_before = sum(api_stats()["calls"].values())
+            control(port, "/_control/broadcast")
+            result["broadcast_returned"] = poll(lambda stats: stats["broadcast_finished"] is not None, args.timeout)
+            result["broadcast_api_calls"] = sum(api_stats()["calls"].values()) - calls_before
+    finally:
+        proc.send_signal(signal.SIGINT)
+        try:
+            proc.wait(60)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+    return result
+
+# ============= REPORT =============
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(len(values) * q))]
+    return {
+        "p50": round(pick(0.5) * 1000, 2),
+        "p90": round(pick(0.9) * 1000, 2),
+        "p99": round(pick(0.99) * 1000, 2),
+        "max": round(values[-1] * 1000, 2),
+    }
+
+def rounded(summary):
+    return {k: round(v, 2) if isinstance(v, float) else v for k, v in summary.items()} if summary else None
+
+def report(args, bot_result, api_stats):
+    calls = api_stats["calls"]
+    output = {
+        "benchmark": "bot_throughput",
+        "workers": args.workers,
+        "api_latency_ms": args.api_latency_ms,
+        "rate_limit_rate": args.rate_limit_rate,
+        "startup_seconds": bot_result["startup_seconds"],
+    }
+    if args.updates:
+        traffic = bot_result["traffic_stats"]
+        seconds = (traffic["last_reply"] or time.time()) - traffic["first_delivery"]
+        traffic_calls = sum(n for method, n in traffic["calls"].items() if method not in ("getUpdates", "getMe", "deleteWebhook"))
+        output["traffic"] = {
+            "updates": args.updates,
+            "users": args.users,
+            "arrival_rate": args.rate or "burst",
+            "completed": bot_result.get("traffic_finished"),
+            "seconds": round(seconds, 3),
+            "updates_per_s": round(args.updates / seconds, 1) if seconds > 0 else None,
+            "first_reply_ms": percentiles(traffic["reply_latencies"]),
+            "handle_message_ms": rounded(bot_result["handlers"].get("handle_message")),
+            # sendMessage, editMessageText and getChatMember (429s included) per synthetic update
+            "api_calls_per_update": round(traffic_calls / args.updates, 2),
+        }
+    if args.broadcast_users:
+        handler = bot_result["handlers"].get("admin_broadcast")
+        finished = api_stats["broadcast_finished"]
+        # a 429 on a progress edit aborts the handler, so fall back to how long it ran
+        seconds = finished - api_stats["broadcast_started"] if finished else handler and handler["avg_ms"] / 1000
+        aborted = bool(handler and handler["errors"]) or not bot_result.get("broadcast_returned")
+        output["broadcast"] = {
+            "seeded_users": args.broadcast_users,
+            "completed": finished is not None,
+            "aborted": aborted,
+            "seconds": round(seconds, 3) if seconds else None,
+            "users_per_s": round(api_stats["copies"] / seconds, 1) if seconds else None,
+            "copy_calls": api_stats["copies"],
+            "api_calls": bot_result.get("broadcast_api_calls"),
+        }
+    output["api_calls"] = dict(sorted(calls.items()))
+    output["injected_429s"] = dict(sorted(api_stats["rate_limited"].items()))
+    output["bot_saw_429s"] = bot_result["api_rate_limited"]
+    output["handlers"] = {name: rounded(summary) for name, summary in bot_result["handlers"].items()}
+    output["api_ms"] = {name: rounded(summary) for name, summary in bot_result["api"].items()}
+    return output
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--updates", type=int, default=2000, help="synthetic user updates to replay")
+    parser.add_argument("--users", type=int, default=500, help="distinct users sending them")
+    parser.add_argument("--rate", type=float, default=0, help="arrival rate in updates/s (0 = all at once)")
+    parser.add_argument("--link-ratio", type=float, default=0.8, help="share of updates that are Terabox links")
+    parser.add_argument("--start-ratio", type=float, default=0.1, help="share of updates that are /start")
+    parser.add_argument("--force-channels", type=int, default=1, help="channels checked with getChatMember")
+    parser.add_argument("--left-rate", type=float, default=0, help="share of getChatMember answers saying 'left'")
+    parser.add_argument("--broadcast-users", type=int, default=1000, help="seeded users for the /broadcast (0 = skip)")
+    parser.add_argument("--broadcast-delay", type=float, default=0.1, help="BROADCAST_DELAY between batches (in-process only)")
+    parser.add_argument("--api-latency-ms", type=float, default=0, help="added to every Bot API call except getUpdates")
+    parser.add_argument("--rate-limit-rate", type=float, default=0, help="share of Bot API calls answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=600, help="give up on a phase after this many seconds")
+    parser.add_argument("--workers", type=int, default=1, help="> 1 runs bot.py as a subprocess with BOT_WORKERS")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    os.environ["BOT_METRICS_PORT"] = "0"
+    sys.path.insert(0, REPO_ROOT)
+    import bot
+
+    port = free_port()
+    api = multiprocessing.Process(target=run_fake_api, args=(port, args, bot.ADMIN_IDS[0]), daemon=True)
+    api.start()
+    workdir = tempfile.mkdtemp(prefix="bot_bench_")
+    cwd = os.getcwd()
+    try:
+        wait_for_port(port)
+        seed_bot_files(workdir, args)
+        if args.workers > 1:
+            bot_result = run_bot_process(args, port, workdir)
+        else:
+            # bot.py keeps user_data.json / force_channels.json relative to the working directory
+            os.chdir(workdir)
+            bot_result = asyncio.run(run_bot(bot, args, port))
+        api_stats = control(port, "/_stats")
+    finally:
+        os.chdir(cwd)
+        api.terminate()
+        api.join()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps(report(args, bot_result, api_stats), indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,543 @@
+"""Load test of the streaming proxy against a local fake Terabox CDN.
+
+Starts three things:
+
+  fake CDN  - range-capable HTTP/1.1 server holding one synthetic file, with
+              optional per-connection throttling, random 403s and link expiry
+  proxy     - api/flask_api.py under gunicorn, uvicorn or werkzeug, with the
+              Apify resolver replaced by a stub that hands out CDN links
+  clients   - threads driving /process, /stream (player-style sequential
+              ranges) and /download at a fixed concurrency
+
+and reports requests/s, TTFB percentiles, sustained MB/s, proxy CPU seconds
+per GB relayed and proxy memory per concurrent stream (Linux /proc), as JSON.
+
+Usage:
+    python benchmarks/proxy_load_bench.py --server gunicorn --concurrency 16
+    python benchmarks/proxy_load_bench.py --server uvicorn --cdn-mbps 4 --forbid-rate 0.05
+    python benchmarks/proxy_load_bench.py --env SEGMENT_CACHE_ENABLED=0 --env FANOUT_ENABLED=0
+"""
+import argparse
+import hashlib
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCH_DIR)
+
+# ============= FAKE CDN =============
+
+def synthetic_file(size, seed):
+    return random.Random(seed).randbytes(size)
+
+def run_cdn(port, size, seed, mbps, forbid_rate, link_ttl):
+    """Serve one synthetic file at every /file/<name> path until killed"""
+    data = synthetic_file(size, seed)
+    rate = mbps * 1024 * 1024 if mbps else 0
+    rng = random.Random(seed + 1)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _refuse(self, status):
+            self.send_response(status)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def _serve(self, send_body):
+            url = urlparse(self.path)
+            if not url.path.startswith("/file/"):
+                return self._refuse(404)
+            issued = int(parse_qs(url.query).get("time", ["0"])[0])
+            if link_ttl and time.time() - issued > link_ttl:
+                return self._refuse(403)
+            if forbid_rate and rng.random() < forbid_rate:
+                return self._refuse(403)
+
+            start, end = 0, size - 1
+            match = re.match(r"bytes=(\d*)-(\d*)", self.headers.get("Range") or "")
+            if match:
+                if match.group(1):
+                    start = int(match.group(1))
+                    end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+                else:
+                    start = max(0, size - int(match.group(2)))
+                if start >= size:
+                    self.send_response(416)
+                    self.send_header("Content-Range", f"bytes */{size}")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+            else:
+                self.send_response(200)
+            self.send_header("Content-Length", str(end - start + 1))
+            self.send_header("Content-Type", "video/mp4")
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("ETag", f'"{seed}-{size}"')
+            self.send_header("Last-Modified", "Wed, 21 Oct 2015 07:28:00 GMT")
+            self.end_headers()
+            if not send_body:
+                return
+
+            pos = start
+            started = time.perf_counter()
+            while pos <= end:
+                n = min(256 * 1024, end + 1 - pos)
+                self.wfile.write(data[pos:pos + n])
+                pos += n
+                if rate:
+                    # Hold the connection to `rate` bytes/s
+                    ahead = (pos - start) / rate - (time.perf_counter() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+
+        def do_GET(self):
+            try:
+                self._serve(True)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+        def do_HEAD(self):
+            self._serve(False)
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    server.serve_forever()
+
+# ============= PROXY UNDER TEST =============
+
+def _stubbed_proxy():
+    """Import the proxy with a stub resolver in place of Apify"""
+    sys.path.insert(0, REPO_ROOT)
+    from api import flask_api as proxy
+
+    cdn_url = os.environ["BENCH_CDN_URL"]
+    files = int(os.environ.get("BENCH_FILES", 1))
+    delay = float(os.environ.get("BENCH_RESOLVE_MS", 0)) / 1000
+
+    def resolve(terabox_url):
+        time.sleep(delay)
+        name = int(hashlib.sha1(terabox_url.encode()).hexdigest(), 16) % files
+        return f"{cdn_url}/file/video{name}.mp4?time={int(time.time())}&sign={uuid.uuid4().hex[:8]}"
+
+    proxy.get_terabox_download_url = resolve
+    return proxy
+
+def bench_app():
+    """WSGI app factory for gunicorn"""
+    return _stubbed_proxy().app
+
+def bench_asgi_app():
+    """ASGI app factory for uvicorn"""
+    return _stubbed_proxy().asgi_app
+
+def serve_werkzeug(port):
+    from werkzeug.serving import make_server
+    make_server("127.0.0.1", port, bench_app(), threaded=True).serve_forever()
+
+def proxy_command(server, port, workers, threads):
+    if server == "gunicorn":
+        return [
+            sys.executable, "-m", "gunicorn", "-w", str(workers), "--threads", str(threads),
+            "-b", f"127.0.0.1:{port}", "--pythonpath", BENCH_DIR, "--log-level", "warning",
+            "proxy_load_bench:bench_app()",
+        ]
+    if server == "uvicorn":
+        return [
+            sys.executable, "-m", "uvicorn", "--factory", "--app-dir", BENCH_DIR,
+            "--port", str(port), "--workers", str(workers), "--log-level", "warning",
+            "proxy_load_bench:bench_asgi_app",
+        ]
+    return [sys.executable, os.path.abspath(__file__), "--serve-werkzeug", str(port)]
+
+# ============= PROCESS ACCOUNTING (Linux /proc) =============
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+def process_tree(root_pid):
+    """root_pid and all its descendants"""
+    parents = {}
+    for name in os.listdir("/proc"):
+        if name.isdigit():
+            try:
+                with open(f"/proc/{name}/stat") as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+                parents[int(name)] = int(fields[1])
+            except (OSError, IndexError):
+                continue
+    tree = {root_pid}
+    grew = True
+    while grew:
+        grew = False
+        for pid, parent in parents.items():
+            if parent in tree and pid not in tree:
+                tree.add(pid)
+                grew = True
+    return tree
+
+def tree_usage(root_pid):
+    """(cpu_seconds, rss_bytes) of a process tree, or (None, None) without /proc"""
+    if not os.path.isdir("/proc"):
+        return None, None
+    cpu = 0.0
+    rss = 0
+    for pid in process_tree(root_pid):
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            cpu += (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        rss += int(line.split()[1]) * 1024
+        except (OSError, IndexError, ValueError):
+            continue
+    return cpu, rss
+
+class ResourceSampler:
+    """Samples the proxy's RSS while a scenario runs"""
+
+    def __init__(self, pid, interval=0.1):
+        self.pid = pid
+        self.interval = interval
+        self.peak_rss = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            _, rss = tree_usage(self.pid)
+            self.peak_rss = max(self.peak_rss, rss or 0)
+
+    def __enter__(self):
+        self.cpu_start, self.rss_start = tree_usage(self.pid)
+        self.peak_rss = self.rss_start or 0
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+        self.cpu_end, self.rss_end = tree_usage(self.pid)
+        self.peak_rss = max(self.peak_rss, self.rss_end or 0)
+
+# ============= CLIENTS =============
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(len(values) * q))]
+    return {
+        "p50": round(pick(0.5) * 1000, 2),
+        "p90": round(pick(0.9) * 1000, 2),
+        "p99": round(pick(0.99) * 1000, 2),
+        "max": round(values[-1] * 1000, 2),
+    }
+
+class ScenarioResult:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = {}
+        self.bytes = 0
+        self.ttfb = []
+        self.mismatches = 0
+
+    def record(self, ttfb=None, nbytes=0, error=None, mismatch=False):
+        with self.lock:
+            self.requests += 1
+            self.bytes += nbytes
+            if ttfb is not None:
+                self.ttfb.append(ttfb)
+            if error:
+                self.errors[error] = self.errors.get(error, 0) + 1
+            if mismatch:
+                self.mismatches += 1
+
+def timed_get(conn, path, headers, expected=None):
+    """GET on a keep-alive connection - (status, ttfb, body bytes, mismatch)"""
+    started = time.perf_counter()
+    conn.request("GET", path, headers=headers)
+    response = conn.getresponse()
+    first = response.read(64 * 1024)
+    ttfb = time.perf_counter() - started
+    received = len(first)
+    body = [first] if expected is not None else None
+    while True:
+        chunk = response.read(1024 * 1024)
+        if not chunk:
+            break
+        received += len(chunk)
+        if body is not None:
+            body.append(chunk)
+    mismatch = expected is not None and response.status in (200, 206) and b"".join(body) != expected
+    return response.status, ttfb, received, mismatch
+
+def run_workers(concurrency, jobs, work):
+    """Run `work(conn, job)` for every job on `concurrency` keep-alive connections"""
+    queue = list(jobs)
+    lock = threading.Lock()
+
+    def worker():
+        conn = http.client.HTTPConnection(*PROXY_ADDRESS, timeout=300)
+        while True:
+            with lock:
+                if not queue:
+                    break
+                job = queue.pop()
+            try:
+                work(conn, job)
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                conn = http.client.HTTPConnection(*PROXY_ADDRESS, timeout=300)
+        conn.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started
+
+PROXY_ADDRESS = ("127.0.0.1", 0)
+
+def scenario_process(args, result):
+    session_ids = []
+    lock = threading.Lock()
+
+    def work(conn, index):
+        body = json.dumps({"url": f"https://1024terabox.com/s/bench{index}"})
+        started = time.perf_counter()
+        conn.request("POST", "/process", body=body, headers={"Content-Type": "application/json"})
+        response = conn.getresponse()
+        payload = response.read()
+        latency = time.perf_counter() - started
+        if response.status != 200:
+            result.record(latency, error=str(response.status))
+            return
+        with lock:
+            session_ids.append(json.loads(payload)["session_id"])
+        result.record(latency, len(payload))
+
+    seconds = run_workers(args.concurrency, range(args.sessions), work)
+    return seconds, session_ids
+
+def scenario_stream(args, result, session_ids, data):
+    range_size = int(args.range_mb * 1024 * 1024)
+    per_viewer = min(int(args.stream_mb * 1024 * 1024), len(data))
+    viewers = [(i, session_ids[i % len(session_ids)]) for i in range(args.viewers)]
+
+    def work(conn, viewer):
+        index, session_id = viewer
+        # Viewers start at different points of the file, like real seeks
+        pos = (index * 7919 * range_size) % max(1, len(data) - per_viewer + 1)
+        stop = pos + per_viewer
+        while pos < stop:
+            end = min(pos + range_size, stop) - 1
+            expected = data[pos:end + 1] if args.verify else None
+            status, ttfb, received, mismatch = timed_get(
+                conn, f"/stream/{session_id}", {"Range": f"bytes={pos}-{end}"}, expected
+            )
+            if status != 206:
+                result.record(ttfb, received, error=str(status))
+                return
+            result.record(ttfb, received, mismatch=mismatch)
+            pos = end + 1
+
+    return run_workers(args.concurrency, viewers, work)
+
+def scenario_download(args, result, session_ids, data):
+    jobs = [session_ids[i % len(session_ids)] for i in range(args.downloads)]
+
+    def work(conn, session_id):
+        status, ttfb, received, mismatch = timed_get(
+            conn, f"/download/{session_id}", {}, data if args.verify else None
+        )
+        if status != 200:
+            result.record(ttfb, received, error=str(status))
+            return
+        result.record(ttfb, received, mismatch=mismatch)
+
+    return run_workers(args.concurrency, jobs, work)
+
+def summarize(name, result, seconds, sampler, concurrency):
+    gigabytes = result.bytes / 1024 ** 3
+    summary = {
+        "scenario": name,
+        "requests": result.requests,
+        "errors": result.errors,
+        "seconds": round(seconds, 3),
+        "requests_per_s": round(result.requests / seconds, 1) if seconds else None,
+        "ttfb_ms": percentiles(result.ttfb),
+        "bytes": result.bytes,
+        "mb_per_s": round(result.bytes / 1024 ** 2 / seconds, 1) if seconds else None,
+    }
+    if result.mismatches:
+        summary["corrupt_responses"] = result.mismatches
+    if sampler.cpu_start is not None:
+        cpu = sampler.cpu_end - sampler.cpu_start
+        summary["proxy_cpu_seconds"] = round(cpu, 3)
+        summary["proxy_cpu_seconds_per_gb"] = round(cpu / gigabytes, 3) if gigabytes > 0.001 else None
+        summary["proxy_rss_peak_mb"] = round(sampler.peak_rss / 1024 ** 2, 1)
+        summary["proxy_rss_per_stream_mb"] = round(
+            max(0, sampler.peak_rss - sampler.rss_start) / 1024 ** 2 / concurrency, 2
+        )
+    return summary
+
+# ============= MAIN =============
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def wait_for(port, path, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=2)
+            conn.request("GET", path)
+            conn.getresponse().read()
+            conn.close()
+            return
+        except (OSError, http.client.HTTPException):
+            time.sleep(0.2)
+    raise SystemExit(f"Nothing answered on port {port} within {timeout}s")
+
+def fetch_json(path):
+    conn = http.client.HTTPConnection(*PROXY_ADDRESS, timeout=10)
+    try:
+        conn.request("GET", path)
+        return json.loads(conn.getresponse().read())
+    except (OSError, ValueError, http.client.HTTPException):
+        return None
+    finally:
+        conn.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--server", choices=("gunicorn", "uvicorn", "werkzeug"), default="gunicorn")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=32, help="gunicorn threads per worker")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--sessions", type=int, default=32, help="/process calls")
+    parser.add_argument("--viewers", type=int, default=16, help="/stream viewers")
+    parser.add_argument("--stream-mb", type=float, default=16, help="bytes each viewer watches")
+    parser.add_argument("--range-mb", type=float, default=2, help="size of each player range request")
+    parser.add_argument("--downloads", type=int, default=4, help="full /download requests")
+    parser.add_argument("--file-mb", type=float, default=64)
+    parser.add_argument("--files", type=int, default=4, help="distinct files behind the share links")
+    parser.add_argument("--cdn-mbps", type=float, default=0, help="per-connection CDN throttle, 0 = unthrottled")
+    parser.add_argument("--forbid-rate", type=float, default=0, help="fraction of CDN GETs answered 403")
+    parser.add_argument("--link-ttl", type=float, default=0, help="CDN links expire (403) after this many seconds")
+    parser.add_argument("--resolve-ms", type=float, default=0, help="stub Apify resolution latency")
+    parser.add_argument("--verify", action="store_true", help="check every body byte for byte")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="extra environment for the proxy, e.g. SEGMENT_CACHE_ENABLED=0")
+    parser.add_argument("--serve-werkzeug", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve_werkzeug:
+        return serve_werkzeug(args.serve_werkzeug)
+
+    size = int(args.file_mb * 1024 * 1024)
+    cdn_port = free_port()
+    cdn = multiprocessing.Process(
+        target=run_cdn,
+        args=(cdn_port, size, args.seed, args.cdn_mbps, args.forbid_rate, args.link_ttl),
+        daemon=True,
+    )
+    cdn.start()
+    wait_for(cdn_port, f"/file/probe?time={2 ** 31}")
+
+    scratch = tempfile.mkdtemp(prefix="proxy_bench_")
+    env = {
+        **os.environ,
+        "BENCH_CDN_URL": f"http://127.0.0.1:{cdn_port}",
+        "BENCH_FILES": str(args.files),
+        "BENCH_RESOLVE_MS": str(args.resolve_ms),
+        "SESSION_DB_PATH": os.path.join(scratch, "sessions.db"),
+        "SEGMENT_CACHE_DIR": os.path.join(scratch, "segments"),
+        "METRICS_DIR": os.path.join(scratch, "metrics"),
+    }
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+
+    global PROXY_ADDRESS
+    proxy_port = free_port()
+    PROXY_ADDRESS = ("127.0.0.1", proxy_port)
+    proxy = subprocess.Popen(
+        proxy_command(args.server, proxy_port, args.workers, args.threads),
+        env=env, cwd=REPO_ROOT, stdout=sys.stderr  # keep stdout for the JSON report
+    )
+    try:
+        wait_for(proxy_port, "/")
+        data = synthetic_file(size, args.seed)
+        results = []
+
+        process_result = ScenarioResult()
+        with ResourceSampler(proxy.pid) as sampler:
+            seconds, session_ids = scenario_process(args, process_result)
+        results.append(summarize("process", process_result, seconds, sampler, args.concurrency))
+        if not session_ids:
+            raise SystemExit("No sessions were created - is the proxy failing?")
+
+        if args.viewers:
+            stream_result = ScenarioResult()
+            with ResourceSampler(proxy.pid) as sampler:
+                seconds = scenario_stream(args, stream_result, session_ids, data)
+            results.append(summarize("stream", stream_result, seconds, sampler, args.concurrency))
+
+        if args.downloads:
+            download_result = ScenarioResult()
+            with ResourceSampler(proxy.pid) as sampler:
+                seconds = scenario_download(args, download_result, session_ids, data)
+            results.append(summarize("download", download_result, seconds, sampler, args.concurrency))
+
+        stats = fetch_json("/stats") or {}
+    finally:
+        proxy.terminate()
+        try:
+            proxy.wait(10)
+        except subprocess.TimeoutExpired:
+            proxy.kill()
+        cdn.terminate()
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    print(json.dumps({
+        "benchmark": "proxy_load",
+        "config": {
+            key: value for key, value in vars(args).items() if key != "serve_werkzeug"
+        },
+        "results": results,
+        # /stats of whichever worker answered
+        "proxy_stats": {
+            key: stats.get(key) for key in ("upstream", "segment_cache", "relay_memory", "fanout", "failover")
+        },
+    }, indent=2))
+
+if __name__ == "__main__":
+    main()
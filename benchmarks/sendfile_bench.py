@@ -0,0 +1,117 @@
+"""Throughput of serving cached segments: Python generator vs zero-copy sendfile.
+
+Replays what a WSGI worker does for a cached /stream range over a loopback
+TCP connection:
+
+  generator - read the segment file in chunks and sock.sendall() each one
+              (the `yield chunk` path every response used before)
+  sendfile  - os.sendfile() from the segment file, which is what gunicorn does
+              with the wsgi.file_wrapper responses from sendfile_segment_response
+
+Usage:
+    python benchmarks/sendfile_bench.py --segment-mb 4 --requests 200
+"""
+import argparse
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+
+def drain(server_socket, total_bytes, done):
+    """Accept one connection and read until `total_bytes` have arrived"""
+    conn, _ = server_socket.accept()
+    received = 0
+    buffer = bytearray(1024 * 1024)
+    with conn:
+        while received < total_bytes:
+            n = conn.recv_into(buffer)
+            if not n:
+                break
+            received += n
+    done.append(received)
+
+def serve_generator(sock, path, offset, length, chunk_size):
+    with open(path, "rb") as f:
+        f.seek(offset)
+        remaining = length
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            sock.sendall(chunk)
+            remaining -= len(chunk)
+
+def serve_sendfile(sock, path, offset, length, chunk_size):
+    with open(path, "rb") as f:
+        sent = 0
+        while sent < length:
+            sent += os.sendfile(sock.fileno(), f.fileno(), offset + sent, min(chunk_size, length - sent))
+
+def run(mode, path, segment_size, requests, chunk_size):
+    serve = serve_sendfile if mode == "sendfile" else serve_generator
+    total_bytes = segment_size * requests
+
+    server_socket = socket.socket()
+    server_socket.bind(("127.0.0.1", 0))
+    server_socket.listen(1)
+    done = []
+    reader = threading.Thread(target=drain, args=(server_socket, total_bytes, done))
+    reader.start()
+
+    sock = socket.create_connection(server_socket.getsockname())
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    for _ in range(requests):
+        serve(sock, path, 0, segment_size, chunk_size)
+    sock.close()
+    reader.join()
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    server_socket.close()
+
+    gigabytes = done[0] / 1024 ** 3
+    return {
+        "mode": mode,
+        "bytes": done[0],
+        "seconds": round(wall, 4),
+        "mb_per_s": round(done[0] / 1024 ** 2 / wall, 1),
+        # process CPU includes the reader thread, which is the same for both modes
+        "cpu_seconds_per_gb": round(cpu / gigabytes, 3),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--segment-mb", type=float, default=4)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--chunk-kb", type=int, default=1024)
+    args = parser.parse_args()
+
+    if not hasattr(os, "sendfile"):
+        raise SystemExit("os.sendfile is not available on this platform")
+
+    segment_size = int(args.segment_mb * 1024 * 1024)
+    with tempfile.NamedTemporaryFile(delete=False) as f:
+        f.write(os.urandom(segment_size))
+        path = f.name
+
+    try:
+        results = [
+            run(mode, path, segment_size, args.requests, args.chunk_kb * 1024)
+            for mode in ("generator", "sendfile")
+        ]
+    finally:
+        os.remove(path)
+
+    generator, sendfile = results
+    print(json.dumps({
+        "benchmark": "sendfile",
+        "segment_bytes": segment_size,
+        "requests": args.requests,
+        "results": results,
+        "speedup": round(sendfile["mb_per_s"] / generator["mb_per_s"], 2),
+    }, indent=2))
+
+if __name__ == "__main__":
+    main()
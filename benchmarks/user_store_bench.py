@@ -0,0 +1,271 @@
+"""Cost of bot.py's user store (AsyncDataManager) as the user table grows.
+
+For each table size (the file is generated in one process, then measured in a
+fresh one so peak memory belongs to the load alone):
+
+  file     - writes a synthetic user_data.json the way _save_worker does
+             (indent=4) and reports its size
+  startup  - AsyncDataManager.start() until the bot can answer (ready) and
+             until the background user load finishes, with event-loop lag
+             and memory over the load
+  saves    - queues --saves full saves and measures how long each one holds
+             the event loop, via a probe task that sleeps 1ms and records
+             how late it wakes up
+  updates  - --updates update_user() calls (existing and new users) spaced
+             --interval-ms apart while the save worker runs, reporting
+             per-call latency and event-loop lag over the same window
+  scans    - get_all_user_ids() and calculate_24h_users()
+
+Everything is reported as JSON, one entry per size.
+
+Usage:
+    python benchmarks/user_store_bench.py --users 1000,100000,1000000
+    python benchmarks/user_store_bench.py --users 250000 --updates 5000 --interval-ms 0
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from queue import Empty
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCH_DIR)
+
+FIRST_USER_ID = 10 ** 9
+IST = timezone(timedelta(hours=5, minutes=30))  # bot.IST
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(len(values) * q))]
+    return {
+        "p50": round(pick(0.5) * 1000, 3),
+        "p90": round(pick(0.9) * 1000, 3),
+        "p99": round(pick(0.99) * 1000, 3),
+        "max": round(values[-1] * 1000, 3),
+    }
+
+def memory_kb(field):
+    """VmRSS / VmHWM of this process in kB, None without /proc"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def synthetic_users(count, seed):
+    """A user table shaped like the real one: last_seen spread over the past week"""
+    rng = random.Random(seed)
+    now = datetime.now(IST)
+    users = {}
+    for i in range(count):
+        last_seen = now - timedelta(seconds=rng.randrange(7 * 24 * 3600))
+        first_seen = last_seen - timedelta(seconds=rng.randrange(90 * 24 * 3600))
+        users[str(FIRST_USER_ID + i)] = {
+            "first_seen": first_seen.isoformat(),
+            "last_seen": last_seen.isoformat(),
+            "total_queries": rng.randint(1, 200),
+        }
+    return {"users": users, "total_users": count, "last_24h_users": 0, "last_update": None}
+
+def write_table(args, count, path):
+    """Write the table the way _save_worker does and report the file"""
+    table = synthetic_users(count, args.seed)
+    started = time.perf_counter()
+    with open(path, "w") as f:
+        f.write(json.dumps(table, indent=4))
+    return {
+        "bytes": os.path.getsize(path),
+        "mb": round(os.path.getsize(path) / 1024 ** 2, 2),
+        "write_seconds": round(time.perf_counter() - started, 3),
+    }
+
+class LoopLagProbe:
+    """Sleeps `interval` in a loop and records how late each wake-up is"""
+
+    def __init__(self, interval=0.001):
+        self.interval = interval
+        self.lags = []
+        self.task = None
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, time.perf_counter() - started - self.interval))
+
+    def start(self):
+        self.lags = []
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        # a wake-up more than 5ms late means something held the loop
+        blocked = [lag for lag in self.lags if lag > 0.005]
+        return {
+            "lag_ms": percentiles(self.lags),
+            "blocked_seconds": round(sum(blocked), 3),
+            "blocked_wakeups": len(blocked),
+        }
+
+async def measure(bot, args, count, path):
+    bot.USER_DATA_FILE = path
+    result = {}
+
+    rss_before = memory_kb("VmRSS")
+    manager = bot.AsyncDataManager()
+    bot.async_data_manager = manager
+    probe = LoopLagProbe()
+    probe.start()
+    started = time.perf_counter()
+    await manager.start()
+    ready = time.perf_counter() - started
+    # users stream in after start() returns; the bot answers updates meanwhile
+    await manager.users_ready.wait()
+    result["startup"] = {
+        "ready_seconds": round(ready, 4),
+        "load_seconds": round(time.perf_counter() - started, 3),
+        "loaded_users": len(manager.users),
+        **await probe.stop(),
+    }
+    if rss_before is not None:
+        result["startup"]["rss_mb"] = round((memory_kb("VmRSS") - rss_before) / 1024, 1)
+        result["startup"]["peak_rss_mb"] = round((memory_kb("VmHWM") - rss_before) / 1024, 1)
+
+    # full saves with nothing else running
+    probe.start()
+    started = time.perf_counter()
+    for _ in range(args.saves):
+        await manager.save_queue.put({'type': 'users'})
+    await manager.save_queue.join()
+    elapsed = time.perf_counter() - started
+    result["saves"] = {
+        "saves": args.saves,
+        # _save_worker sleeps 0.1s between saves
+        "seconds_per_save": round((elapsed - 0.1 * (args.saves - 1)) / args.saves, 4),
+        **await probe.stop(),
+    }
+
+    # update_user calls interleaved with the save worker they feed
+    rng = random.Random(args.seed + 1)
+    latencies = []
+    next_new = FIRST_USER_ID + count
+    probe.start()
+    started = time.perf_counter()
+    for _ in range(args.updates):
+        if rng.random() < args.new_ratio:
+            user_id, next_new = next_new, next_new + 1
+        else:
+            user_id = FIRST_USER_ID + rng.randrange(count)
+        call_started = time.perf_counter()
+        await manager.update_user(user_id)
+        latencies.append(time.perf_counter() - call_started)
+        await asyncio.sleep(args.interval_ms / 1000)
+    elapsed = time.perf_counter() - started
+    result["updates"] = {
+        "calls": args.updates,
+        "calls_per_s": round(args.updates / elapsed, 1),
+        "latency_ms": percentiles(latencies),
+        "saves_still_queued": manager.save_queue.qsize(),
+        **await probe.stop(),
+    }
+    await manager.stop()
+
+    # drop the backlog so calculate_24h_users' own save is the only one queued
+    while not manager.save_queue.empty():
+        manager.save_queue.get_nowait()
+
+    timings = []
+    for _ in range(args.scan_repeats):
+        started = time.perf_counter()
+        await manager.get_all_user_ids()
+        timings.append(time.perf_counter() - started)
+    result["get_all_user_ids_ms"] = percentiles(timings)
+
+    timings = []
+    for _ in range(args.scan_repeats):
+        started = time.perf_counter()
+        active = await bot.calculate_24h_users()
+        timings.append(time.perf_counter() - started)
+    result["calculate_24h_users_ms"] = percentiles(timings)
+    result["active_24h"] = active
+    return result
+
+def run_size(args, count, path):
+    os.environ["BOT_METRICS_PORT"] = "0"
+    sys.path.insert(0, REPO_ROOT)
+    import bot
+
+    if not args.log:
+        # update_user logs every new user at INFO
+        logging.getLogger("bot").setLevel(logging.WARNING)
+    return asyncio.run(measure(bot, args, count, path))
+
+def _child(results, target, args):
+    results.put(target(*args))
+
+def in_process(target, *args):
+    """Run target(*args) in a fresh process, so its peak RSS is its own"""
+    results = multiprocessing.Queue()
+    worker = multiprocessing.Process(target=_child, args=(results, target, args))
+    worker.start()
+    while True:
+        try:
+            result = results.get(timeout=1)
+            break
+        except Empty:
+            if not worker.is_alive():
+                raise SystemExit(f"{target.__name__} failed")
+    worker.join()
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", default="1000,10000,100000", help="comma-separated table sizes")
+    parser.add_argument("--updates", type=int, default=2000, help="update_user calls per size")
+    parser.add_argument("--new-ratio", type=float, default=0.1, help="share of update_user calls for unseen users")
+    parser.add_argument("--interval-ms", type=float, default=1, help="pause between update_user calls")
+    parser.add_argument("--saves", type=int, default=3, help="full saves timed on their own")
+    parser.add_argument("--scan-repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--log", action="store_true", help="keep bot.py's INFO logging")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.users.split(",") if size.strip()]
+    workdir = tempfile.mkdtemp(prefix="user_store_bench_")
+    results = []
+    try:
+        for count in sizes:
+            path = os.path.join(workdir, f"user_data_{count}.json")
+            file_stats = in_process(write_table, args, count, path)
+            results.append({"users": count, "file": file_stats, **in_process(run_size, args, count, path)})
+            os.remove(path)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps({
+        "benchmark": "user_store",
+        "updates": args.updates,
+        "new_ratio": args.new_ratio,
+        "interval_ms": args.interval_ms,
+        "results": results,
+    }, indent=2))
+
+if __name__ == "__main__":
+    main()
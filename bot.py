@@ -2,17 +2,26 @@ import os
 import re
 import json
 import asyncio
+import functools
+import signal
+import sqlite3
+import threading
+import multiprocessing
 import aiofiles
+from array import array
 from datetime import datetime, timedelta, timezone
 from typing import Dict, List, Set, Optional
 from collections import defaultdict, deque
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, 
-    filters, ContextTypes, CallbackQueryHandler
+    filters, ContextTypes, CallbackQueryHandler, TypeHandler
 )
 from telegram.constants import ParseMode
+from telegram.request import HTTPXRequest
 from asyncio import Semaphore, Queue
+from contextlib import asynccontextmanager, contextmanager
+from queue import Empty
 from threading import Lock
 import logging
 import time
@@ -57,13 +66,196 @@ IST = timezone(timedelta(hours=5, minutes=30))
 MAX_CONCURRENT_TASKS = 100
 BROADCAST_BATCH_SIZE = 20
 BROADCAST_DELAY = 0.1
+BROADCAST_LOAD_WAIT = 120  # seconds /broadcast waits for the user load to finish
 USER_CACHE_TTL = 300
 MEMBERSHIP_CACHE_TTL = 300
 
+# user_data.json is streamed in this many characters at a time at startup
+USER_LOAD_CHUNK_SIZE = 256 * 1024
+
 # Rate limiting
 RATE_LIMIT_PER_USER = 10
 RATE_LIMIT_WINDOW = 60
 
+# Multi-process mode: one front end polls Telegram and hands each update to one of
+# BOT_WORKERS worker processes by user ID (1 = everything in this process)
+BOT_WORKERS = int(os.environ.get("BOT_WORKERS", 1))
+SHARED_STORE_FILE = os.environ.get("BOT_SHARED_STORE", "bot_shared.sqlite3")
+SHARED_WRITE_BATCH = 1000  # worker writes applied per transaction
+FORCE_CHANNELS_REFRESH = 5  # seconds a worker trusts its copy of the force channels
+
+# Bot API server, e.g. a local telegram-bot-api instance ("http://host:8081/bot")
+BOT_API_URL = os.environ.get("BOT_API_URL")
+
+# Metrics endpoint (Prometheus text format) - off unless BOT_METRICS_PORT is set.
+# With BOT_WORKERS > 1 the workers take the ports after it
+METRICS_HOST = os.environ.get("BOT_METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("BOT_METRICS_PORT", 0))
+
+# ============= INSTRUMENTATION =============
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+LATENCY_SAMPLES = 1024  # recent samples kept per timer for percentiles
+
+class BotMetrics:
+    """Latency histograms and error counts for handlers and Bot API calls.
+    
+    Only used from the event loop, so nothing here takes a lock.
+    """
+    
+    def __init__(self):
+        self.timers = {}  # (kind, name) -> timer state
+        self.counters = defaultdict(int)
+        self.started = time.time()
+        self.server = None
+    
+    def observe(self, kind: str, name: str, seconds: float, error: bool = False):
+        timer = self.timers.get((kind, name))
+        if timer is None:
+            timer = self.timers[(kind, name)] = {
+                "buckets": [0] * (len(LATENCY_BUCKETS) + 1),
+                "sum": 0.0,
+                "count": 0,
+                "errors": 0,
+                "recent": deque(maxlen=LATENCY_SAMPLES),
+            }
+        index = 0
+        while index < len(LATENCY_BUCKETS) and seconds > LATENCY_BUCKETS[index]:
+            index += 1
+        timer["buckets"][index] += 1
+        timer["sum"] += seconds
+        timer["count"] += 1
+        timer["recent"].append(seconds)
+        if error:
+            timer["errors"] += 1
+    
+    def count(self, name: str, amount: int = 1):
+        self.counters[name] += amount
+    
+    def summary(self, kind: str, name: str) -> Optional[Dict]:
+        """count, errors, avg/p50/p95 in milliseconds - None if never observed"""
+        timer = self.timers.get((kind, name))
+        if timer is None or not timer["count"]:
+            return None
+        recent = sorted(timer["recent"])
+        return {
+            "count": timer["count"],
+            "errors": timer["errors"],
+            "avg_ms": timer["sum"] / timer["count"] * 1000,
+            "p50_ms": recent[len(recent) // 2] * 1000,
+            "p95_ms": recent[min(len(recent) - 1, int(len(recent) * 0.95))] * 1000,
+        }
+    
+    def render(self) -> str:
+        """Prometheus text exposition of everything recorded"""
+        lines = [
+            "# HELP terabox_bot_latency_seconds Handler, step and Bot API call latency",
+            "# TYPE terabox_bot_latency_seconds histogram",
+        ]
+        for (kind, name), timer in sorted(self.timers.items()):
+            labels = f'kind="{kind}",name="{name}"'
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), timer["buckets"]):
+                cumulative += count
+                lines.append(f'terabox_bot_latency_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"terabox_bot_latency_seconds_sum{{{labels}}} {timer['sum']}")
+            lines.append(f"terabox_bot_latency_seconds_count{{{labels}}} {timer['count']}")
+        
+        lines.append("# HELP terabox_bot_errors_total Failed handler runs and Bot API calls")
+        lines.append("# TYPE terabox_bot_errors_total counter")
+        for (kind, name), timer in sorted(self.timers.items()):
+            lines.append(f'terabox_bot_errors_total{{kind="{kind}",name="{name}"}} {timer["errors"]}')
+        
+        lines.append("# HELP terabox_bot_cache_lookups_total TTL cache lookups by result")
+        lines.append("# TYPE terabox_bot_cache_lookups_total counter")
+        for cache_name, cache in cache_manager.caches().items():
+            lines.append(f'terabox_bot_cache_lookups_total{{cache="{cache_name}",result="hit"}} {cache.hits}')
+            lines.append(f'terabox_bot_cache_lookups_total{{cache="{cache_name}",result="miss"}} {cache.misses}')
+        
+        lines.append("# HELP terabox_bot_cache_entries Entries held in each TTL cache")
+        lines.append("# TYPE terabox_bot_cache_entries gauge")
+        for cache_name, cache in cache_manager.caches().items():
+            lines.append(f'terabox_bot_cache_entries{{cache="{cache_name}"}} {len(cache)}')
+        
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"# TYPE terabox_bot_{name}_total counter")
+            lines.append(f"terabox_bot_{name}_total {value}")
+        
+        lines.append("# TYPE terabox_bot_uptime_seconds gauge")
+        lines.append(f"terabox_bot_uptime_seconds {time.time() - self.started:.0f}")
+        return "\n".join(lines) + "\n"
+    
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+                pass
+            if request_line.split(b" ")[1:2] == [b"/metrics"]:
+                status, body = "200 OK", self.render().encode()
+            else:
+                status, body = "404 Not Found", b"Not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+    
+    async def start_server(self):
+        if not METRICS_PORT:
+            return
+        try:
+            self.server = await asyncio.start_server(self._serve, METRICS_HOST, METRICS_PORT)
+            logger.info(f"✅ Metrics: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+        except OSError as e:
+            logger.error(f"Metrics endpoint not started: {e}")
+    
+    async def stop_server(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+bot_metrics = BotMetrics()
+
+def instrumented(kind: str = "handler", name: Optional[str] = None):
+    """Record the latency and failures of an async function under `kind`/`name`"""
+    def decorate(func):
+        label = name or func.__name__
+        
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            error = False
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                error = True
+                raise
+            finally:
+                bot_metrics.observe(kind, label, time.perf_counter() - started, error)
+        return wrapper
+    return decorate
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest that times every Bot API call by method name"""
+    
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        code = None
+        try:
+            code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+            return code, payload
+        finally:
+            bot_metrics.observe("api", api_method, time.perf_counter() - started, error=code != 200)
+            if code == 429:
+                bot_metrics.count("api_rate_limited")
+
 # ============= SIMPLE CACHE IMPLEMENTATION =============
 
 class TTLCache:
@@ -75,17 +267,25 @@ class TTLCache:
         self.cache = {}
         self.timestamps = {}
         self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
     
     def get(self, key):
         with self.lock:
             if key in self.cache:
                 if time.time() - self.timestamps[key] < self.ttl:
+                    self.hits += 1
                     return self.cache[key]
                 else:
                     del self.cache[key]
                     del self.timestamps[key]
+            self.misses += 1
             return None
     
+    def hit_ratio(self) -> Optional[float]:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else None
+    
     def set(self, key, value):
         with self.lock:
             if len(self.cache) >= self.maxsize:
@@ -121,6 +321,22 @@ class CacheManager:
         
         self.semaphore = Semaphore(MAX_CONCURRENT_TASKS)
     
+    def caches(self) -> Dict[str, TTLCache]:
+        return {
+            "user": self.user_cache,
+            "force_channel": self.force_channel_cache,
+            "membership": self.membership_cache,
+            "stats": self.stats_cache,
+        }
+    
+    @asynccontextmanager
+    async def slot(self):
+        """Hold one of the MAX_CONCURRENT_TASKS slots, recording how long it took to get"""
+        started = time.perf_counter()
+        async with self.semaphore:
+            bot_metrics.observe("wait", "semaphore", time.perf_counter() - started)
+            yield
+    
     async def get_user(self, user_id: int) -> Optional[Dict]:
         return self.user_cache.get(user_id)
     
@@ -134,6 +350,8 @@ class CacheManager:
         self.membership_cache.set(user_id, status)
     
     async def check_rate_limit(self, user_id: int) -> bool:
+        """Per process - in multi-process mode every update of a user goes to the
+        same worker, so that worker's count is the user's whole count"""
         now = time.time()
         
         with self.rate_limit_lock:
@@ -151,21 +369,256 @@ class CacheManager:
 
 cache_manager = CacheManager()
 
+# ============= USER STORE =============
+
+def iso_to_timestamp(value: Optional[str]) -> float:
+    return datetime.fromisoformat(value).timestamp() if value else 0.0
+
+def timestamp_to_iso(value: float) -> Optional[str]:
+    return datetime.fromtimestamp(value, IST).isoformat() if value else None
+
+class CompactUserStore:
+    """User table as parallel arrays indexed by row.
+    
+    Around 150 bytes per user where a dict of ISO-string dicts took ~700, and the
+    24h scans compare floats instead of parsing dates.
+    """
+    
+    def __init__(self):
+        self.rows = {}                # user_id -> row
+        self.ids = array('q')
+        self.first_seen = array('d')  # epoch seconds, 0 = unknown
+        self.last_seen = array('d')
+        self.queries = array('q')
+    
+    def __len__(self) -> int:
+        return len(self.ids)
+    
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self.rows
+    
+    def _append(self, user_id: int, first_seen: float, last_seen: float, queries: int):
+        self.rows[user_id] = len(self.ids)
+        self.ids.append(user_id)
+        self.first_seen.append(first_seen)
+        self.last_seen.append(last_seen)
+        self.queries.append(queries)
+    
+    def touch(self, user_id: int, now: float) -> bool:
+        """Record one query from `user_id`; True if the user was not in the table"""
+        row = self.rows.get(user_id)
+        if row is None:
+            self._append(user_id, now, now, 1)
+            return True
+        self.last_seen[row] = now
+        self.queries[row] += 1
+        return False
+    
+    def merge(self, user_id: int, first_seen: float, last_seen: float, queries: int):
+        """Add a user read from disk, folding in anything recorded for it since startup"""
+        row = self.rows.get(user_id)
+        if row is None:
+            self._append(user_id, first_seen, last_seen, queries)
+            return
+        if first_seen and (not self.first_seen[row] or first_seen < self.first_seen[row]):
+            self.first_seen[row] = first_seen
+        self.last_seen[row] = max(self.last_seen[row], last_seen)
+        self.queries[row] += queries
+    
+    def record(self, user_id: int) -> Dict:
+        row = self.rows[user_id]
+        return {
+            "first_seen": timestamp_to_iso(self.first_seen[row]),
+            "last_seen": timestamp_to_iso(self.last_seen[row]),
+            "total_queries": self.queries[row],
+        }
+    
+    def user_ids(self) -> List[str]:
+        return [str(user_id) for user_id in self.ids]
+    
+    def count_since(self, cutoff: float, field: str = "last_seen") -> int:
+        return sum(1 for seen in getattr(self, field) if seen > cutoff)
+    
+    def iter_json(self, batch_size: int = 2000):
+        """The `users` object of user_data.json, laid out like json.dumps(indent=4), in pieces"""
+        count = len(self.ids)
+        if not count:
+            yield "{}"
+            return
+        yield "{\n"
+        for start in range(0, count, batch_size):
+            rows = range(start, min(start + batch_size, count))
+            yield ",\n".join(
+                f'        "{self.ids[row]}": {{\n'
+                f'            "first_seen": {json.dumps(timestamp_to_iso(self.first_seen[row]))},\n'
+                f'            "last_seen": {json.dumps(timestamp_to_iso(self.last_seen[row]))},\n'
+                f'            "total_queries": {self.queries[row]}\n'
+                f'        }}'
+                for row in rows
+            ) + (",\n" if rows.stop < count else "\n    }")
+
+def user_data_pieces(users: CompactUserStore, meta: Dict):
+    """user_data.json for `users`, in pieces small enough to write between event loop turns"""
+    yield '{\n    "users": '
+    yield from users.iter_json()
+    yield (
+        f',\n    "total_users": {len(users)},\n'
+        f'    "last_24h_users": {json.dumps(meta["last_24h_users"])},\n'
+        f'    "last_update": {json.dumps(meta["last_update"])}\n}}'
+    )
+
+def parse_user_record(user_id_str: str, record: Dict) -> Optional[tuple]:
+    """(user_id, first_seen, last_seen, total_queries) from a user_data.json entry, None if malformed"""
+    try:
+        user_id = int(user_id_str)
+        first_seen = iso_to_timestamp(record.get("first_seen"))
+        last_seen = iso_to_timestamp(record.get("last_seen")) or first_seen
+        return user_id, first_seen, last_seen, int(record.get("total_queries", 0))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+class UserDataStreamParser:
+    """Incremental parser for user_data.json.
+    
+    feed() it text as it is read; it returns ("user", user_id, record) for each
+    entry of the top-level "users" object and ("field", key, value) for the other
+    top-level keys, so the whole document is never held in memory at once.
+    """
+    
+    WHITESPACE = re.compile(r'[ \t\n\r]*')
+    
+    def __init__(self):
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.state = "start"  # start -> top -> users -> top -> done
+    
+    def _skip(self, pos: int) -> int:
+        return self.WHITESPACE.match(self.buffer, pos).end()
+    
+    def _decode(self, pos: int) -> Optional[tuple]:
+        """(value, end) of the JSON value at `pos`, None if it may be cut off by the buffer end"""
+        try:
+            value, end = self.decoder.raw_decode(self.buffer, pos)
+        except json.JSONDecodeError:
+            return None
+        # a number right at the end could still have digits to come
+        if self._skip(end) >= len(self.buffer):
+            return None
+        return value, end
+    
+    def _decode_batch(self, pos: int) -> tuple:
+        """Every complete `users` entry from `pos` on, parsed by json.loads in one go.
+        
+        Cuts after the last "}," - or the one before, when the last closes "users"
+        itself. A cut inside a string or a nested object cannot parse, so a bad cut
+        only costs the fallback to entry-by-entry decoding.
+        """
+        end = len(self.buffer)
+        for _ in range(2):
+            cut = self.buffer.rfind("},", pos, end)
+            if cut <= pos:
+                break
+            try:
+                batch = json.loads("{" + self.buffer[pos:cut + 1] + "}")
+            except ValueError:
+                end = cut
+                continue
+            if isinstance(batch, dict):
+                return batch, cut
+            break
+        return None, None
+    
+    def feed(self, text: str) -> List[tuple]:
+        self.buffer += text
+        events = []
+        pos = 0
+        batching = True
+        while True:
+            pos = self._skip(pos)
+            if pos >= len(self.buffer):
+                break
+            char = self.buffer[pos]
+            if self.state == "start":
+                if char != "{":
+                    raise ValueError("user data is not a JSON object")
+                self.state = "top"
+                pos += 1
+                continue
+            if self.state == "done":
+                raise ValueError("unexpected data after the end of user data")
+            if char == ",":
+                pos += 1
+                continue
+            if char == "}":
+                self.state = "top" if self.state == "users" else "done"
+                pos += 1
+                continue
+            
+            if self.state == "users" and batching:
+                batch, cut = self._decode_batch(pos)
+                if batch is not None:
+                    events.extend(("user", key, value) for key, value in batch.items())
+                    pos = cut + 2
+                    continue
+                batching = False
+            
+            decoded = self._decode(pos)
+            if decoded is None:
+                break
+            key, colon = decoded
+            colon = self._skip(colon)
+            if self.buffer[colon] != ":":
+                raise ValueError(f"expected ':' after {key!r}")
+            value_start = self._skip(colon + 1)
+            if value_start >= len(self.buffer):
+                break
+            
+            if self.state == "top" and key == "users":
+                if self.buffer[value_start] != "{":
+                    raise ValueError("'users' is not an object")
+                self.state = "users"
+                pos = value_start + 1
+                continue
+            
+            decoded = self._decode(value_start)
+            if decoded is None:
+                break
+            value, pos = decoded
+            events.append(("user" if self.state == "users" else "field", key, value))
+        
+        self.buffer = self.buffer[pos:]
+        return events
+    
+    def close(self):
+        if self.state != "done" or self.buffer.strip():
+            raise ValueError("user data file ended early")
+
 # ============= ASYNC FILE OPERATIONS =============
 
 class AsyncDataManager:
     """Async file operations with batching"""
     
+    stats_owner = True  # runs the daily 24h stats update
+    
     def __init__(self):
-        self.user_data = {"users": {}, "total_users": 0, "last_24h_users": 0, "last_update": None}
+        self.users = CompactUserStore()
+        self.user_meta = {"last_24h_users": 0, "last_update": None}
         self.force_channels = []
         self.data_lock = asyncio.Lock()
         self.save_queue = Queue()
         self._save_worker_task = None
         self._stats_update_task = None
+        self._load_task = None
+        
+        # Users load in the background; until then a user missing from the store
+        # may just not have been read yet, so new ones are kept as pending
+        self.users_ready = asyncio.Event()
+        self.pending_users = set()
+        self.load_seconds = None
+        self._save_after_load = False
     
     async def start(self):
-        """Start background save worker"""
+        """Start background save worker and user loading"""
         self._save_worker_task = asyncio.create_task(self._save_worker())
         await self.load_initial_data()
     
@@ -175,23 +628,18 @@ class AsyncDataManager:
             self._save_worker_task.cancel()
         if self._stats_update_task:
             self._stats_update_task.cancel()
+        if self._load_task:
+            self._load_task.cancel()
+    
+    @property
+    def loading(self) -> bool:
+        return not self.users_ready.is_set()
     
     async def load_initial_data(self):
-        """Load all data at startup"""
+        """Load force channels, then stream users in without waiting for them"""
+        self._load_task = asyncio.create_task(self._load_users())
+        
         async with self.data_lock:
-            # Load users
-            try:
-                async with aiofiles.open(USER_DATA_FILE, 'r') as f:
-                    content = await f.read()
-                    self.user_data = json.loads(content)
-                    logger.info(f"Loaded {len(self.user_data.get('users', {}))} users from file")
-            except FileNotFoundError:
-                self.user_data = {"users": {}, "total_users": 0, "last_24h_users": 0, "last_update": None}
-                logger.info("No user data file found, starting fresh")
-            except Exception as e:
-                logger.error(f"Error loading user data: {e}")
-                self.user_data = {"users": {}, "total_users": 0, "last_24h_users": 0, "last_update": None}
-            
             # Load force channels
             try:
                 async with aiofiles.open(FORCE_CHANNELS_FILE, 'r') as f:
@@ -205,6 +653,66 @@ class AsyncDataManager:
                 logger.error(f"Error loading force channels: {e}")
                 self.force_channels = []
     
+    async def _load_users(self):
+        """Stream user_data.json into the store a chunk at a time"""
+        started = time.perf_counter()
+        parser = UserDataStreamParser()
+        loaded = 0
+        skipped = 0
+        try:
+            async with aiofiles.open(USER_DATA_FILE, 'r') as f:
+                while True:
+                    text = await f.read(USER_LOAD_CHUNK_SIZE)
+                    if not text:
+                        break
+                    events = parser.feed(text)
+                    async with self.data_lock:
+                        for kind, key, value in events:
+                            if kind == "field":
+                                if key in self.user_meta:
+                                    self.user_meta[key] = value
+                            elif self._add_loaded_user(key, value):
+                                loaded += 1
+                            else:
+                                skipped += 1
+            parser.close()
+            logger.info(f"Loaded {loaded} users from file")
+        except FileNotFoundError:
+            logger.info("No user data file found, starting fresh")
+        except Exception as e:
+            logger.error(f"Error loading user data after {loaded} users: {e}")
+        
+        if skipped:
+            logger.warning(f"Skipped {skipped} malformed user records")
+        
+        self.load_seconds = time.perf_counter() - started
+        bot_metrics.observe("startup", "user_data_load", self.load_seconds)
+        async with self.data_lock:
+            if self.pending_users:
+                logger.info(f"{len(self.pending_users)} new users registered while loading, total users: {len(self.users)}")
+            self.pending_users.clear()
+            self.users_ready.set()
+            if self._save_after_load:
+                await self.save_queue.put({'type': 'users'})
+        logger.info(f"User data ready in {self.load_seconds:.2f}s")
+    
+    def _add_loaded_user(self, user_id_str: str, record: Dict) -> bool:
+        parsed = parse_user_record(user_id_str, record)
+        if parsed is None:
+            return False
+        self.pending_users.discard(parsed[0])
+        self.users.merge(*parsed)
+        return True
+    
+    async def _save_users(self):
+        """Write user_data.json a batch of users at a time, yielding to the event loop in between"""
+        temp_file = USER_DATA_FILE + ".tmp"
+        async with aiofiles.open(temp_file, 'w') as f:
+            for piece in user_data_pieces(self.users, self.user_meta):
+                await f.write(piece)
+                await asyncio.sleep(0)
+        os.replace(temp_file, USER_DATA_FILE)
+    
     async def _save_worker(self):
         """Background worker for saving data"""
         try:
@@ -212,9 +720,12 @@ class AsyncDataManager:
                 try:
                     save_task = await self.save_queue.get()
                     
-                    if save_task['type'] == 'users':
-                        async with aiofiles.open(USER_DATA_FILE, 'w') as f:
-                            await f.write(json.dumps(self.user_data, indent=4))
+                    if save_task['type'] == 'users' and self.loading:
+                        # writing a half-loaded table would drop everyone not read yet
+                        self._save_after_load = True
+                    
+                    elif save_task['type'] == 'users':
+                        await self._save_users()
                         logger.debug("User data saved successfully")
                         
                     elif save_task['type'] == 'channels':
@@ -234,25 +745,16 @@ class AsyncDataManager:
     async def update_user(self, user_id: int) -> Dict:
         """Update user data asynchronously"""
         async with self.data_lock:
-            current_time = datetime.now(IST).isoformat()
-            user_id_str = str(user_id)
-            
-            if user_id_str not in self.user_data["users"]:
-                self.user_data["users"][user_id_str] = {
-                    "first_seen": current_time,
-                    "last_seen": current_time,
-                    "total_queries": 1
-                }
-                self.user_data["total_users"] = len(self.user_data["users"])
-                logger.info(f"New user registered: {user_id}, total users: {self.user_data['total_users']}")
-            else:
-                self.user_data["users"][user_id_str]["last_seen"] = current_time
-                self.user_data["users"][user_id_str]["total_queries"] = \
-                    self.user_data["users"][user_id_str].get("total_queries", 0) + 1
+            if self.users.touch(user_id, time.time()):
+                if self.loading:
+                    # new-but-pending: merged with its record if the loader reaches one
+                    self.pending_users.add(user_id)
+                else:
+                    logger.info(f"New user registered: {user_id}, total users: {len(self.users)}")
             
             await self.save_queue.put({'type': 'users'})
             
-            return self.user_data["users"][user_id_str]
+            return self.users.record(user_id)
     
     async def get_force_channels(self) -> List[Dict]:
         """Get force channels with caching"""
@@ -263,7 +765,7 @@ class AsyncDataManager:
         """Add force channel asynchronously"""
         async with self.data_lock:
             self.force_channels.append(channel_data)
-            await self.save_queue.put({'type': 'channels'})
+            await self._channels_changed()
             logger.info(f"Force channel added: {channel_data['title']}")
     
     async def remove_force_channel(self, channel_id: int) -> bool:
@@ -272,7 +774,7 @@ class AsyncDataManager:
             initial_len = len(self.force_channels)
             self.force_channels = [c for c in self.force_channels if c['id'] != channel_id]
             if len(self.force_channels) < initial_len:
-                await self.save_queue.put({'type': 'channels'})
+                await self._channels_changed()
                 logger.info(f"Force channel removed: {channel_id}")
                 return True
             return False
@@ -282,25 +784,287 @@ class AsyncDataManager:
         async with self.data_lock:
             count = len(self.force_channels)
             self.force_channels = []
-            await self.save_queue.put({'type': 'channels'})
+            await self._channels_changed()
             logger.info(f"All force channels cleared: {count} channels removed")
     
     async def get_user_stats(self) -> Dict:
         """Get user statistics"""
         async with self.data_lock:
             return {
-                "total_users": len(self.user_data.get("users", {})),
-                "last_24h_users": self.user_data.get("last_24h_users", 0),
-                "last_update": self.user_data.get("last_update")
+                "total_users": len(self.users),
+                "last_24h_users": self.user_meta["last_24h_users"],
+                "last_update": self.user_meta["last_update"],
+                "loading": self.loading
             }
     
     async def get_all_user_ids(self) -> List[str]:
         """Get all user IDs"""
         async with self.data_lock:
-            return list(self.user_data.get("users", {}).keys())
+            return self.users.user_ids()
+    
+    async def count_users_since(self, cutoff: float, field: str = "last_seen") -> int:
+        """Users whose `field` (last_seen or first_seen) is after the `cutoff` timestamp"""
+        async with self.data_lock:
+            return self.users.count_since(cutoff, field)
+    
+    async def record_24h_users(self, count: int, updated_at: str):
+        async with self.data_lock:
+            self.user_meta["last_24h_users"] = count
+            self.user_meta["last_update"] = updated_at
+            await self.save_queue.put({'type': 'users'})
+    
+    async def _channels_changed(self):
+        await self.save_queue.put({'type': 'channels'})
 
 async_data_manager = AsyncDataManager()
 
+# ============= SHARED STORE (MULTI-PROCESS MODE) =============
+
+class SharedStore:
+    """SQLite file shared by the front end and every worker in multi-process mode.
+    
+    WAL journaling lets workers read while a write commits. Workers only read;
+    user data and force channels are written by the front end's
+    SharedStoreWriter alone.
+    """
+    
+    def __init__(self, path: Optional[str] = None):
+        # SharedDataManager queries it from asyncio.to_thread, not the thread that opened it
+        self.db = sqlite3.connect(
+            path or SHARED_STORE_FILE, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                first_seen REAL NOT NULL,
+                last_seen REAL NOT NULL,
+                total_queries INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS users_last_seen ON users (last_seen);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+        """)
+    
+    def close(self):
+        self.db.close()
+    
+    @contextmanager
+    def transaction(self):
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+    
+    def get_meta(self, key: str, default=None):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+    
+    def set_meta(self, key: str, value):
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, json.dumps(value)))
+    
+    def user_count(self) -> int:
+        return self.db.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+    
+    def user_ids(self) -> List[str]:
+        return [str(row[0]) for row in self.db.execute("SELECT user_id FROM users")]
+    
+    def count_since(self, cutoff: float, field: str = "last_seen") -> int:
+        if field not in ("first_seen", "last_seen"):
+            raise ValueError(f"unknown field: {field}")
+        return self.db.execute(f"SELECT COUNT(*) FROM users WHERE {field} > ?", (cutoff,)).fetchone()[0]
+    
+    def upsert_users(self, rows: List[tuple], add_queries: bool = True) -> int:
+        """Merge (user_id, first_seen, last_seen, queries) rows in; returns how many users are new.
+        
+        Queries are added to a known user's count, or with `add_queries` False
+        the larger count is kept - for rows that are totals, not new queries.
+        """
+        queries = "total_queries + excluded.total_queries" if add_queries else "MAX(total_queries, excluded.total_queries)"
+        with self.transaction():
+            known = 0
+            for start in range(0, len(rows), 500):
+                ids = [row[0] for row in rows[start:start + 500]]
+                known += self.db.execute(
+                    f"SELECT COUNT(*) FROM users WHERE user_id IN ({','.join('?' * len(ids))})", ids
+                ).fetchone()[0]
+            self.db.executemany(f"""
+                INSERT INTO users VALUES (?, ?, ?, ?)
+                ON CONFLICT (user_id) DO UPDATE SET
+                    first_seen = MIN(first_seen, excluded.first_seen),
+                    last_seen = MAX(last_seen, excluded.last_seen),
+                    total_queries = {queries}
+            """, rows)
+        return len(rows) - known
+    
+    def user_data_changed(self, path: str) -> bool:
+        """Whether `path` differs from the user_data.json this store last imported or exported"""
+        if not os.path.exists(path):
+            return False
+        return os.stat(path).st_mtime_ns != self.get_meta("user_data_mtime")
+    
+    def _mark_user_data(self, path: str):
+        self.set_meta("user_data_mtime", os.stat(path).st_mtime_ns)
+    
+    def import_user_data(self, path: str) -> int:
+        """Stream user_data.json into the store, merged with the users already there.
+        
+        The file holds totals, so a user in both keeps the larger query count -
+        re-importing a file exported from this store changes nothing.
+        """
+        parser = UserDataStreamParser()
+        imported = 0
+        with open(path, 'r') as f:
+            while True:
+                text = f.read(USER_LOAD_CHUNK_SIZE)
+                if not text:
+                    break
+                rows = []
+                for kind, key, value in parser.feed(text):
+                    if kind == "field":
+                        if key in ("last_24h_users", "last_update"):
+                            self.set_meta(key, value)
+                    else:
+                        parsed = parse_user_record(key, value)
+                        if parsed is not None:
+                            rows.append(parsed)
+                if rows:
+                    self.upsert_users(rows, add_queries=False)
+                    imported += len(rows)
+        parser.close()
+        self._mark_user_data(path)
+        return imported
+    
+    def export_user_data(self, path: str) -> int:
+        """Write the store out as user_data.json, for single-process mode to pick up"""
+        users = CompactUserStore()
+        for row in self.db.execute("SELECT user_id, first_seen, last_seen, total_queries FROM users"):
+            users.merge(*row)
+        meta = {"last_24h_users": self.get_meta("last_24h_users", 0), "last_update": self.get_meta("last_update")}
+        temp_file = path + ".tmp"
+        with open(temp_file, 'w') as f:
+            for piece in user_data_pieces(users, meta):
+                f.write(piece)
+        os.replace(temp_file, path)
+        self._mark_user_data(path)
+        return len(users)
+
+class SharedDataManager(AsyncDataManager):
+    """AsyncDataManager for multi-process mode.
+    
+    Reads come straight from the shared store, in a thread so a busy store
+    can't hold up the event loop. User updates, force channel changes and 24h
+    stats are sent to the front end's SharedStoreWriter, the only process that
+    persists anything.
+    """
+    
+    def __init__(self, writes, stats_owner: bool = False):
+        super().__init__()
+        self.writes = writes
+        self.stats_owner = stats_owner
+        self.store = None
+        self.channels_loaded_at = 0.0
+    
+    async def start(self):
+        self.store = await asyncio.to_thread(SharedStore)
+        self.force_channels = await asyncio.to_thread(self.store.get_meta, "force_channels", [])
+        self.channels_loaded_at = time.time()
+        # the store is complete from the start, there is nothing to stream in
+        self.load_seconds = 0.0
+        self.users_ready.set()
+    
+    async def stop(self):
+        if self.store:
+            self.store.close()
+    
+    async def update_user(self, user_id: int) -> Dict:
+        now = time.time()
+        self.writes.put(("touch", user_id, now))
+        return {"last_seen": timestamp_to_iso(now)}
+    
+    async def get_force_channels(self) -> List[Dict]:
+        """Force channels, re-read every FORCE_CHANNELS_REFRESH seconds to see other workers' changes"""
+        async with self.data_lock:
+            if time.time() - self.channels_loaded_at > FORCE_CHANNELS_REFRESH:
+                self.force_channels = await asyncio.to_thread(self.store.get_meta, "force_channels", [])
+                self.channels_loaded_at = time.time()
+            return self.force_channels.copy()
+    
+    async def _channels_changed(self):
+        self.writes.put(("channels", list(self.force_channels)))
+        self.channels_loaded_at = time.time()
+    
+    def _read_user_stats(self) -> Dict:
+        return {
+            "total_users": self.store.user_count(),
+            "last_24h_users": self.store.get_meta("last_24h_users", 0),
+            "last_update": self.store.get_meta("last_update"),
+            "loading": False
+        }
+    
+    async def get_user_stats(self) -> Dict:
+        return await asyncio.to_thread(self._read_user_stats)
+    
+    async def get_all_user_ids(self) -> List[str]:
+        return await asyncio.to_thread(self.store.user_ids)
+    
+    async def count_users_since(self, cutoff: float, field: str = "last_seen") -> int:
+        return await asyncio.to_thread(self.store.count_since, cutoff, field)
+    
+    async def record_24h_users(self, count: int, updated_at: str):
+        self.writes.put(("stats", count, updated_at))
+
+class SharedStoreWriter(threading.Thread):
+    """Front-end thread that applies the workers' writes to the shared store in batches"""
+    
+    def __init__(self, writes):
+        super().__init__(name="shared-store-writer", daemon=True)
+        self.writes = writes
+    
+    def run(self):
+        store = SharedStore()
+        running = True
+        while running:
+            messages = [self.writes.get()]
+            while len(messages) < SHARED_WRITE_BATCH:
+                try:
+                    messages.append(self.writes.get_nowait())
+                except Empty:
+                    break
+            
+            touches = {}  # user_id -> [first_seen, last_seen, queries]
+            try:
+                for message in messages:
+                    if message is None:
+                        running = False
+                    elif message[0] == "touch":
+                        _, user_id, at = message
+                        touch = touches.get(user_id)
+                        if touch is None:
+                            touches[user_id] = [at, at, 1]
+                        else:
+                            touch[1] = max(touch[1], at)
+                            touch[2] += 1
+                    elif message[0] == "channels":
+                        store.set_meta("force_channels", message[1])
+                        with open(FORCE_CHANNELS_FILE, 'w') as f:
+                            json.dump(message[1], f, indent=4)
+                        logger.info(f"Force channels saved: {len(message[1])} channels")
+                    elif message[0] == "stats":
+                        store.set_meta("last_24h_users", message[1])
+                        store.set_meta("last_update", message[2])
+                
+                if touches:
+                    new_users = store.upsert_users([(user_id, *touch) for user_id, touch in touches.items()])
+                    if new_users:
+                        logger.info(f"{new_users} new users registered, total users: {store.user_count()}")
+            except (sqlite3.Error, OSError) as e:
+                logger.error(f"Shared store write failed: {e}")
+        store.close()
+
 # ============= HELPER FUNCTIONS =============
 
 def is_admin(user_id: int) -> bool:
@@ -346,6 +1110,7 @@ def validate_terabox_link(text: str) -> tuple:
     
     return True, False, f"❌ *Domain not supported:* `{domain}`\n\n*Supported domains:*\n• " + "\n• ".join(SUPPORTED_DOMAINS)
 
+@instrumented("step", "membership_check")
 async def check_user_joined_channels(user_id: int, context: ContextTypes.DEFAULT_TYPE) -> tuple:
     """Check if user has joined all force channels (with caching)"""
     cached_result = await cache_manager.get_membership(user_id)
@@ -389,25 +1154,20 @@ def get_force_channels_keyboard(not_joined_channels: List[Dict]) -> InlineKeyboa
     
     return InlineKeyboardMarkup(keyboard)
 
+@instrumented("step", "update_user")
 async def update_user_stats(user_id: int):
     """Update user statistics asynchronously"""
     await async_data_manager.update_user(user_id)
 
 async def calculate_24h_users():
     """Calculate users in last 24 hours"""
+    await async_data_manager.users_ready.wait()
+    
     current_time = datetime.now(IST)
     last_24h_cutoff = current_time - timedelta(hours=24)
     
-    count = 0
-    async with async_data_manager.data_lock:
-        for user_data in async_data_manager.user_data["users"].values():
-            last_seen = datetime.fromisoformat(user_data["last_seen"])
-            if last_seen > last_24h_cutoff:
-                count += 1
-        
-        async_data_manager.user_data["last_24h_users"] = count
-        async_data_manager.user_data["last_update"] = current_time.isoformat()
-        await async_data_manager.save_queue.put({'type': 'users'})
+    count = await async_data_manager.count_users_since(last_24h_cutoff.timestamp())
+    await async_data_manager.record_24h_users(count, current_time.isoformat())
     
     logger.info(f"24h active users calculated: {count}")
     return count
@@ -430,11 +1190,37 @@ async def periodic_stats_update():
     except asyncio.CancelledError:
         logger.info("Periodic stats update stopped")
 
+def format_timer(kind: str, name: str) -> str:
+    """`n · p50 · p95` for the /adm_cmd summary"""
+    summary = bot_metrics.summary(kind, name)
+    if summary is None:
+        return "no data"
+    return f"n={summary['count']} · p50 {summary['p50_ms']:.0f}ms · p95 {summary['p95_ms']:.0f}ms"
+
+def format_performance_summary() -> str:
+    """Handler latency, slot waits, Bot API time and cache hit ratio since startup"""
+    uptime = int(time.time() - bot_metrics.started)
+    handler_errors = sum(t["errors"] for (kind, _), t in bot_metrics.timers.items() if kind == "handler")
+    api_errors = sum(t["errors"] for (kind, _), t in bot_metrics.timers.items() if kind == "api")
+    hit_ratio = cache_manager.membership_cache.hit_ratio()
+    load_seconds = async_data_manager.load_seconds
+    user_data = f"loaded in {load_seconds:.1f}s" if load_seconds is not None else "loading..."
+    return (
+        f"• Uptime: `{uptime // 3600}h {uptime % 3600 // 60}m`\n"
+        f"• Messages: `{format_timer('handler', 'handle_message')}`\n"
+        f"• Slot wait: `{format_timer('wait', 'semaphore')}`\n"
+        f"• getChatMember: `{format_timer('api', 'getChatMember')}`\n"
+        f"• Membership cache hits: `{f'{hit_ratio * 100:.1f}%' if hit_ratio is not None else 'no data'}`\n"
+        f"• User data: `{user_data}`\n"
+        f"• Errors: `{handler_errors} handler · {api_errors} API · {bot_metrics.counters['api_rate_limited']} x 429`"
+    )
+
 # ============= HANDLERS =============
 
+@instrumented()
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Send welcome message with concurrency control"""
-    async with cache_manager.semaphore:
+    async with cache_manager.slot():
         user_id = update.effective_user.id
         
         if not await cache_manager.check_rate_limit(user_id):
@@ -466,9 +1252,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         await update.message.reply_text(welcome_text, parse_mode='Markdown')
 
+@instrumented()
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle user messages with concurrency control"""
-    async with cache_manager.semaphore:
+    async with cache_manager.slot():
         user_id = update.effective_user.id
         
         if not await cache_manager.check_rate_limit(user_id):
@@ -532,9 +1319,10 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parse_mode='Markdown'
         )
 
+@instrumented()
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle button callbacks"""
-    async with cache_manager.semaphore:
+    async with cache_manager.slot():
         query = update.callback_query
         user_id = update.effective_user.id
         await query.answer()
@@ -572,6 +1360,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # ============= ADMIN COMMANDS =============
 
+@instrumented()
 async def admin_commands(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show all admin commands and their usage"""
     user_id = update.effective_user.id
@@ -625,6 +1414,10 @@ async def admin_commands(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • Cache Size: `{len(cache_manager.membership_cache.cache)}`
 • Rate Limit: `{RATE_LIMIT_PER_USER}/min`
 
+📈 *PERFORMANCE*
+────────────────────────
+{format_performance_summary()}
+
 ═══════════════════════════════
 ✅ *Bot is running in high-performance mode*
     """
@@ -635,6 +1428,7 @@ async def admin_commands(update: Update, context: ContextTypes.DEFAULT_TYPE):
         disable_web_page_preview=True
     )
 
+@instrumented()
 async def admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Optimized broadcast with batching and queueing"""
     user_id = update.effective_user.id
@@ -654,6 +1448,23 @@ async def admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_stats = await async_data_manager.get_user_stats()
     total_users = user_stats['total_users']
     
+    if user_stats['loading']:
+        await update.message.reply_text(
+            f"⏳ *User data is still loading* ({total_users} users so far)\n\n"
+            "The broadcast starts once it is done.",
+            parse_mode='Markdown'
+        )
+        try:
+            await asyncio.wait_for(async_data_manager.users_ready.wait(), BROADCAST_LOAD_WAIT)
+        except asyncio.TimeoutError:
+            await update.message.reply_text(
+                "❌ *User data did not finish loading in time* - nothing was sent.\n\nTry again in a moment.",
+                parse_mode='Markdown'
+            )
+            return
+        user_stats = await async_data_manager.get_user_stats()
+        total_users = user_stats['total_users']
+    
     if total_users == 0:
         await update.message.reply_text("❌ No users to broadcast to.", parse_mode='Markdown')
         return
@@ -708,6 +1519,7 @@ async def admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode='Markdown'
     )
 
+@instrumented()
 async def admin_force_add(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Add force subscription channel"""
     user_id = update.effective_user.id
@@ -790,6 +1602,7 @@ async def admin_force_add(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parse_mode='Markdown'
         )
 
+@instrumented()
 async def admin_force_remove(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Remove force subscription channel"""
     user_id = update.effective_user.id
@@ -841,6 +1654,7 @@ async def admin_force_remove(update: Update, context: ContextTypes.DEFAULT_TYPE)
             parse_mode='Markdown'
         )
 
+@instrumented()
 async def admin_force_clear(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Clear all force channels"""
     user_id = update.effective_user.id
@@ -865,6 +1679,7 @@ async def admin_force_clear(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode='Markdown'
     )
 
+@instrumented()
 async def admin_force_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Check force channel status with joined users count"""
     user_id = update.effective_user.id
@@ -923,6 +1738,7 @@ async def admin_force_status(update: Update, context: ContextTypes.DEFAULT_TYPE)
         disable_web_page_preview=True
     )
 
+@instrumented()
 async def admin_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Get user statistics"""
     user_id = update.effective_user.id
@@ -938,18 +1754,9 @@ async def admin_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     current_time = datetime.now(IST)
     last_24h_cutoff = current_time - timedelta(hours=24)
-    active_24h = 0
-    new_users_24h = 0
-    
-    async with async_data_manager.data_lock:
-        for user in async_data_manager.user_data.get("users", {}).values():
-            last_seen = datetime.fromisoformat(user["last_seen"])
-            if last_seen > last_24h_cutoff:
-                active_24h += 1
-            
-            first_seen = datetime.fromisoformat(user["first_seen"])
-            if first_seen > last_24h_cutoff:
-                new_users_24h += 1
+    
+    active_24h = await async_data_manager.count_users_since(last_24h_cutoff.timestamp())
+    new_users_24h = await async_data_manager.count_users_since(last_24h_cutoff.timestamp(), "first_seen")
     
     stats_text = (
         f"📊 *User Statistics*\n\n"
@@ -960,9 +1767,12 @@ async def admin_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"🕐 *Last Updated:* `{last_update or 'Never'}`\n"
         f"⏰ *Timezone:* IST (UTC+5:30)"
     )
+    if user_stats['loading']:
+        stats_text += "\n\n⏳ _Still loading user data, counts are partial_"
     
     await update.message.reply_text(stats_text, parse_mode='Markdown')
 
+@instrumented()
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show help for regular users"""
     user_id = update.effective_user.id
@@ -1028,10 +1838,15 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def post_init(application: Application):
     """Initialize bot on startup - FIXED: accepts application parameter"""
+    started = time.perf_counter()
     await async_data_manager.start()
+    ready_seconds = time.perf_counter() - started
+    bot_metrics.observe("startup", "ready", ready_seconds)
+    await bot_metrics.start_server()
     
     # Start periodic stats update in background
-    asyncio.create_task(periodic_stats_update())
+    if async_data_manager.stats_owner:
+        async_data_manager._stats_update_task = asyncio.create_task(periodic_stats_update())
     
     logger.info("=" * 60)
     logger.info("🤖 TERABOX BOT - HIGH PERFORMANCE MODE")
@@ -1042,17 +1857,28 @@ async def post_init(application: Application):
     logger.info(f"✅ Broadcast Batch Size: {BROADCAST_BATCH_SIZE}")
     logger.info(f"✅ Cache Size Limit: 10,000 users")
     logger.info(f"✅ Rate Limit: {RATE_LIMIT_PER_USER} req/min per user")
+    logger.info(f"✅ Ready in {ready_seconds:.3f}s (users loading in background: {async_data_manager.loading})")
     logger.info("=" * 60)
 
 async def post_shutdown(application: Application):
     """Cleanup on shutdown"""
     await async_data_manager.stop()
+    await bot_metrics.stop_server()
     logger.info("Bot shutdown complete")
 
-def main():
-    """Start the bot"""
-    # Create application
-    application = Application.builder().token(BOT_TOKEN).build()
+def build_application(token: str = BOT_TOKEN, base_url: Optional[str] = BOT_API_URL, polling: bool = True) -> Application:
+    """Create the application with every handler registered
+    
+    `base_url` points the bot at another Bot API server, e.g. the fake one used by
+    benchmarks/bot_throughput_bench.py. Without `polling` there is no updater and
+    updates have to be put on application.update_queue.
+    """
+    builder = Application.builder().token(token).request(InstrumentedRequest(connection_pool_size=256))
+    if base_url:
+        builder = builder.base_url(base_url)
+    if not polling:
+        builder = builder.updater(None)
+    application = builder.build()
     
     # Register startup/shutdown handlers - FIXED: Now accepts application parameter
     application.post_init = post_init
@@ -1067,7 +1893,9 @@ def main():
     application.add_handler(CommandHandler("force_remove", admin_force_remove))
     application.add_handler(CommandHandler("force_clear", admin_force_clear))
     application.add_handler(CommandHandler("force_status", admin_force_status))
-    application.add_handler(CommandHandler("broadcast", admin_broadcast))
+    # A broadcast can wait for the user load and then run for minutes - as its own
+    # task, so other updates keep being answered meanwhile
+    application.add_handler(CommandHandler("broadcast", admin_broadcast, block=False))
     application.add_handler(CommandHandler("users", admin_users))
     application.add_handler(CommandHandler("adm_cmd", admin_commands))
     application.add_handler(CommandHandler("admin", admin_commands))
@@ -1079,6 +1907,125 @@ def main():
     # Error handler
     application.add_error_handler(error_handler)
     
+    return application
+
+# ============= MULTI-PROCESS MODE =============
+
+class UpdateRouter:
+    """Front-end handler: sends every update to the worker that owns its user"""
+    
+    def __init__(self, queues: List):
+        self.queues = queues
+    
+    async def route(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user = update.effective_user
+        shard = user.id % len(self.queues) if user else 0
+        self.queues[shard].put(update.to_dict())
+        bot_metrics.count(f"routed_worker_{shard}")
+
+def run_worker(index: int, updates, writes):
+    """Worker process: the full handler set, fed by the front end instead of polling"""
+    global async_data_manager, METRICS_PORT
+    
+    # Ctrl+C reaches the whole process group; the front end decides when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if METRICS_PORT:
+        METRICS_PORT += index + 1
+    async_data_manager = SharedDataManager(writes)
+    application = build_application(base_url=BOT_API_URL, polling=False)
+    
+    async def serve():
+        await application.initialize()
+        await application.post_init(application)
+        await application.start()
+        logger.info(f"Worker {index} ready")
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                data = await loop.run_in_executor(None, updates.get)
+                if data is None:
+                    break
+                await application.update_queue.put(Update.de_json(data, application.bot))
+        finally:
+            # stop() lets the updates already queued finish first
+            await application.stop()
+            await application.post_shutdown(application)
+            await application.shutdown()
+    
+    asyncio.run(serve())
+
+def export_shared_store() -> int:
+    store = SharedStore()
+    try:
+        return store.export_user_data(USER_DATA_FILE)
+    finally:
+        store.close()
+
+def run_sharded(workers: int):
+    """Front end: poll Telegram and hand updates to `workers` worker processes by user ID"""
+    global async_data_manager
+    
+    store = SharedStore()
+    # Single-process mode may have run since the last export - merge its users in,
+    # or the export at shutdown would overwrite them
+    if store.user_data_changed(USER_DATA_FILE):
+        started = time.perf_counter()
+        imported = store.import_user_data(USER_DATA_FILE)
+        logger.info(f"Merged {imported} users from {USER_DATA_FILE} in {time.perf_counter() - started:.1f}s")
+    if store.get_meta("force_channels") is None and os.path.exists(FORCE_CHANNELS_FILE):
+        with open(FORCE_CHANNELS_FILE, 'r') as f:
+            store.set_meta("force_channels", json.load(f))
+    store.close()
+    
+    context = multiprocessing.get_context("spawn")
+    writes = context.Queue()
+    queues = [context.Queue() for _ in range(workers)]
+    processes = [
+        context.Process(target=run_worker, args=(index, queues[index], writes), name=f"bot-worker-{index}")
+        for index in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    writer = SharedStoreWriter(writes)
+    writer.start()
+    
+    async_data_manager = SharedDataManager(writes, stats_owner=True)
+    
+    async def frontend_post_init(application: Application):
+        await async_data_manager.start()
+        await bot_metrics.start_server()
+        async_data_manager._stats_update_task = asyncio.create_task(periodic_stats_update())
+        logger.info(f"✅ Front end ready: {workers} workers, shared store {SHARED_STORE_FILE}")
+    
+    async def frontend_post_shutdown(application: Application):
+        loop = asyncio.get_running_loop()
+        for updates in queues:
+            updates.put(None)
+        for process in processes:
+            await loop.run_in_executor(None, process.join)
+        writes.put(None)
+        await loop.run_in_executor(None, writer.join)
+        
+        # keep user_data.json current for single-process mode
+        exported = await loop.run_in_executor(None, export_shared_store)
+        logger.info(f"Exported {exported} users to {USER_DATA_FILE}")
+        
+        await async_data_manager.stop()
+        await bot_metrics.stop_server()
+        logger.info("Bot shutdown complete")
+    
+    builder = Application.builder().token(BOT_TOKEN).request(InstrumentedRequest(connection_pool_size=16))
+    if BOT_API_URL:
+        builder = builder.base_url(BOT_API_URL)
+    application = builder.build()
+    application.post_init = frontend_post_init
+    application.post_shutdown = frontend_post_shutdown
+    application.add_handler(TypeHandler(Update, UpdateRouter(queues).route))
+    
+    application.run_polling(allowed_updates=Update.ALL_TYPES)
+
+def main():
+    """Start the bot"""
     print("\n" + "=" * 60)
     print("🤖 TERABOX BOT - STARTING UP")
     print("=" * 60)
@@ -1087,8 +2034,14 @@ def main():
     print(f"✅ User Data File: {USER_DATA_FILE}")
     print(f"✅ Force Channels File: {FORCE_CHANNELS_FILE}")
     print(f"✅ Supported Domains: {len(SUPPORTED_DOMAINS)}")
+    print(f"✅ Workers: {BOT_WORKERS}" + (f" (shared store: {SHARED_STORE_FILE})" if BOT_WORKERS > 1 else ""))
     print("=" * 60 + "\n")
     
+    if BOT_WORKERS > 1:
+        run_sharded(BOT_WORKERS)
+        return
+    
+    application = build_application()
     application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == '__main__':
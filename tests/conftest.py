@@ -0,0 +1,46 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+# The proxy sets up its session db, metrics and segment cache on import - keep
+# them in a scratch directory and leave the URL refresher idle
+SCRATCH_DIR = tempfile.mkdtemp(prefix="terabox_tests_")
+os.environ.setdefault("SESSION_DB_PATH", os.path.join(SCRATCH_DIR, "sessions.db"))
+os.environ.setdefault("METRICS_DIR", os.path.join(SCRATCH_DIR, "metrics"))
+os.environ.setdefault("SEGMENT_CACHE_DIR", os.path.join(SCRATCH_DIR, "segments"))
+os.environ.setdefault("URL_REFRESH_ENABLED", "0")
+# No metrics server from bot.py
+os.environ.setdefault("BOT_METRICS_PORT", "0")
+
+@pytest.fixture(scope="session")
+def proxy():
+    from api import flask_api
+    return flask_api
+
+@pytest.fixture(scope="session")
+def bot():
+    import bot
+    return bot
+
+@pytest.fixture(scope="session")
+def cdn_server():
+    from fake_cdn import FakeCDN
+    server = FakeCDN()
+    server.start()
+    yield server
+    server.stop()
+
+@pytest.fixture
+def cdn(cdn_server):
+    cdn_server.reset()
+    yield cdn_server
+    cdn_server.reset()
+
+@pytest.fixture
+def cdn_url(cdn):
+    return cdn.url
@@ -0,0 +1,110 @@
+"""A range-capable file server standing in for the Terabox CDN"""
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+FILE_SIZE = 10000
+BODY = bytes(i % 251 for i in range(FILE_SIZE))
+# What the CDN serves for ?fid=2 - same size, other bytes
+OTHER_BODY = BODY[::-1]
+ETAG = '"v1"'
+LAST_MODIFIED = "Wed, 01 Jan 2025 00:00:00 GMT"
+BLOCK_SIZE = 1024
+
+class CDNHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        cdn = self.server.cdn
+        query = parse_qs(urlparse(self.path).query)
+        cdn.log(self.path, self.headers.get("Range"))
+        if query.get("fid") == ["403"]:
+            self.send_response(403)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        body = OTHER_BODY if query.get("fid") == ["2"] else BODY
+        first, last = 0, len(body) - 1
+        status = 200
+        spec = self.headers.get("Range", "")
+        if spec.startswith("bytes="):
+            lo, _, hi = spec[6:].partition("-")
+            if not lo:
+                first = max(0, len(body) - int(hi))
+            else:
+                first = int(lo)
+                last = min(int(hi), len(body) - 1) if hi else len(body) - 1
+            if first >= len(body):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(body)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            status = 206
+
+        self.send_response(status)
+        self.send_header("Content-Type", "video/mp4")
+        self.send_header("Content-Length", str(last - first + 1))
+        self.send_header("ETag", ETAG)
+        self.send_header("Last-Modified", LAST_MODIFIED)
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {first}-{last}/{len(body)}")
+        self.end_headers()
+
+        pos = first
+        while pos <= last:
+            block = body[pos:min(pos + BLOCK_SIZE, last + 1)]
+            if cdn.should_drop(len(block)):
+                # Hang up mid-body, as a CDN node going away would
+                self.close_connection = True
+                return
+            self.wfile.write(block)
+            self.wfile.flush()
+            pos += len(block)
+            if cdn.delay:
+                time.sleep(cdn.delay)
+
+    def log_message(self, *args):
+        pass
+
+class FakeCDN:
+    """The server plus knobs a test can turn, reset between tests.
+
+    `delay` is slept after every BLOCK_SIZE bytes sent; `drop_after` makes the
+    next response hang up once that many body bytes have been sent overall.
+    """
+
+    def __init__(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), CDNHandler)
+        self.server.daemon_threads = True
+        self.server.cdn = self
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        self.lock = threading.Lock()
+        self.reset()
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+
+    def reset(self):
+        with self.lock:
+            self.delay = 0
+            self.drop_after = None
+            self.requests = []  # (path, Range header)
+            self.sent = 0
+
+    def log(self, path, range_header):
+        with self.lock:
+            self.requests.append((path, range_header))
+
+    def should_drop(self, nbytes):
+        with self.lock:
+            if self.drop_after is not None and self.sent + nbytes > self.drop_after:
+                self.drop_after = None
+                return True
+            self.sent += nbytes
+            return False
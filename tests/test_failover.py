@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+
+from fake_cdn import BODY, FILE_SIZE
+
+@pytest.fixture
+def failover(proxy, monkeypatch):
+    # Resume straight away, on a private connection the test can watch fail
+    monkeypatch.setattr(proxy, "FAILOVER_BACKOFF", 0)
+    monkeypatch.setattr(proxy, "fanout", None)
+    monkeypatch.setattr(proxy, "RELAY_MIN_CHUNK_SIZE", 1024)
+    monkeypatch.setattr(proxy, "RELAY_INITIAL_CHUNK_SIZE", 1024)
+    return proxy.failover_budget
+
+def session_for(proxy, url):
+    return url, proxy.create_session(url)
+
+def resumed_at(cdn):
+    """Where the resumed request started, after the first one was dropped"""
+    assert len(cdn.requests) == 2
+    return int(cdn.requests[1][1][6:].partition("-")[0])
+
+def test_dropped_relay_resumes_where_it_stopped(proxy, cdn, failover, request):
+    url, session_id = session_for(proxy, f"{cdn.url}/file/{request.node.name}.mp4")
+    cdn.drop_after = 3000
+    resumed = failover.stats["resumed"]
+    data = b"".join(proxy.failover_chunks(url, "stream", 0, FILE_SIZE - 1, 1024, session_id))
+    assert data == BODY
+    assert failover.stats["resumed"] == resumed + 1
+    assert 0 < resumed_at(cdn) <= 3000
+
+def test_async_relay_resumes_where_it_stopped(proxy, cdn, failover, request):
+    url, session_id = session_for(proxy, f"{cdn.url}/file/{request.node.name}.mp4")
+    cdn.drop_after = 3000
+    resumed = failover.stats["resumed"]
+
+    async def relay():
+        chunks = proxy.async_failover_chunks(url, "stream", 0, FILE_SIZE - 1, 1024, session_id)
+        return b"".join([chunk async for chunk in chunks])
+
+    assert asyncio.run(relay()) == BODY
+    assert failover.stats["resumed"] == resumed + 1
+    assert 0 < resumed_at(cdn) <= 3000
+
+def test_expired_link_resumes_on_a_fresh_one(proxy, cdn, failover, monkeypatch, request):
+    url, session_id = session_for(proxy, f"{cdn.url}/file/{request.node.name}.mp4?fid=403")
+    fresh = f"{cdn.url}/file/{request.node.name}.mp4?fid=1"
+    monkeypatch.setattr(proxy.url_refresher, "fresh_url", lambda session_id, failed_url: fresh)
+    refreshed = failover.stats["refreshed_links"]
+    data = b"".join(proxy.failover_chunks(url, "download", 0, FILE_SIZE - 1, 1024, session_id))
+    assert data == BODY
+    assert failover.stats["refreshed_links"] == refreshed + 1
+
+def test_exhausted_budget_gives_up(proxy, cdn, failover, monkeypatch, request):
+    monkeypatch.setattr(proxy, "FAILOVER_MAX_RETRIES", 0)
+    url, session_id = session_for(proxy, f"{cdn.url}/file/{request.node.name}.mp4")
+    cdn.drop_after = 3000
+    failed = failover.stats["failed"]
+    with pytest.raises(proxy.UPSTREAM_FAILURES):
+        b"".join(proxy.failover_chunks(url, "stream", 0, FILE_SIZE - 1, 1024, session_id))
+    assert failover.stats["failed"] == failed + 1
+    assert len(cdn.requests) == 1
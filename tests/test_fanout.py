@@ -0,0 +1,103 @@
+import asyncio
+import threading
+
+import pytest
+
+from fake_cdn import BODY, FILE_SIZE, OTHER_BODY
+
+def watch_together(proxy, paths, headers=None):
+    """GET every path at once - returns the responses in order"""
+    responses = [None] * len(paths)
+
+    def watch(index):
+        responses[index] = proxy.app.test_client().get(paths[index], headers=headers or {})
+
+    threads = [threading.Thread(target=watch, args=(index,)) for index in range(len(paths))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+    return responses
+
+def test_shared_read_counts_upstream_bytes_once(proxy, cdn, request):
+    url = f"{cdn.url}/file/{request.node.name}.mp4"
+    paths = [f"/stream/{proxy.create_session(url)}" for _ in range(3)]
+    # Learn the size, so the viewers go through the segment cache
+    assert proxy.app.test_client().head(paths[0]).status_code == 200
+    cdn.reset()
+    cdn.delay = 0.05
+    before = proxy.segment_cache.snapshot()["bytes_from_upstream"]
+
+    responses = watch_together(proxy, paths, {"Range": "bytes=0-"})
+
+    assert [response.data for response in responses] == [BODY] * 3
+    assert len(cdn.requests) == 1
+    assert proxy.segment_cache.snapshot()["bytes_from_upstream"] - before == FILE_SIZE
+
+# ============= THE REGISTRY =============
+
+@pytest.fixture
+def registry(proxy, monkeypatch):
+    # Relay 1 KB at a time, so a test can act between the chunks of one small file
+    monkeypatch.setattr(proxy, "RELAY_MIN_CHUNK_SIZE", 1024)
+    monkeypatch.setattr(proxy, "RELAY_INITIAL_CHUNK_SIZE", 1024)
+    return proxy.FanoutRegistry()
+
+def collect(chunks, into, index):
+    into[index] = b"".join(chunks)
+
+def test_files_behind_one_generic_path_get_their_own_fetch(proxy, cdn, registry):
+    cdn.delay = 0.02
+    urls = [f"{cdn.url}/rest/2.0/pcs/file?fid=1&sign=a", f"{cdn.url}/rest/2.0/pcs/file?fid=2&sign=b"]
+    bodies = [None, None]
+    threads = [
+        threading.Thread(target=collect, args=(registry.chunks(url, "stream", 0, FILE_SIZE - 1, 1024), bodies, index))
+        for index, url in enumerate(urls)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+    assert bodies == [BODY, OTHER_BODY]
+    assert len(cdn.requests) == 2
+
+def test_late_viewer_joins_the_running_fetch(proxy, cdn, registry, request):
+    cdn.delay = 0.02
+    url = f"{cdn.url}/file/{request.node.name}.mp4"
+    first = registry.chunks(url, "stream", 0, FILE_SIZE - 1, 1024)
+    head = next(first)
+    joins = proxy.FANOUT_STATS["joins"]
+    second = b"".join(registry.chunks(url, "stream", 0, FILE_SIZE - 1, 1024))
+    assert head + b"".join(first) == BODY
+    assert second == BODY
+    assert proxy.FANOUT_STATS["joins"] == joins + 1
+    assert len(cdn.requests) == 1
+
+def test_lagging_viewer_falls_back_to_its_own_fetch(proxy, cdn, registry, monkeypatch, request):
+    monkeypatch.setattr(proxy, "FANOUT_WINDOW", 2048)
+    url = f"{cdn.url}/file/{request.node.name}.mp4"
+    fast = registry.chunks(url, "stream", 0, FILE_SIZE - 1, 1024)
+    slow = registry.chunks(url, "stream", 0, FILE_SIZE - 1, 1024)
+    head = next(fast)
+    lagging = next(slow)
+    fallbacks = proxy.FANOUT_STATS["fallbacks"]
+    # The fast viewer reads on, taking the shared window past the slow one
+    assert head + b"".join(fast) == BODY
+    assert lagging + b"".join(slow) == BODY
+    assert proxy.FANOUT_STATS["fallbacks"] == fallbacks + 1
+    _, spec = cdn.requests[-1]
+    assert spec == f"bytes={len(lagging)}-{FILE_SIZE - 1}"
+
+def test_async_viewers_share_one_fetch(proxy, cdn, registry, request):
+    cdn.delay = 0.02
+    url = f"{cdn.url}/file/{request.node.name}.mp4"
+
+    async def watch():
+        chunks = registry.async_chunks(url, "stream", 0, FILE_SIZE - 1, 1024)
+        return b"".join([chunk async for chunk in chunks])
+
+    async def main():
+        return await asyncio.gather(watch(), watch())
+
+    assert asyncio.run(main()) == [BODY, BODY]
+    assert len(cdn.requests) == 1
@@ -0,0 +1,21 @@
+import html
+
+HOSTILE_URL = 'https://d.terabox.com/file?a=1&b="><script>alert(1)</script>\'</script>'
+
+def test_fallback_page_escapes_the_link(proxy):
+    page = proxy.download_fallback_html(HOSTILE_URL)
+    assert "<script>alert(1)" not in page
+    assert page.count("</script>") == 1
+    assert f'href="{html.escape(HOSTILE_URL)}"' in page
+    assert "\\u003c/script\\u003e" in page
+
+def test_content_disposition_quotes_the_name(proxy):
+    header = proxy.content_disposition('clip "1"\r\nX-Injected: 1 – é.mp4')
+    assert "\r" not in header and "\n" not in header
+    assert header.startswith('attachment; filename="clip _1___X-Injected: 1 _ _.mp4"')
+    assert header.endswith("filename*=UTF-8''clip%20%221%22%0D%0AX-Injected%3A%201%20%E2%80%93%20%C3%A9.mp4")
+
+def test_expired_player_page_is_not_cached(proxy):
+    response = proxy.app.test_client().get("/player/no-such-session")
+    assert "Session Expired" in response.get_data(as_text=True)
+    assert response.headers["Cache-Control"] == "no-store"
@@ -0,0 +1,49 @@
+import pytest
+
+from fake_cdn import BODY
+
+PIECE_SIZE = 1000
+
+@pytest.fixture
+def small_pieces(proxy, monkeypatch):
+    # Ten pieces per file, at most three held for reordering
+    monkeypatch.setattr(proxy, "DOWNLOAD_ACCEL_PIECE_SIZE", PIECE_SIZE)
+    monkeypatch.setattr(proxy, "DOWNLOAD_ACCEL_MIN_CONNECTIONS", 2)
+    monkeypatch.setattr(proxy, "DOWNLOAD_ACCEL_MAX_CONNECTIONS", 4)
+    monkeypatch.setattr(proxy, "DOWNLOAD_ACCEL_REORDER_PIECES", 3)
+
+def fetcher_for(proxy, url, start, end, chunk_size=300):
+    return proxy.ParallelRangeFetcher(proxy.open_download_upstream, url, start, end, chunk_size)
+
+def test_pieces_come_back_in_order(proxy, cdn, small_pieces, request):
+    cdn.delay = 0.01
+    fetcher = fetcher_for(proxy, f"{cdn.url}/file/{request.node.name}.mp4", 150, 9849)
+    chunks = list(fetcher.chunks())
+    assert b"".join(chunks) == BODY[150:9850]
+    assert max(len(chunk) for chunk in chunks) <= 300
+    ranges = sorted(int(spec[6:].partition("-")[0]) for _, spec in cdn.requests)
+    assert ranges == list(range(150, 9850, PIECE_SIZE))
+    # Reordering never held more than the allowed pieces, and all of it is freed
+    assert fetcher.memory["peak"] <= 3 * PIECE_SIZE
+    assert fetcher.memory["closed"]
+
+def test_refused_piece_fails_the_download(proxy, cdn_url, small_pieces):
+    fetcher = fetcher_for(proxy, f"{cdn_url}/file/refused.mp4?fid=403", 0, 9999)
+    with pytest.raises(proxy.UpstreamRefused) as refused:
+        list(fetcher.chunks())
+    assert refused.value.status == 403
+    assert fetcher.stopped
+
+def test_short_piece_fails_the_download(proxy, cdn, small_pieces, request):
+    cdn.drop_after = 2500
+    fetcher = fetcher_for(proxy, f"{cdn.url}/file/{request.node.name}.mp4", 0, 9999)
+    with pytest.raises(IOError, match="ended after"):
+        list(fetcher.chunks())
+
+def test_accelerated_download_end_to_end(proxy, cdn, small_pieces, monkeypatch, request):
+    monkeypatch.setattr(proxy, "DOWNLOAD_ACCEL_MIN_BYTES", 0)
+    session_id = proxy.create_session(f"{cdn.url}/file/{request.node.name}.mp4")
+    response = proxy.app.test_client().get(f"/download/{session_id}?accel=1", headers={"Range": "bytes=0-"})
+    assert response.data == BODY
+    # The download went out over several piece requests rather than one
+    assert len(cdn.requests) > 2
@@ -0,0 +1,161 @@
+import pytest
+
+from fake_cdn import BODY, ETAG, FILE_SIZE, LAST_MODIFIED, OTHER_BODY
+
+# ============= PARSING AND PLANNING =============
+
+@pytest.mark.parametrize("value, expected", [
+    ("bytes=0-499", (0, 499)),
+    ("bytes=500-", (500, None)),
+    ("bytes=-500", (None, 500)),
+    (" Bytes = 10-20", (10, 20)),
+    (None, None),
+    ("", None),
+    ("items=0-10", None),
+    ("bytes=0-10,20-30", None),
+    ("bytes=10-5", None),
+    ("bytes=abc-", None),
+    ("bytes=-", None),
+    ("bytes=5", None),
+])
+def test_parse_byte_range(proxy, value, expected):
+    assert proxy.parse_byte_range(value) == expected
+
+@pytest.mark.parametrize("byte_range, expected", [
+    (None, (200, 0, 9999)),
+    ((0, 499), (206, 0, 499)),
+    ((9000, None), (206, 9000, 9999)),
+    ((9000, 20000), (206, 9000, 9999)),
+    ((None, 500), (206, 9500, 9999)),
+    ((None, 20000), (206, 0, 9999)),
+    ((10000, None), None),
+    ((None, 0), None),
+])
+def test_plan_window(proxy, byte_range, expected):
+    assert proxy.plan_window(byte_range, FILE_SIZE) == expected
+
+def test_plan_window_empty_file(proxy):
+    assert proxy.plan_window((None, 10), 0) is None
+    assert proxy.plan_window((0, None), 0) is None
+
+def test_unknown_size_lets_upstream_resolve(proxy):
+    assert proxy.plan_client_range("bytes=-500", None, None) == ((None, 500), None, "bytes=-500")
+    assert proxy.plan_client_range(None, None, None) == (None, None, "bytes=0-")
+
+@pytest.mark.parametrize("if_range, expected", [
+    (ETAG, (206, 100, 199)),
+    (LAST_MODIFIED, (206, 100, 199)),
+    ('"v2"', (200, 0, 9999)),
+    ('W/"v1"', (200, 0, 9999)),
+    ("Thu, 02 Jan 2025 00:00:00 GMT", (200, 0, 9999)),
+])
+def test_if_range(proxy, if_range, expected):
+    info = {"size": FILE_SIZE, "etag": ETAG, "last_modified": LAST_MODIFIED}
+    _, window, _ = proxy.plan_client_range("bytes=100-199", if_range, info)
+    assert window == expected
+
+def test_unsatisfiable_with_known_size(proxy):
+    info = {"size": FILE_SIZE, "etag": None, "last_modified": None}
+    assert proxy.plan_client_range("bytes=20000-", None, info)[1] == "unsatisfiable"
+
+def test_upstream_response_mapping(proxy):
+    url = "https://cdn.test/file/mapping.mp4"
+    headers = {"Content-Range": f"bytes 0-{FILE_SIZE - 1}/{FILE_SIZE}"}
+    assert proxy.plan_upstream_response(url, (None, 500), 206, headers)[0] == "relay"
+    # The CDN started at 0 for an open-ended request, so the relay skips ahead
+    outcome, (status, start, end, skip, _) = proxy.plan_upstream_response(url, (9000, None), 206, headers)
+    assert (status, start, end, skip) == (206, 9000, 9999, 9000)
+    assert proxy.plan_upstream_response(url, None, 416, {"Content-Range": f"bytes */{FILE_SIZE}"}) == (
+        "unsatisfiable", FILE_SIZE
+    )
+    assert proxy.plan_upstream_response("https://cdn.test/file/unknown.mp4", None, 403, {}) == ("passthrough", None)
+
+# ============= AGAINST A FAKE CDN =============
+
+@pytest.fixture
+def stream_path(proxy, cdn_url, request):
+    # A file per test, so nothing learned or cached by one test leaks into the next
+    session_id = proxy.create_session(f"{cdn_url}/file/{request.node.name}.mp4")
+    return f"/stream/{session_id}"
+
+def fetch(proxy, path, headers=None):
+    return proxy.app.test_client().get(path, headers=headers or {})
+
+def test_stream_suffix_range(proxy, stream_path):
+    response = fetch(proxy, stream_path, {"Range": "bytes=-500"})
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == f"bytes 9500-9999/{FILE_SIZE}"
+    assert response.data == BODY[-500:]
+
+def test_stream_open_ended_range(proxy, stream_path):
+    response = fetch(proxy, stream_path, {"Range": "bytes=1234-"})
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == f"bytes 1234-9999/{FILE_SIZE}"
+    assert response.data == BODY[1234:]
+
+def test_stream_range_after_size_is_known(proxy, stream_path):
+    assert fetch(proxy, stream_path).data == BODY
+    response = fetch(proxy, stream_path, {"Range": "bytes=100-199"})
+    assert response.status_code == 206
+    assert response.headers["Content-Length"] == "100"
+    assert response.data == BODY[100:200]
+
+def test_stream_unsatisfiable_range(proxy, stream_path):
+    response = fetch(proxy, stream_path, {"Range": "bytes=20000-"})
+    assert response.status_code == 416
+    assert response.headers["Content-Range"] == f"bytes */{FILE_SIZE}"
+    # Now that the size is known the proxy answers without asking the CDN
+    assert fetch(proxy, stream_path, {"Range": "bytes=20000-"}).status_code == 416
+
+def test_stream_if_range_match(proxy, stream_path):
+    response = fetch(proxy, stream_path, {"Range": "bytes=100-199", "If-Range": ETAG})
+    assert response.status_code == 206
+    assert response.data == BODY[100:200]
+
+def test_stream_if_range_mismatch_sends_whole_file(proxy, stream_path):
+    response = fetch(proxy, stream_path, {"Range": "bytes=100-199", "If-Range": '"v0"'})
+    assert response.status_code == 200
+    assert response.data == BODY
+
+def test_stream_head(proxy, stream_path):
+    response = proxy.app.test_client().head(stream_path, headers={"Range": "bytes=0-99"})
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == f"bytes 0-99/{FILE_SIZE}"
+    assert response.headers["Content-Length"] == "100"
+
+def test_files_behind_one_generic_path_stay_apart(proxy, cdn_url):
+    first = proxy.create_session(f"{cdn_url}/rest/2.0/pcs/file?fid=1&sign=a")
+    second = proxy.create_session(f"{cdn_url}/rest/2.0/pcs/file?fid=2&sign=b")
+    assert fetch(proxy, f"/stream/{first}").data == BODY
+    assert fetch(proxy, f"/stream/{second}").data == OTHER_BODY
+    assert fetch(proxy, f"/stream/{first}", {"Range": "bytes=0-99"}).data == BODY[:100]
+    assert fetch(proxy, f"/stream/{second}", {"Range": "bytes=0-99"}).data == OTHER_BODY[:100]
+
+# ============= RESOURCE KEYS =============
+
+INFO = {"size": FILE_SIZE, "etag": ETAG, "last_modified": LAST_MODIFIED}
+
+def test_resigned_link_keeps_its_key(proxy):
+    key = proxy.resource_key("https://d.cdn.test/file/abc?fid=7&sign=x&time=1&expires=8h", INFO)
+    assert proxy.resource_key("https://D.cdn.test/file/abc?expires=8h&time=2&sign=y&fid=7", INFO) == key
+
+@pytest.mark.parametrize("url, info", [
+    ("https://d.cdn.test/file/abc?fid=8&sign=x", INFO),
+    ("https://d2.cdn.test/file/abc?fid=7&sign=x", INFO),
+    ("https://d.cdn.test/file/abd?fid=7&sign=x", INFO),
+    ("https://d.cdn.test/file/abc?fid=7&sign=x", {**INFO, "size": FILE_SIZE + 1}),
+    ("https://d.cdn.test/file/abc?fid=7&sign=x", {**INFO, "etag": '"v2"'}),
+])
+def test_other_files_get_other_keys(proxy, url, info):
+    assert proxy.resource_key(url, info) != proxy.resource_key("https://d.cdn.test/file/abc?fid=7&sign=x", INFO)
+
+# ============= RELAY BUFFERS =============
+
+def test_short_relay_keeps_a_short_buffer(proxy, cdn_url, monkeypatch):
+    memory = proxy.RelayMemory()
+    monkeypatch.setattr(proxy, "relay_memory", memory)
+    req = proxy.requests.get(f"{cdn_url}/file/short_relay.mp4", stream=True)
+    data = b"".join(proxy.relay_chunks(req, 8 * 1024 * 1024, skip=100, length=1000))
+    assert data == BODY[100:1100]
+    # Buffer plus the copy handed on - nowhere near a max-size chunk
+    assert memory.snapshot()["max_stream_peak_bytes"] <= 2 * 1100
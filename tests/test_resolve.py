@@ -0,0 +1,79 @@
+import pytest
+
+LINKS = [
+    "https://www.terabox.com/s/1aaa",
+    "https://terabox.com/s/1bbb/",
+    "https://1024terabox.com/s/1ccc",
+]
+
+class FakeApify:
+    """Stands in for the ApifyClient - `answer(links)` returns a run's dataset items"""
+
+    def __init__(self, answer):
+        self.answer = answer
+        self.runs = []
+
+    def actor(self, actor_id):
+        return self
+
+    def call(self, run_input):
+        self.runs.append(list(run_input["links"]))
+        return {"defaultDatasetId": len(self.runs) - 1}
+
+    def dataset(self, dataset_id):
+        items = self.answer(self.runs[dataset_id])
+        return type("Dataset", (), {"iterate_items": lambda _: iter(items)})()
+
+@pytest.fixture
+def apify(proxy, monkeypatch):
+    def install(answer):
+        fake = FakeApify(answer)
+        monkeypatch.setattr(proxy, "client", fake)
+        return fake
+    return install
+
+def download_url(link):
+    return "https://d.cdn.test/file/" + link.rstrip("/").rsplit("/", 1)[-1]
+
+EXPECTED = {link: download_url(link) for link in LINKS}
+
+@pytest.mark.parametrize("field", ["url", "link", "input_url", "original_url", "share_url"])
+def test_items_echoing_their_link(proxy, apify, field):
+    # Another spelling of the link, out of order
+    fake = apify(lambda links: [
+        {field: link.replace("https://www.", "http://").rstrip("/"), "success": True, "download_url": download_url(link)}
+        for link in reversed(links)
+    ])
+    assert proxy.resolve_terabox_urls(LINKS) == EXPECTED
+    assert fake.runs == [LINKS]
+
+def test_items_in_input_order(proxy, apify):
+    fake = apify(lambda links: [{"success": True, "download_url": download_url(link)} for link in links])
+    assert proxy.resolve_terabox_urls(LINKS) == EXPECTED
+    assert len(fake.runs) == 1
+
+def test_unmatchable_items_are_resolved_one_by_one(proxy, apify):
+    # No source link and the first link missing - nothing says which link is which
+    fake = apify(lambda links: [
+        {"success": True, "download_url": download_url(link)} for link in links if link != LINKS[0]
+    ])
+    assert proxy.resolve_terabox_urls(LINKS) == {**EXPECTED, LINKS[0]: None}
+    assert fake.runs[0] == LINKS
+    assert sorted(fake.runs[1:]) == sorted([link] for link in LINKS)
+
+def test_failed_links_are_not_retried(proxy, apify):
+    fake = apify(lambda links: [
+        {"url": link, "success": link != LINKS[1], "download_url": download_url(link)} for link in links
+    ])
+    assert proxy.resolve_terabox_urls(LINKS) == {**EXPECTED, LINKS[1]: None}
+    assert len(fake.runs) == 1
+
+def test_single_link(proxy, apify):
+    apify(lambda links: [{"status": "done"}, {"success": True, "download_url": download_url(links[0])}])
+    assert proxy.get_terabox_download_url(LINKS[0]) == EXPECTED[LINKS[0]]
+
+def test_actor_error(proxy, apify):
+    def fail(links):
+        raise RuntimeError("actor failed")
+    apify(fail)
+    assert proxy.resolve_terabox_urls(LINKS) == dict.fromkeys(LINKS)
@@ -0,0 +1,75 @@
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SECRET = b"test-secret"
+
+def make_session(expire_in=3600):
+    now = time.time()
+    return {
+        "download_url": "https://d.terabox.com/file/video.mp4?sign=abc",
+        "filename": "video_abc.mp4",
+        "expire": now + expire_in,
+        "terabox_url": "https://www.terabox.com/s/1abc",
+        "url_issued": now,
+        "url_expire": now + 8 * 3600,
+    }
+
+@pytest.fixture
+def token_mode(proxy, monkeypatch):
+    monkeypatch.setattr(proxy, "SESSION_MODE", "token")
+    monkeypatch.setattr(proxy, "TOKEN_MAC_KEY", proxy.derive_token_key(b"mac", SECRET))
+    monkeypatch.setattr(proxy, "TOKEN_ENC_KEY", proxy.derive_token_key(b"enc", SECRET))
+    return proxy
+
+def test_round_trip(token_mode):
+    session = make_session()
+    token = token_mode.encode_session_token(session)
+
+    decoded = token_mode.get_session(token)
+    assert decoded["download_url"] == session["download_url"]
+    assert decoded["filename"] == session["filename"]
+    assert decoded["terabox_url"] == session["terabox_url"]
+    assert decoded["expire"] == int(session["expire"])
+
+def test_token_signed_with_another_secret_is_rejected(token_mode, monkeypatch):
+    # What anyone could mint while the key was derived from an empty secret
+    monkeypatch.setattr(token_mode, "TOKEN_MAC_KEY", token_mode.derive_token_key(b"mac", b""))
+    forged = token_mode.encode_session_token({
+        **make_session(), "download_url": "http://169.254.169.254/latest/meta-data/",
+    })
+    monkeypatch.setattr(token_mode, "TOKEN_MAC_KEY", token_mode.derive_token_key(b"mac", SECRET))
+
+    assert token_mode.decode_session_token(forged) is None
+    assert token_mode.get_session(forged) is None
+
+def test_tampered_token_is_rejected(token_mode):
+    body, mac = token_mode.encode_session_token(make_session()).split(".")
+    flipped = "A" if body[5] != "A" else "B"
+
+    assert token_mode.get_session(f"{body[:5]}{flipped}{body[6:]}.{mac}") is None
+    assert token_mode.get_session(f"{body}.{mac[:-2]}") is None
+    assert token_mode.get_session(body) is None
+
+def test_expired_token_is_rejected(token_mode):
+    token = token_mode.encode_session_token(make_session(expire_in=-1))
+    assert token_mode.get_session(token) is None
+
+def test_store_mode_ignores_tokens(token_mode, monkeypatch):
+    token = token_mode.encode_session_token(make_session())
+    monkeypatch.setattr(token_mode, "SESSION_MODE", "store")
+    assert token_mode.get_session(token) is None
+
+def test_token_mode_requires_secret():
+    env = {key: value for key, value in os.environ.items() if key != "SESSION_SECRET"}
+    env["SESSION_MODE"] = "token"
+    result = subprocess.run(
+        [sys.executable, "-c", "from api import flask_api"],
+        cwd=REPO_ROOT, env=env, capture_output=True, text=True, timeout=60,
+    )
+    assert result.returncode != 0
+    assert "SESSION_SECRET" in result.stderr
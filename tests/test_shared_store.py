@@ -0,0 +1,102 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+DAY = 24 * 3600
+NOW = 1_750_000_000.0
+
+@pytest.fixture
+def store(bot, tmp_path):
+    store = bot.SharedStore(str(tmp_path / "shared.sqlite3"))
+    yield store
+    store.close()
+
+def users_in(store):
+    return {
+        row[0]: row[1:]
+        for row in store.db.execute("SELECT user_id, first_seen, last_seen, total_queries FROM users")
+    }
+
+def write_user_data(bot, path, users):
+    """user_data.json as single-process mode writes it, with a new mtime"""
+    record = lambda first, last, queries: {
+        "first_seen": bot.timestamp_to_iso(first),
+        "last_seen": bot.timestamp_to_iso(last),
+        "total_queries": queries,
+    }
+    previous = os.stat(path).st_mtime_ns if os.path.exists(path) else 0
+    with open(path, "w") as f:
+        json.dump({"users": {str(uid): record(*row) for uid, row in users.items()}, "total_users": len(users)}, f)
+    os.utime(path, ns=(previous + 10 ** 9, previous + 10 ** 9))
+
+def test_export_then_import_changes_nothing(bot, store, tmp_path):
+    path = str(tmp_path / "user_data.json")
+    store.upsert_users([(1, NOW - DAY, NOW, 5), (2, NOW - DAY, NOW - 10, 1)])
+    assert store.export_user_data(path) == 2
+    assert not store.user_data_changed(path)
+
+    # Even re-importing it on purpose doesn't add the counts again
+    store.import_user_data(path)
+    assert users_in(store) == {1: (NOW - DAY, NOW, 5), 2: (NOW - DAY, NOW - 10, 1)}
+
+def test_newer_user_data_is_merged(bot, store, tmp_path):
+    path = str(tmp_path / "user_data.json")
+    store.upsert_users([(1, NOW - DAY, NOW, 5), (2, NOW - DAY, NOW, 1)])
+    store.export_user_data(path)
+
+    # Single-process mode ran since: user 1 came back, user 3 is new
+    write_user_data(bot, path, {1: (NOW - DAY, NOW + 60, 7), 2: (NOW - DAY, NOW, 1), 3: (NOW + 30, NOW + 30, 1)})
+    # and this store saw a user of its own the file never had
+    store.upsert_users([(4, NOW + 10, NOW + 10, 2)])
+
+    assert store.user_data_changed(path)
+    store.import_user_data(path)
+    assert not store.user_data_changed(path)
+    assert users_in(store) == {
+        1: (NOW - DAY, NOW + 60, 7),
+        2: (NOW - DAY, NOW, 1),
+        3: (NOW + 30, NOW + 30, 1),
+        4: (NOW + 10, NOW + 10, 2),
+    }
+
+    # The export at shutdown now keeps everyone
+    assert store.export_user_data(path) == 4
+
+def test_no_user_data_file(store, tmp_path):
+    assert not store.user_data_changed(str(tmp_path / "missing.json"))
+
+def test_shared_data_manager_reads_in_a_thread(bot, tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, "SHARED_STORE_FILE", str(tmp_path / "shared.sqlite3"))
+    seed = bot.SharedStore()
+    seed.upsert_users([(1, NOW - DAY, NOW, 5), (2, NOW - 2 * DAY, NOW - 2 * DAY, 1)])
+    seed.close()
+
+    async def read():
+        manager = bot.SharedDataManager(writes=None)
+        await manager.start()
+        try:
+            return (
+                await manager.get_user_stats(),
+                sorted(await manager.get_all_user_ids()),
+                await manager.count_users_since(NOW - DAY),
+            )
+        finally:
+            await manager.stop()
+
+    stats, user_ids, active = asyncio.run(read())
+    assert stats["total_users"] == 2 and not stats["loading"]
+    assert user_ids == ["1", "2"]
+    assert active == 1
+
+@pytest.mark.parametrize("hits, allowed", [(9, True), (10, False)])
+def test_rate_limit_is_per_process(bot, hits, allowed):
+    cache = bot.CacheManager()
+
+    async def check():
+        for _ in range(hits):
+            assert await cache.check_rate_limit(42)
+        return await cache.check_rate_limit(42)
+
+    assert asyncio.run(check()) is allowed
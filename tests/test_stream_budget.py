@@ -0,0 +1,75 @@
+import json
+import os
+import time
+
+from fake_cdn import BODY
+
+def open_stream(proxy, path):
+    """Start a GET without reading its body - the slot stays held until close()"""
+    return proxy.app.test_client().get(path, buffered=False)
+
+def test_full_budget_answers_503(proxy, cdn_url, request, monkeypatch):
+    # Room for exactly one more stream, whatever unclosed test responses still hold
+    monkeypatch.setattr(proxy.stream_budget, "max_active", proxy.stream_budget.active + 1)
+    path = f"/stream/{proxy.create_session(f'{cdn_url}/file/{request.node.name}.mp4')}"
+    held = open_stream(proxy, path)
+    try:
+        response = proxy.app.test_client().get(path)
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == str(proxy.STREAM_RETRY_AFTER)
+        assert response.headers["Cache-Control"] == "no-store"
+    finally:
+        held.close()
+    assert proxy.app.test_client().get(path).data == BODY
+
+def test_client_disconnect_frees_the_slot(proxy, cdn, request):
+    cdn.delay = 0.05
+    path = f"/stream/{proxy.create_session(f'{cdn.url}/file/{request.node.name}.mp4')}"
+    active = proxy.stream_budget.active
+    response = open_stream(proxy, path)
+    assert next(iter(response.response))
+    assert proxy.stream_budget.active == active + 1
+    # The client hangs up mid-body
+    response.close()
+    assert proxy.stream_budget.active == active
+
+# ============= SHARED ACROSS WORKERS =============
+
+def write_peer(directory, name, usage, age=0):
+    path = os.path.join(directory, f"{name}.json")
+    with open(path, "w") as f:
+        json.dump(usage, f)
+    if age:
+        then = time.time() - age
+        os.utime(path, (then, then))
+    return path
+
+def test_peers_count_against_the_limits(proxy, tmp_path):
+    budget = proxy.StreamBudget(4, 0, 0, shared_dir=str(tmp_path))
+    write_peer(tmp_path, "1", {"active": 2, "buffer_bytes": 100, "egress_bps": 5.0})
+    write_peer(tmp_path, "2", {"active": 1, "buffer_bytes": 50, "egress_bps": 0.0})
+    budget.sync()
+    assert budget.peers == {"workers": 2, "active": 3, "buffer_bytes": 150, "egress_bps": 5.0}
+    assert budget.admit() is None
+    assert budget.admit() == "streams"
+    snapshot = budget.snapshot()
+    assert (snapshot["scope"], snapshot["workers"], snapshot["active_streams"]) == ("proxy", 3, 4)
+
+def test_sync_publishes_own_usage(proxy, tmp_path):
+    budget = proxy.StreamBudget(4, 0, 0, shared_dir=str(tmp_path))
+    assert budget.admit() is None
+    budget.sync()
+    with open(tmp_path / f"{os.getpid()}.json") as f:
+        assert json.load(f)["active"] == 1
+    # Its own file is not counted as a peer
+    assert budget.peers["workers"] == 0
+
+def test_stale_peers_are_ignored(proxy, tmp_path):
+    budget = proxy.StreamBudget(4, 0, 0, shared_dir=str(tmp_path))
+    hung = write_peer(tmp_path, "1", {"active": 4}, age=10 * proxy.STREAM_BUDGET_SYNC_INTERVAL)
+    gone = write_peer(tmp_path, "2", {"active": 4}, age=2 * proxy.METRICS_RETENTION)
+    budget.sync()
+    assert budget.peers["workers"] == 0
+    assert budget.admit() is None
+    assert os.path.exists(hung)
+    assert not os.path.exists(gone)
@@ -0,0 +1,56 @@
+import time
+
+import pytest
+
+HOST = "d.cdn.test"
+
+@pytest.fixture
+def refresher(proxy, monkeypatch):
+    refresher = proxy.UrlRefresher()
+    # Re-resolving calls Apify
+    monkeypatch.setattr(refresher, "schedule", lambda session_id: None)
+    return refresher
+
+def issue_link(proxy, refresher, name, age):
+    """A tracked session whose link was handed out `age` seconds ago"""
+    url = f"https://{HOST}/file/{name}.mp4"
+    session_id = proxy.create_session(url)
+    session = proxy.get_session(session_id)
+    session["url_issued"] = time.time() - age
+    refresher.touch(session_id, session)
+    return url
+
+def learned(proxy, refresher):
+    return refresher.expiry_for(f"https://{HOST}/file/any.mp4", 0)
+
+def test_link_rejected_before_serving_teaches_nothing(proxy, refresher):
+    for i in range(5):
+        refresher.url_rejected(issue_link(proxy, refresher, f"blocked{i}", 120))
+    assert HOST not in refresher.learned_ttl
+    assert learned(proxy, refresher) == proxy.URL_DEFAULT_TTL
+
+def test_lifetime_needs_repeated_observations(proxy, refresher):
+    for i in range(proxy.URL_TTL_MIN_SAMPLES):
+        assert learned(proxy, refresher) == proxy.URL_DEFAULT_TTL
+        url = issue_link(proxy, refresher, f"expired{i}", 3600)
+        refresher.url_served(url)
+        refresher.url_rejected(url)
+    assert learned(proxy, refresher) == pytest.approx(3600, abs=5)
+
+def test_learned_lifetime_recovers(proxy, refresher):
+    for i in range(proxy.URL_TTL_MIN_SAMPLES):
+        url = issue_link(proxy, refresher, f"short{i}", 600)
+        refresher.url_served(url)
+        refresher.url_rejected(url)
+    assert learned(proxy, refresher) == pytest.approx(600, abs=5)
+
+    # A longer-lived link, served while young, pulls the estimate back up
+    url = issue_link(proxy, refresher, "long", 0)
+    refresher.url_served(url)
+    refresher.links[url]["issued"] -= 3600
+    refresher.url_rejected(url)
+    assert 600 < learned(proxy, refresher) < 3600
+
+    # And a link seen serving past the estimate lifts it at once
+    refresher.url_served(issue_link(proxy, refresher, "alive", 7200))
+    assert learned(proxy, refresher) == pytest.approx(7200, abs=5)
@@ -0,0 +1,66 @@
+import json
+
+import pytest
+
+# Strings with escapes and with the "}," the batch decoder cuts at, a nested
+# object and top-level fields on both sides of "users"
+DOCUMENT = json.dumps({
+    "total_users": 4,
+    "users": {
+        "1001": {"first_seen": "2025-01-01T00:00:00+05:30", "total_queries": 3},
+        "1002": {"name": 'quote " and backslash \\ and }, inside', "total_queries": 12},
+        "1003": {"name": "caf\u00e9 \U0001f389 \n\t", "tags": {"a": [1, 2.5, None, True]}},
+        "1004": {"total_queries": 1234567890},
+    },
+    "last_24h_users": 2,
+    "last_update": None,
+}, indent=4)
+
+def parse(bot, chunks):
+    parser = bot.UserDataStreamParser()
+    users, fields = {}, {}
+    for chunk in chunks:
+        for kind, key, value in parser.feed(chunk):
+            (users if kind == "user" else fields)[key] = value
+    parser.close()
+    return users, fields
+
+def expected():
+    document = json.loads(DOCUMENT)
+    return document.pop("users"), document
+
+def test_document_has_the_escapes():
+    for escape in ('\\"', "\\\\", "\\u00e9", "\\ud83c\\udf89", "\\n"):
+        assert escape in DOCUMENT
+
+def test_whole_document(bot):
+    assert parse(bot, [DOCUMENT]) == expected()
+
+@pytest.mark.parametrize("size", [1, 2, 3, 5, 7, 16, 64])
+def test_fixed_size_chunks(bot, size):
+    chunks = [DOCUMENT[i:i + size] for i in range(0, len(DOCUMENT), size)]
+    assert parse(bot, chunks) == expected()
+
+def test_every_split_point(bot):
+    # Covers cuts inside keys, inside strings, right after a backslash,
+    # inside \u escapes and inside numbers
+    for split in range(1, len(DOCUMENT)):
+        assert parse(bot, [DOCUMENT[:split], DOCUMENT[split:]]) == expected(), split
+
+def test_split_inside_escapes(bot):
+    for escape in ('\\"', "\\\\", "\\u00e9", "\\ud83c\\udf89"):
+        at = DOCUMENT.index(escape)
+        for offset in range(1, len(escape)):
+            split = at + offset
+            assert parse(bot, [DOCUMENT[:split], DOCUMENT[split:]]) == expected(), escape
+
+def test_truncated_document(bot):
+    document = DOCUMENT.rstrip()
+    for cut in range(len(document)):
+        with pytest.raises(ValueError):
+            parse(bot, [document[:cut]])
+
+@pytest.mark.parametrize("text", ["[]", '{"users": []}', '{"users": {}} {}', '{"users" 1}'])
+def test_malformed_document(bot, text):
+    with pytest.raises(ValueError):
+        parse(bot, [text])